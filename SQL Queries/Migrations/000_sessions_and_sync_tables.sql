@@ -0,0 +1,54 @@
+-- Tables added after the first schema: login sessions, the change log and sync state for branch
+-- sync, and the reconcile audit trail. Numbered 000 because 001 indexes Sessions. Every statement
+-- is IF NOT EXISTS, so this also runs cleanly on a database created from the current
+-- LibraryCreateQueries.txt. (Inventory and Borrow become branch-aware in migrate.py, through
+-- branches.migrate, before any of these files run.)
+
+CREATE TABLE IF NOT EXISTS Sessions(
+	Token CHAR(64) PRIMARY KEY,
+	Email VARCHAR(100) REFERENCES LibraryUsers ON DELETE CASCADE,
+	IsAdmin CHAR(1),
+	Expires TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ChangeSeq(
+	Id INTEGER PRIMARY KEY,
+	Seq BIGINT NOT NULL
+);
+INSERT INTO ChangeSeq(Id, Seq) VALUES (1, 0) ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS ChangeLog(
+	Seq BIGINT PRIMARY KEY,
+	Origin VARCHAR(40) NOT NULL,
+	TableName VARCHAR(20) NOT NULL,
+	Op CHAR(1) NOT NULL,
+	RowKey VARCHAR(120) NOT NULL,
+	Data TEXT,
+	Changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS InventoryAudit(
+	RunID VARCHAR(40) NOT NULL,
+	Branch VARCHAR(40) NOT NULL,
+	ISBN CHAR(13) NOT NULL,
+	OldQuantity INTEGER,
+	NewQuantity INTEGER,
+	OldCopies INTEGER,
+	NewCopies INTEGER,
+	Loans INTEGER,
+	Reason VARCHAR(20),
+	Repaired TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+	CONSTRAINT audit_pk PRIMARY KEY(RunID, Branch, ISBN)
+);
+
+CREATE TABLE IF NOT EXISTS SyncState(
+	Peer VARCHAR(40) PRIMARY KEY,
+	LastSeq BIGINT NOT NULL
+);
+
+-- The grants LibraryCreateQueries.txt gives these tables (its GRANT ... ON ALL TABLES ran before they existed)
+GRANT SELECT,INSERT,UPDATE,DELETE ON Sessions, ChangeSeq, ChangeLog, InventoryAudit, SyncState TO librarian;
+GRANT SELECT ON Sessions, ChangeSeq, ChangeLog, InventoryAudit, SyncState TO patron;
+GRANT SELECT,INSERT,DELETE ON Sessions TO patron;
+GRANT INSERT ON ChangeLog TO patron;
+GRANT UPDATE ON ChangeSeq TO patron;
@@ -0,0 +1,31 @@
+-- Replace the HASH indexes with B-tree indexes shaped like the queries in main.py and services.py.
+-- Every statement is IF [NOT] EXISTS, so this also runs cleanly on a database created from the
+-- current LibraryCreateQueries.txt (which has these indexes already).
+
+-- email and isbn duplicated the LibraryUsers and Books primary keys
+DROP INDEX IF EXISTS email_index;
+DROP INDEX IF EXISTS isbn_index;
+
+-- Subject search and recommendations (subject = $1), titles in order, ISBN without a table visit
+DROP INDEX IF EXISTS subject_index;
+CREATE INDEX IF NOT EXISTS books_subject_index ON Books (Subject, Title) INCLUDE (ISBN);
+
+-- Author search: lastname = $1 ORDER BY firstname
+DROP INDEX IF EXISTS lastname_index;
+CREATE INDEX IF NOT EXISTS authors_lastname_index ON Authors (LastName, FirstName) INCLUDE (AuthorID);
+
+-- Books to authors: the WrittenBy primary key starts with AuthorID, subject search comes in by ISBN
+CREATE INDEX IF NOT EXISTS writtenby_isbn_index ON WrittenBy (ISBN, AuthorID);
+
+-- Next due date of an ISBN at a branch, loans per ISBN range (reconcile.py)
+CREATE INDEX IF NOT EXISTS borrow_isbn_index ON Borrow (ISBN, DueDate);
+
+-- Overdue report and dashboard: duedate < CURRENT_DATE, oldest first, the whole row from the index
+CREATE INDEX IF NOT EXISTS borrow_duedate_index ON Borrow (DueDate) INCLUDE (Branch, ISBN, Email, BorrowDate);
+
+-- Dashboard: the most recent checkouts
+CREATE INDEX IF NOT EXISTS borrow_borrowdate_index ON Borrow (BorrowDate);
+
+-- Sessions: ON DELETE CASCADE from LibraryUsers, and the expired-session sweep at logout
+CREATE INDEX IF NOT EXISTS sessions_email_index ON Sessions (Email);
+CREATE INDEX IF NOT EXISTS sessions_expires_index ON Sessions (Expires);
@@ -0,0 +1,29 @@
+-- Catalog version for the author search cache: a one-row counter bumped by a statement trigger on
+-- every write to Books, Authors or WrittenBy. Safe to run on a database that already has it.
+
+CREATE TABLE IF NOT EXISTS CatalogVersion(
+	Id INTEGER PRIMARY KEY,
+	Version BIGINT NOT NULL
+);
+INSERT INTO CatalogVersion(Id, Version) VALUES (1, 0) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+	UPDATE CatalogVersion SET Version = Version + 1 WHERE Id = 1;
+	RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS books_catalog_version ON Books;
+CREATE TRIGGER books_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Books
+	FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+DROP TRIGGER IF EXISTS authors_catalog_version ON Authors;
+CREATE TRIGGER authors_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Authors
+	FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+DROP TRIGGER IF EXISTS writtenby_catalog_version ON WrittenBy;
+CREATE TRIGGER writtenby_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON WrittenBy
+	FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
+-- Tables created after the GRANT ... ON ALL TABLES in LibraryCreateQueries.txt need their own
+GRANT SELECT,INSERT,UPDATE,DELETE ON CatalogVersion TO librarian;
+GRANT SELECT ON CatalogVersion TO patron;
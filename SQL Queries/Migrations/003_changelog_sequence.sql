@@ -0,0 +1,10 @@
+-- Change log numbers come from a sequence instead of the locked ChangeSeq row (see changelog.py).
+-- Run it with every desk stopped and upgraded together: old code still counting in ChangeSeq
+-- would hand out the same numbers. The sequence carries on from the highest number already used.
+
+CREATE SEQUENCE IF NOT EXISTS changelog_seq;
+SELECT setval('changelog_seq', GREATEST((SELECT MAX(seq) FROM ChangeLog), (SELECT seq FROM ChangeSeq WHERE id = 1),
+                                        (SELECT last_value FROM changelog_seq), 1));
+
+GRANT USAGE, SELECT ON SEQUENCE changelog_seq TO librarian;
+GRANT USAGE ON SEQUENCE changelog_seq TO patron;
@@ -0,0 +1,5 @@
+-- Earlier versions let patron update LibraryUsers.password (for upgrading old hashes at login),
+-- which let any patron connection overwrite anyone's password. Login now does that upgrade through a
+-- librarian connection, checking the old hash.
+
+REVOKE UPDATE (password) ON LibraryUsers FROM patron;
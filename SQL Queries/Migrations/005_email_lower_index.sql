@@ -0,0 +1,4 @@
+-- Sign up, login and the bulk import match emails without case: lower(email) = lower($1).
+-- Not UNIQUE, since an existing database may already hold one address in two cases.
+
+CREATE INDEX IF NOT EXISTS libraryusers_email_lower_index ON LibraryUsers (lower(Email));
@@ -0,0 +1,184 @@
+import json
+import time
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit, quote
+
+import http_api
+from main import DataBase
+from benchmarks.views import Workload, percentile
+
+# HTTP API benchmark
+# Runs keep-alive clients on threads against the JSON API for a fixed time and reports
+# requests per second and latency percentiles per endpoint. Catalog reads send If-None-Match
+# with the last ETag they saw, like a browser would.
+#
+#     python -m benchmarks.http_api --clients 32 --duration 20
+#     python -m benchmarks.http_api --no-cache                 (catalog reads always hit the database)
+#     python -m benchmarks.http_api --url http://127.0.0.1:8080 (a server that is already running)
+#
+# Without --url an APIServer is started in this process on a free port.
+
+# endpoint -> weight
+MIX = {
+    'catalog'        : 10,
+    'subjects'       : 10,
+    'subject_search' : 25,
+    'author_search'  : 25,
+    'recommendation' : 10,
+    'my_books'       : 15,
+    'login'          : 5,
+}
+
+# One keep-alive client
+class Client():
+    def __init__(self, host, port, workload, subjects, token):
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.workload = workload
+        self.subjects = subjects
+        self.token = token
+        self.etags = {}
+
+    def request(self, method, path, body=None, auth=False):
+        headers = {'Content-Type': 'application/json'}
+        if auth:
+            headers['Authorization'] = 'Bearer ' + self.token
+        if method == 'GET' and path in self.etags:
+            headers['If-None-Match'] = self.etags[path]
+        self.connection.request(method, path, body=json.dumps(body) if body != None else None, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        if response.getheader('ETag') != None:
+            self.etags[path] = response.getheader('ETag')
+        return response.status
+
+    def run(self, endpoint):
+        rng = self.workload.rng
+        if endpoint == 'catalog':
+            return self.request('GET', '/books')
+        if endpoint == 'subjects':
+            return self.request('GET', '/subjects')
+        if endpoint == 'subject_search':
+            return self.request('GET', '/search?subject=' + quote(rng.choice(self.subjects)))
+        if endpoint == 'author_search':
+            return self.request('GET', '/search?author=' + quote(rng.choice(self.workload.lastnames)))
+        if endpoint == 'recommendation':
+            return self.request('GET', '/recommendation?subject=' + quote(rng.choice(self.subjects)))
+        if endpoint == 'my_books':
+            return self.request('GET', '/me/books', auth=True)
+        email, password = self.workload.login()
+        return self.request('POST', '/login', {'email': email, 'password': password})
+
+def run_client(client, deadline, results):
+    names = list(MIX)
+    weights = [MIX[name] for name in names]
+    while time.monotonic() < deadline:
+        endpoint = client.workload.rng.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            status = client.run(endpoint)
+        except (OSError, http.client.HTTPException) as error:
+            status = type(error).__name__
+            client.connection.close()
+        results.append((endpoint, (time.perf_counter() - start) * 1000, status))
+    client.connection.close()
+
+def summarise(results, duration):
+    summary = {'endpoints': {}}
+    by_endpoint = {}
+    for endpoint, ms, status in results:
+        by_endpoint.setdefault(endpoint, []).append((ms, status))
+    for endpoint, calls in sorted(by_endpoint.items()):
+        latencies = [ms for ms, status in calls]
+        statuses = {}
+        for ms, status in calls:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary['endpoints'][endpoint] = {
+            'requests' : len(calls),
+            'per_sec'  : round(len(calls) / duration, 1),
+            'p50_ms'   : round(percentile(latencies, 50), 2),
+            'p95_ms'   : round(percentile(latencies, 95), 2),
+            'p99_ms'   : round(percentile(latencies, 99), 2),
+            'statuses' : statuses,
+        }
+    summary['total_per_sec'] = round(len(results) / duration, 1)
+    return summary
+
+def print_summary(summary):
+    print('\n{:<16} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+        'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'statuses'))
+    for endpoint, stats in summary['endpoints'].items():
+        print('{:<16} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+            endpoint, stats['requests'], stats['per_sec'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            ' '.join('{}x{}'.format(status, count) for status, count in sorted(stats['statuses'].items()))))
+    print('\nThroughput: {} requests/s'.format(summary['total_per_sec']))
+
+def run(args):
+    db = DataBase()
+    connection = db.get_patron_connection()
+    cursor = connection.cursor()
+    workload = Workload(cursor, args.password, args.seed)
+    cursor.execute("SELECT DISTINCT subject FROM Books")
+    subjects = [row[0] for row in cursor.fetchall()]
+    connection.rollback()
+    cursor.close()
+    db.release(connection)
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        if args.no_cache:
+            http_api.CATALOG_MAX_AGE = 0
+        server = http_api.APIServer(('127.0.0.1', 0), args.workers)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+    # Every client logs in once as its own patron for /me/books
+    clients = []
+    for i in range(args.clients):
+        session = workload.fork(args.seed + i)
+        client = Client(host, port, session, subjects, None)
+        email, password = session.login()
+        client.connection.request('POST', '/login', body=json.dumps({'email': email, 'password': password}))
+        response = client.connection.getresponse()
+        client.token = json.loads(response.read()).get('token', '')
+        clients.append(client)
+
+    results = []
+    deadline = time.monotonic() + args.duration
+    started = time.monotonic()
+    threads = [threading.Thread(target=run_client, args=(client, deadline, results)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    if server != None:
+        server.shutdown()
+        server.server_close()
+    summary = summarise(results, elapsed)
+    summary['clients'] = args.clients
+    summary['cache_max_age'] = 0 if args.no_cache else http_api.CATALOG_MAX_AGE
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure requests per second of the JSON HTTP API')
+    parser.add_argument('--clients', type=int, default=16, help='keep-alive client threads')
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--workers', type=int, default=32, help='requests using the database at once (in-process server)')
+    parser.add_argument('--url', help='benchmark this server instead of starting one')
+    parser.add_argument('--no-cache', action='store_true', help='disable the in-process catalog cache')
+    parser.add_argument('--password', default='password', help='password of the generated patrons')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the summary as JSON here')
+    args = parser.parse_args()
+
+    summary = run(args)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(summary, outfile, indent=2)
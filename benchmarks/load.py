@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+
+import psycopg2
+
+from main import DataBase, Views
+from benchmarks.scripted import ScriptedInput, scripted
+from benchmarks.views import Workload, operations, percentile, ADMIN_DSN
+
+# Concurrent load driver
+# Simulates many librarian desks and patron kiosks at once against the local database.
+# Sessions are spread over worker processes (one thread per session); each one replays a
+# weighted mix of menu actions with exponential think time, or paced to a target rate.
+# Reports throughput and latency percentiles per action, failures by SQLSTATE and constraint
+# (quantity_check, bw_pk, ...), and lock waits and deadlocks seen by the server.
+#
+#     python -m benchmarks.load --librarians 20 --patrons 180 --processes 8 --duration 60
+#     python -m benchmarks.load --patrons 100 --rate 500    (500 actions/s in total)
+#
+# Lock waits are sampled from pg_stat_activity and deadlocks read from pg_stat_database
+# through LIBRARY_ADMIN_DSN (default "dbname=bookstore", a local superuser).
+
+# action -> weight
+LIBRARIAN_MIX = {
+    'checkout'       : 40,
+    'return'         : 35,
+    'login'          : 10,
+    'overdue'        : 6,
+    'borrowed'       : 4,
+    'patron_list'    : 3,
+    'catalog'        : 2,
+}
+PATRON_MIX = {
+    'subject_search' : 30,
+    'author_search'  : 30,
+    'recommendation' : 15,
+    'my_books'       : 15,
+    'login'          : 10,
+}
+
+# SQLSTATEs worth calling out by name
+SQLSTATES = {
+    '23514' : 'check_violation',
+    '23505' : 'unique_violation',
+    '23503' : 'foreign_key_violation',
+    '40P01' : 'deadlock_detected',
+    '40001' : 'serialization_failure',
+    '55P03' : 'lock_not_available',
+    '57014' : 'query_canceled',
+}
+
+# Name of a failure, e.g. "check_violation (quantity_check)"
+def classify(error):
+    if not isinstance(error, psycopg2.Error) or error.pgcode == None:
+        return type(error).__name__
+    name = SQLSTATES.get(error.pgcode, error.pgcode)
+    constraint = error.diag.constraint_name if error.diag != None else None
+    if constraint != None:
+        name = '{} ({})'.format(name, constraint)
+    return name
+
+# One simulated session: runs actions until the deadline, appending (action, ms, outcome)
+def run_session(workload, mix, deadline, think_ms, interval, answers, results):
+    view = Views()
+    actions = operations(workload)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    next_start = time.monotonic()
+
+    while time.monotonic() < deadline:
+        # Target rate: start on a fixed schedule; otherwise wait the think time
+        if interval != None:
+            next_start = next_start + interval
+        else:
+            next_start = time.monotonic() + (workload.rng.expovariate(1000.0 / think_ms) if think_ms > 0 else 0)
+        delay = next_start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        action = workload.rng.choices(names, weights)[0]
+        method, answers_for, kwargs = actions[action]
+        answers.clear()
+        answers.feed(*answers_for())
+
+        start = time.perf_counter()
+        try:
+            getattr(view, method)(**kwargs)
+            outcome = 'ok'
+        except Exception as error:
+            outcome = classify(error)
+            DataBase().release_all()
+        results.append((action, (time.perf_counter() - start) * 1000, outcome))
+
+# Worker process: runs its share of the sessions on threads and sends back the results
+def run_worker(sessions, workload, duration, think_ms, interval, queue):
+    # One pooled connection per role per session is enough
+    DataBase.POOL_MAX = max(DataBase.POOL_MAX, len(sessions))
+    deadline = time.monotonic() + duration
+    answers = ScriptedInput()
+    results = []
+    threads = []
+    with scripted(answers):
+        for seed, kind in sessions:
+            mix = LIBRARIAN_MIX if kind == 'librarian' else PATRON_MIX
+            thread = threading.Thread(
+                target=run_session,
+                args=(workload.fork(seed), mix, deadline, think_ms, interval, answers, results)
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    queue.put(results)
+
+# Samples lock waits and reads the deadlock counter while the load runs
+class ServerMonitor(threading.Thread):
+    def __init__(self, period=0.1):
+        super().__init__(daemon=True)
+        self.period = period
+        self.stopping = threading.Event()
+        self.samples = 0
+        self.lock_wait_samples = 0
+        self.max_lock_waiters = 0
+        self.connection = psycopg2.connect(ADMIN_DSN)
+        self.connection.autocommit = True
+        self.deadlocks_start = self.deadlocks()
+
+    def deadlocks(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    def run(self):
+        cursor = self.connection.cursor()
+        while not self.stopping.wait(self.period):
+            cursor.execute("""SELECT COUNT(*) FROM pg_stat_activity
+                              WHERE datname = current_database() AND wait_event_type = 'Lock'""")
+            waiting = cursor.fetchone()[0]
+            self.samples += 1
+            if waiting > 0:
+                self.lock_wait_samples += 1
+            self.max_lock_waiters = max(self.max_lock_waiters, waiting)
+        cursor.close()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        summary = {
+            'samples'            : self.samples,
+            'lock_wait_fraction' : round(self.lock_wait_samples / max(self.samples, 1), 4),
+            'max_lock_waiters'   : self.max_lock_waiters,
+            'deadlocks'          : self.deadlocks() - self.deadlocks_start,
+        }
+        self.connection.close()
+        return summary
+
+def summarise(results, duration):
+    summary = {'actions': {}, 'failures': {}}
+    by_action = {}
+    for action, ms, outcome in results:
+        by_action.setdefault(action, []).append((ms, outcome))
+        if outcome != 'ok':
+            summary['failures'][outcome] = summary['failures'].get(outcome, 0) + 1
+
+    for action, calls in sorted(by_action.items()):
+        latencies = [ms for ms, outcome in calls]
+        summary['actions'][action] = {
+            'calls'       : len(calls),
+            'failed'      : sum(1 for ms, outcome in calls if outcome != 'ok'),
+            'per_sec'     : round(len(calls) / duration, 1),
+            'p50_ms'      : round(percentile(latencies, 50), 2),
+            'p95_ms'      : round(percentile(latencies, 95), 2),
+            'p99_ms'      : round(percentile(latencies, 99), 2),
+        }
+    summary['total_per_sec'] = round(len(results) / duration, 1)
+    return summary
+
+def print_summary(summary):
+    print('\n{:<16} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'action', 'calls', 'failed', 'per sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for action, stats in summary['actions'].items():
+        print('{:<16} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+            action, stats['calls'], stats['failed'], stats['per_sec'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    print('\nThroughput: {} actions/s'.format(summary['total_per_sec']))
+    print('Failures: ' + (', '.join('{} x{}'.format(name, count) for name, count in summary['failures'].items()) or 'none'))
+    server = summary['server']
+    print('Lock waits: {:.1%} of samples, at most {} sessions waiting. Deadlocks: {}'.format(
+        server['lock_wait_fraction'], server['max_lock_waiters'], server['deadlocks']))
+
+def run(args):
+    db = DataBase()
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+    workload = Workload(cursor, args.password, args.seed)
+    connection.rollback()
+    cursor.close()
+    db.release(connection)
+    for pool in DataBase.pools.values():
+        pool.closeall()
+    DataBase.pools.clear()
+
+    # Deal the sessions out to the processes
+    sessions = [(args.seed + i, 'librarian') for i in range(args.librarians)]
+    sessions += [(args.seed + args.librarians + i, 'patron') for i in range(args.patrons)]
+    random.Random(args.seed).shuffle(sessions)
+    shares = [sessions[i::args.processes] for i in range(args.processes)]
+
+    # Each session gets an equal share of the target rate
+    interval = len(sessions) / args.rate if args.rate else None
+
+    monitor = ServerMonitor()
+    monitor.start()
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(share, workload, args.duration, args.think_ms, interval, queue))
+               for share in shares if len(share) > 0]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    results = []
+    for worker in workers:
+        results.extend(queue.get())
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+
+    summary = summarise(results, elapsed)
+    summary['server'] = monitor.stop()
+    summary['sessions'] = {'librarians': args.librarians, 'patrons': args.patrons, 'processes': len(workers)}
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate many librarian and patron sessions at once')
+    parser.add_argument('--librarians', type=int, default=10)
+    parser.add_argument('--patrons', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--think-ms', type=float, default=500, help='mean think time between actions')
+    parser.add_argument('--rate', type=float, default=None, help='target actions per second in total (overrides think time)')
+    parser.add_argument('--password', default='password', help='password of the generated patrons')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the summary as JSON here')
+    args = parser.parse_args()
+
+    summary = run(args)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(summary, outfile, indent=2)
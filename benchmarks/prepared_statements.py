@@ -0,0 +1,99 @@
+import re
+import time
+import argparse
+
+from main import DataBase
+
+# Prepared statement benchmark
+# Runs each of DataBase.STATEMENTS as plain text (planned every time) and with EXECUTE
+# (planned once per connection) and prints the time per call for both.
+# Also prints the planning time EXPLAIN ANALYZE reports for the text version,
+# which is the cost the prepared version stops paying on every call.
+#
+#     python -m benchmarks.prepared_statements --iterations 2000
+
+# Turn the $1, $2 placeholders into %s for the plain text version
+def to_text(sql):
+    return re.sub(r'\$\d+', '%s', sql)
+
+# Pick real parameter values from the database for each statement
+# (every key of DataBase.STATEMENTS needs an entry; update this when a statement is added or renamed)
+def sample_params(cursor):
+    cursor.execute("SELECT isbn, subject FROM Books LIMIT 1")
+    isbn, subject = cursor.fetchone()
+    cursor.execute("SELECT email FROM LibraryUsers LIMIT 1")
+    email = cursor.fetchone()[0]
+    cursor.execute("SELECT lastname FROM Authors LIMIT 1")
+    lastname = cursor.fetchone()[0]
+    cursor.execute("SELECT email, isbn, branch FROM Borrow LIMIT 1")
+    borrow = cursor.fetchone() or (email, isbn, 'central')
+    cursor.execute("SELECT branch, isbn FROM Inventory LIMIT 1")
+    stock = cursor.fetchone() or ('central', isbn)
+    return {
+        'book_by_isbn'        : (isbn,),
+        'user_by_email'       : (email,),
+        'user_for_checkout'   : (email,),
+        'email_in_use'        : (email,),
+        'login_by_email'      : (email,),
+        'inventory_by_branch_isbn': tuple(stock),
+        'borrow_by_email_isbn': tuple(borrow),
+        'next_due_by_branch_isbn': (borrow[2], borrow[1]),
+        'subjects'            : (),
+        'catalog_version'     : (),
+        'search_by_subject'   : (subject,),
+        'search_by_author'    : (lastname,),
+        'recommend_by_subject': (subject,),
+    }
+
+# Planning time (ms) of one run of the text statement
+def planning_time(cursor, sql, params):
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+    return cursor.fetchone()[0][0]['Planning Time']
+
+def run(iterations):
+    db = DataBase()
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+    params = sample_params(cursor)
+
+    print('{:<26} {:>12} {:>12} {:>10} {:>12}'.format('statement', 'text us', 'prepared us', 'saved %', 'planning us'))
+    missing = [name for name in DataBase.STATEMENTS if name not in params]
+    if len(missing) > 0:
+        raise SystemExit('No sample parameters for ' + ', '.join(missing))
+
+    for name, sql in DataBase.STATEMENTS.items():
+        text = to_text(sql)
+        args = params[name]
+
+        # Plain text, planned on every call
+        start = time.perf_counter()
+        for i in range(iterations):
+            cursor.execute(text, args)
+            cursor.fetchall()
+        text_time = (time.perf_counter() - start) / iterations
+
+        # PREPARE once (done by the first call), then EXECUTE
+        db.execute_prepared(cursor, name, args)
+        cursor.fetchall()
+        start = time.perf_counter()
+        for i in range(iterations):
+            db.execute_prepared(cursor, name, args)
+            cursor.fetchall()
+        prepared_time = (time.perf_counter() - start) / iterations
+
+        plan = planning_time(cursor, text, args)
+        saved = (text_time - prepared_time) / text_time * 100
+        print('{:<26} {:>12.1f} {:>12.1f} {:>10.1f} {:>12.1f}'.format(
+            name, text_time * 1e6, prepared_time * 1e6, saved, plan * 1000))
+
+    connection.rollback()
+    cursor.close()
+    db.release(connection)
+
+    print('\nEXECUTE calls per statement: {}'.format(db.get_statement_calls()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare plain text and prepared hot statements')
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+    run(args.iterations)
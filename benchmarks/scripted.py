@@ -0,0 +1,61 @@
+import io
+import builtins
+import threading
+import contextlib
+from collections import deque
+
+import main
+
+# Scripted input for running the Views without a keyboard
+# The views read from input() and getpass(); inside scripted() both take their answers
+# from a queue instead, and stdout goes to a throwaway buffer.
+#
+#     answers = ScriptedInput()
+#     with scripted(answers):
+#         answers.feed('patron1@example.org', '9790000000016')
+#         Views().assign_book_view()
+
+# Each thread has its own queue, so simulated sessions can run side by side
+class ScriptedInput():
+    def __init__(self):
+        self.local = threading.local()
+
+    @property
+    def answers(self):
+        if not hasattr(self.local, 'answers'):
+            self.local.answers = deque()
+        return self.local.answers
+
+    # Queue answers for the next prompts, in order
+    def feed(self, *answers):
+        self.answers.extend(answers)
+
+    def clear(self):
+        self.answers.clear()
+
+    # Stands in for both input(prompt) and getpass(prompt=..., stream=...)
+    def __call__(self, prompt='', stream=None):
+        if len(self.answers) == 0:
+            raise RuntimeError('The view asked for more input than was scripted: ' + prompt)
+        return self.answers.popleft()
+
+# Sink for the view output (keeps nothing)
+class NullWriter(io.TextIOBase):
+    def write(self, text):
+        return len(text)
+
+@contextlib.contextmanager
+def scripted(answers, quiet=True):
+    saved_input = builtins.input
+    saved_getpass = main.getpass
+    builtins.input = answers
+    main.getpass = answers
+    try:
+        if quiet:
+            with contextlib.redirect_stdout(NullWriter()):
+                yield answers
+        else:
+            yield answers
+    finally:
+        builtins.input = saved_input
+        main.getpass = saved_getpass
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# Startup benchmark
+# Times `python cli.py --help` in fresh interpreters against a bare `python -c pass` and fails if
+# the CLI adds more than STARTUP_BUDGET_MS (median of --runs), or if starting it imports a module
+# that only the commands need (psycopg2, main, services...). Run it after touching cli.py's
+# imports:
+#
+#     python -m benchmarks.startup --runs 30
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, 'cli.py')
+
+# Most a no-op command may add to interpreter startup (ms)
+STARTUP_BUDGET_MS = float(os.environ.get('LIBRARY_STARTUP_BUDGET_MS', 50))
+
+# Modules the commands import when they run; none of them may load for --help
+HEAVY = ['psycopg2', 'sqlite3', 'main', 'services', 'instrumentation', 'metrics', 'render', 'export',
+         'bulk_import', 'credentials', 'changelog']
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def time_command(command, runs):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, cwd=ROOT)
+        times.append((time.perf_counter() - start) * 1000)
+    return median(times)
+
+# Top-level modules imported while running a command (from -X importtime)
+def imported_modules(command):
+    result = subprocess.run([command[0], '-X', 'importtime'] + command[1:], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, cwd=ROOT)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.rsplit('|', 1)[1].strip()
+            modules.add(name.split('.')[0])
+    return modules
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the CLI starts within its budget')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    command = [sys.executable, CLI, '--help']
+    baseline = time_command([sys.executable, '-c', 'pass'], args.runs)
+    cli = time_command(command, args.runs)
+    heavy = sorted(imported_modules(command) & set(HEAVY))
+
+    print('{:<22} {:>7.1f} ms'.format('python -c pass', baseline))
+    print('{:<22} {:>7.1f} ms  (+{:.1f} ms, budget +{:.0f} ms)'.format('python cli.py --help', cli, cli - baseline, STARTUP_BUDGET_MS))
+    failures = 0
+    if cli - baseline > STARTUP_BUDGET_MS:
+        print('FAIL startup over budget')
+        failures += 1
+    if len(heavy) > 0:
+        print('FAIL imported at startup: ' + ', '.join(heavy))
+        failures += 1
+    if failures > 0:
+        sys.exit(1)
+    print('Startup within budget')
@@ -0,0 +1,263 @@
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import datetime
+import resource
+import subprocess
+
+import psycopg2
+
+import datagen
+import instrumentation
+from main import DataBase, Views
+from benchmarks.scripted import ScriptedInput, scripted
+
+# Views benchmark
+# Runs every operation in Views with scripted input against the local database at one or more
+# data scales (loaded with datagen) and reports p50/p95/p99 latency, throughput, round trips
+# per call and peak RSS. Results are saved as JSON so runs can be compared across commits.
+#
+#     python -m benchmarks.views --scales small,medium
+#     python -m benchmarks.views --no-load                 (use whatever is loaded now)
+#     python -m benchmarks.views --compare old.json new.json
+#
+# Loading a scale empties Books, Authors, Borrow, Sessions and the patrons first, through
+# LIBRARY_ADMIN_DSN (default "dbname=bookstore", a local superuser).
+
+# name -> (books, loans)
+SCALES = {
+    'small'  : (1000, 5000),
+    'medium' : (100000, 500000),
+    'large'  : (1000000, 5000000),
+}
+
+ADMIN_DSN = os.environ.get('LIBRARY_ADMIN_DSN', 'dbname=bookstore')
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Reports print every row, so they get fewer iterations
+REPORTS = ['catalog', 'patron_list', 'overdue', 'borrowed']
+
+# Values the scripted answers are drawn from
+class Workload():
+    def __init__(self, cursor, password, seed=0):
+        self.rng = random.Random(seed)
+        self.password = password
+
+        cursor.execute("SELECT isbn FROM Inventory WHERE quantity > 0 LIMIT 5000")
+        self.available = [row[0] for row in cursor.fetchall()]
+        # Patrons with no loans, so a checkout never hits the Borrow primary key
+        cursor.execute("""SELECT email FROM LibraryUsers u WHERE isadmin = 'N'
+                          AND NOT EXISTS (SELECT 1 FROM Borrow b WHERE b.email = u.email) LIMIT 5000""")
+        self.patrons = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT email FROM Borrow LIMIT 100")
+        self.borrowers = [row[0] for row in cursor.fetchall()] or self.patrons
+        cursor.execute("SELECT DISTINCT lastname FROM Authors LIMIT 100")
+        self.lastnames = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT COUNT(DISTINCT subject) FROM Books")
+        self.subjects = cursor.fetchone()[0]
+
+        self.checked_out = []  # (email, isbn) checked out by the benchmark, returned by 'return'
+        self.used = set()
+
+    # Copy for one simulated session (own random stream and own checked out books)
+    def fork(self, seed):
+        session = copy.copy(self)
+        session.rng = random.Random(seed)
+        session.checked_out = []
+        session.used = set()
+        return session
+
+    def checkout(self):
+        for attempt in range(100):
+            pair = (self.rng.choice(self.patrons), self.rng.choice(self.available))
+            if pair not in self.used:
+                break
+        self.used.add(pair)
+        self.checked_out.append(pair)
+        return list(pair)
+
+    def checkin(self):
+        if len(self.checked_out) == 0:
+            return self.checkout()
+        pair = self.checked_out.pop()
+        self.used.discard(pair)
+        return list(pair)
+
+    def login(self):
+        return [self.rng.choice(self.patrons), self.password]
+
+    def subject(self):
+        return [str(self.rng.randint(1, max(self.subjects, 1)))]
+
+    def author(self):
+        return [self.rng.choice(self.lastnames)]
+
+# operation -> (Views method, function returning the scripted answers, extra keyword arguments)
+def operations(workload):
+    return {
+        'login'          : ('login_view',               workload.login,   {}),
+        'checkout'       : ('assign_book_view',         workload.checkout, {}),
+        'return'         : ('process_return_view',      workload.checkin, {}),
+        'subject_search' : ('search_by_subject_view',   workload.subject, {}),
+        'author_search'  : ('search_by_author_view',    workload.author,  {}),
+        'recommendation' : ('book_recommendation_view', workload.subject, {}),
+        'my_books'       : ('borrowed_books_view',      lambda: [],       {'email': workload.borrowers[0]}),
+        'catalog'        : ('book_catalog_view',        lambda: [],       {}),
+        'patron_list'    : ('registered_patrons_view',  lambda: [],       {}),
+        'overdue'        : ('overdue_books_view',       lambda: [],       {}),
+        'borrowed'       : ('all_borrowed_books_view',  lambda: [],       {}),
+    }
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+# Run one operation `iterations` times and summarise it
+def run_operation(method, answers_for, kwargs, iterations, answers):
+    view = Views()
+    latencies = []
+    errors = 0
+    instrumentation.reset_stats()
+
+    started = time.perf_counter()
+    for i in range(iterations):
+        answers.clear()
+        answers.feed(*answers_for())
+        start = time.perf_counter()
+        try:
+            getattr(view, method)(**kwargs)
+        except Exception:
+            errors = errors + 1
+            DataBase().release_all()
+        latencies.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+
+    stats = instrumentation.get_stats()['views'].get(method, {'round_trips': 0, 'calls': 1})
+    return {
+        'iterations'      : iterations,
+        'errors'          : errors,
+        'p50_ms'          : round(percentile(latencies, 50), 3),
+        'p95_ms'          : round(percentile(latencies, 95), 3),
+        'p99_ms'          : round(percentile(latencies, 99), 3),
+        'mean_ms'         : round(sum(latencies) / len(latencies), 3),
+        'ops_per_sec'     : round(iterations / elapsed, 1),
+        'round_trips'     : round(stats['round_trips'] / max(stats['calls'], 1), 2),
+        'peak_rss_kb'     : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+# Empty the tables and load a datagen dataset of the given size
+def load_scale(books, loans):
+    admin = psycopg2.connect(ADMIN_DSN)
+    cursor = admin.cursor()
+    cursor.execute("TRUNCATE Books, Authors, Borrow, Sessions CASCADE")
+    cursor.execute("DELETE FROM LibraryUsers WHERE isadmin = 'N'")
+    admin.commit()
+
+    generator = datagen.Generator(books, max(1, books // 2), max(1, loans // 5), loans)
+    datagen.copy_to_database(generator)
+
+    admin.autocommit = True
+    cursor.execute("ANALYZE")
+    cursor.close()
+    admin.close()
+
+def table_counts(cursor):
+    counts = {}
+    for table in ['Books', 'Authors', 'WrittenBy', 'Inventory', 'LibraryUsers', 'Borrow']:
+        cursor.execute("SELECT COUNT(*) FROM " + table)
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+def run_scale(args):
+    db = DataBase()
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+    workload = Workload(cursor, args.password, args.seed)
+    counts = table_counts(cursor)
+    connection.rollback()
+    cursor.close()
+    db.release(connection)
+
+    results = {'rows': counts, 'operations': {}}
+    answers = ScriptedInput()
+    with scripted(answers):
+        for name, (method, answers_for, kwargs) in operations(workload).items():
+            iterations = args.report_iterations if name in REPORTS else args.iterations
+            results['operations'][name] = run_operation(method, answers_for, kwargs, iterations, answers)
+            sys.stderr.write('  {:<16} p50 {:>9.2f} ms\n'.format(name, results['operations'][name]['p50_ms']))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def print_results(results):
+    for scale, result in results['scales'].items():
+        print('\nScale: {} ({} books, {} loans)'.format(scale, result['rows']['Books'], result['rows']['Borrow']))
+        print('{:<16} {:>9} {:>9} {:>9} {:>10} {:>7} {:>7}'.format(
+            'operation', 'p50 ms', 'p95 ms', 'p99 ms', 'ops/s', 'trips', 'errors'))
+        for name, op in result['operations'].items():
+            print('{:<16} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f} {:>7} {:>7}'.format(
+                name, op['p50_ms'], op['p95_ms'], op['p99_ms'], op['ops_per_sec'], op['round_trips'], op['errors']))
+        print('peak RSS: {} KB'.format(max(op['peak_rss_kb'] for op in result['operations'].values())))
+
+# Print the p50 change of every operation between two result files
+def compare(old_path, new_path):
+    with open(old_path) as oldfile, open(new_path) as newfile:
+        old, new = json.load(oldfile), json.load(newfile)
+    print('{} -> {}'.format(old['commit'], new['commit']))
+    for scale, result in new['scales'].items():
+        if scale not in old['scales']:
+            continue
+        print('\nScale: ' + scale)
+        print('{:<16} {:>10} {:>10} {:>8} {:>7} {:>7}'.format('operation', 'old p50', 'new p50', 'change', 'trips', 'trips'))
+        for name, op in result['operations'].items():
+            before = old['scales'][scale]['operations'].get(name)
+            if before == None:
+                continue
+            change = (op['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0.0
+            print('{:<16} {:>10.2f} {:>10.2f} {:>7.1f}% {:>7} {:>7}'.format(
+                name, before['p50_ms'], op['p50_ms'], change, before['round_trips'], op['round_trips']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark every Views operation')
+    parser.add_argument('--scales', default='small', help='comma separated: ' + ','.join(SCALES))
+    parser.add_argument('--no-load', action='store_true', help='benchmark the data already loaded')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--report-iterations', type=int, default=5)
+    parser.add_argument('--password', default='password', help='password of the generated patrons')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<commit>-<time>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    results = {'commit': git_commit(), 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'scales': {}}
+    if args.no_load:
+        results['scales']['current'] = run_scale(args)
+    else:
+        for scale in args.scales.split(','):
+            books, loans = SCALES[scale]
+            sys.stderr.write('Loading {} ({} books, {} loans)\n'.format(scale, books, loans))
+            load_scale(books, loans)
+            results['scales'][scale] = run_scale(args)
+
+    print_results(results)
+    output = args.output or os.path.join(RESULTS_DIR, '{}-{}.json'.format(results['commit'], results['timestamp'].replace(':', '')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    print('\nSaved ' + output)
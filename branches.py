@@ -0,0 +1,152 @@
+import re
+import argparse
+
+from main import DataBase
+
+# Branches
+# Each branch keeps its own stock (Inventory rows keyed by branch and ISBN) and its own loans.
+# On Postgres Inventory and Borrow are partitioned by branch, so each branch's rows live in their
+# own partitions (with their own indexes) and a checkout at one branch never locks or waits on
+# another branch's rows. A branch without partitions yet lands in the DEFAULT ones.
+#
+#     python branches.py list
+#     python branches.py add north "North Branch" --db "dbname=bookstore user=postgres"
+#     python branches.py migrate --db "dbname=bookstore user=postgres"
+#
+# add and migrate create tables, so on Postgres --db must connect as the tables' owner.
+# migrate turns a database from before branches (one Inventory row per ISBN, Borrow keyed by
+# email and ISBN) into the branch-aware schema, with every existing row at 'central'.
+
+# Branch ids are used in partition names
+BRANCH_ID = re.compile(r'^[a-z][a-z0-9_]{0,39}$')
+
+# Tables that became branch-aware
+BRANCH_TABLES = ['Inventory', 'Borrow']
+
+def connect(spec):
+    if spec == None:
+        return DataBase().get_librarian_connection()
+    import sync
+    return sync.connect(spec)
+
+def list_branches(connection):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT b.branchid, b.name, COUNT(i.isbn), COALESCE(SUM(i.quantity), 0)
+                      FROM Branches b LEFT JOIN Inventory i ON i.branch = b.branchid
+                      GROUP BY b.branchid, b.name ORDER BY b.branchid""")
+    rows = cursor.fetchall()
+    cursor.close()
+    connection.rollback()
+    return rows
+
+def add_branch(connection, branch, name):
+    if not BRANCH_ID.match(branch):
+        raise ValueError('Branch ids are lower case letters, digits and _: ' + branch)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("INSERT INTO Branches(branchid,name) VALUES (%s, %s) ON CONFLICT DO NOTHING", (branch, name))
+        if connection.backend == 'postgres':
+            for table in BRANCH_TABLES:
+                # Rows already in the DEFAULT partition for this branch have to move into the new one
+                cursor.execute("CREATE TABLE {0}_{1} (LIKE {0} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(table, branch))
+                cursor.execute("WITH moved AS (DELETE FROM {0}_other WHERE branch = %s RETURNING *) "
+                               "INSERT INTO {0}_{1} SELECT * FROM moved".format(table, branch), (branch,))
+                cursor.execute("ALTER TABLE {0} ATTACH PARTITION {0}_{1} FOR VALUES IN ('{1}')".format(table, branch))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# The schema statements that create Branches, Inventory and Borrow (and their partitions and indexes)
+def branch_statements(connection):
+    if connection.backend == 'sqlite':
+        import sqlite_backend
+        statements = sqlite_backend.schema()
+    else:
+        from temp_postgres import schema_statements, SCHEMA_FILE
+        statements = schema_statements(SCHEMA_FILE)
+    return [statement for statement in statements
+            if re.match(r'(CREATE|INSERT)\b', statement, re.I)
+            and re.search(r'\b(Branches|Inventory|Borrow)\b', statement, re.I)]
+
+# The schema-wide grants, for the new partitions (the grants on single tables are left to the
+# migrations that add those tables)
+def grant_statements():
+    from temp_postgres import schema_statements, SCHEMA_FILE
+    return [statement for statement in schema_statements(SCHEMA_FILE)
+            if statement.upper().startswith('GRANT') and 'ALL TABLES' in statement.upper()]
+
+def inventory_columns(cursor):
+    cursor.execute("SELECT * FROM Inventory WHERE 1 = 0")
+    return [col[0] for col in cursor.description]
+
+# Rebuild Inventory and Borrow with a branch column (or just add Inventory.Copies to a database
+# that has branches already), in one transaction; returns False if already done
+def migrate(connection):
+    cursor = connection.cursor()
+    try:
+        if connection.backend == 'sqlite':
+            cursor.execute("BEGIN IMMEDIATE")
+        columns = inventory_columns(cursor)
+        if 'branch' in columns and 'copies' in columns:
+            connection.rollback()
+            return False
+        if 'branch' in columns:
+            cursor.execute("ALTER TABLE Inventory ADD COLUMN Copies INTEGER")
+            connection.commit()
+            return True
+
+        for table in BRANCH_TABLES:
+            cursor.execute("ALTER TABLE {0} RENAME TO {0}_unbranched".format(table))
+        if connection.backend == 'postgres':
+            cursor.execute("ALTER INDEX bw_pk RENAME TO bw_pk_unbranched")
+
+        statements = branch_statements(connection)
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute("""INSERT INTO Inventory(branch,isbn,quantity)
+                          SELECT 'central',isbn,quantity FROM Inventory_unbranched""")
+        cursor.execute("""INSERT INTO Borrow(branch,isbn,email,borrowdate,duedate)
+                          SELECT 'central',isbn,email,borrowdate,duedate FROM Borrow_unbranched""")
+        for table in BRANCH_TABLES:
+            cursor.execute("DROP TABLE {}_unbranched".format(table))
+
+        if connection.backend == 'sqlite':
+            # The old tables' indexes had the names the new ones need
+            for statement in statements:
+                cursor.execute(statement)
+        else:
+            for statement in grant_statements():
+                cursor.execute(statement)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return True
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', help='sqlite:PATH or a Postgres DSN (default: the librarian connection)')
+    parser = argparse.ArgumentParser(description='List and add library branches')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', parents=[common], help='branches with their titles and copies on the shelf')
+    add = commands.add_parser('add', parents=[common], help='add a branch (with its own partitions on Postgres)')
+    add.add_argument('branch', help='branch id (lower case, as in LIBRARY_BRANCH)')
+    add.add_argument('name', help='display name')
+    commands.add_parser('migrate', parents=[common], help='make Inventory and Borrow branch-aware (existing rows go to central)')
+    args = parser.parse_args()
+
+    connection = connect(args.db)
+    if args.command == 'list':
+        for branch, name, titles, copies in list_branches(connection):
+            print('{:<20} {:<30} {:>8} titles {:>10} copies'.format(branch, name or '', titles, copies))
+    elif args.command == 'add':
+        add_branch(connection, args.branch, args.name)
+        print('Added branch {}'.format(args.branch))
+    elif args.command == 'migrate':
+        done = migrate(connection)
+        print('Migrated Inventory and Borrow to branches' if done else 'Already branch-aware')
@@ -0,0 +1,189 @@
+import csv
+import io
+import datetime
+import argparse
+
+import changelog
+import credentials
+from main import DataBase
+from services import FORMAT, check_form_fields, valid_email, valid_date
+
+# Bulk patron import
+# Streams a CSV of patrons (firstname,lastname,email,dob,password) in chunks,
+# applies the same rules as validate_form to each chunk, drops duplicates inside the file,
+# finds the emails already in LibraryUsers with one anti-join per chunk (ignoring case, like sign up),
+# hashes the passwords in the credentials process pool and COPYs the new patrons in.
+# Each new patron is also written to the change log (as sign up does), in the same transaction,
+# so branches learn about them.
+# Every rejected row is written to the rejects file with the reason.
+
+# Columns expected in the import file
+COLUMNS = ['firstname', 'lastname', 'email', 'dob', 'password']
+
+# Rows per chunk (one staging COPY, one anti-join and one COPY into LibraryUsers per chunk)
+CHUNK_SIZE = 5000
+
+# Read the import file in chunks of rows (list of dicts) so the whole file is never in memory
+def read_chunks(infile, chunk_size):
+    reader = csv.DictReader(infile)
+    missing = [col for col in COLUMNS if col not in (reader.fieldnames or [])]
+    if len(missing) > 0:
+        raise ValueError('Import file is missing columns: ' + ', '.join(missing))
+
+    chunk = []
+    for line, row in enumerate(reader, start=2):
+        # Same cleaning as get_clean_input (remove ' from input)
+        row = {col: (row[col] or '').strip().replace('\'', '') for col in COLUMNS}
+        row['line'] = line
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+# Apply the validate_form rules to a whole chunk, one column at a time
+# Each distinct email/dob value is only checked once (a district file repeats birth dates a lot)
+# Returns (valid rows, [(row, reason)])
+def validate_chunk(chunk):
+    email_ok = {}
+    dob_ok = {}
+    for row in chunk:
+        if row['email'] not in email_ok:
+            email_ok[row['email']] = valid_email(row['email'])
+        if row['dob'] not in dob_ok:
+            dob_ok[row['dob']] = valid_date(row['dob'])
+
+    valid = []
+    rejects = []
+    for row in chunk:
+        # All the rules passed, nothing more to check for this row
+        if email_ok[row['email']] and dob_ok[row['dob']] and len(row['firstname']) > 0 and len(row['lastname']) > 0 and len(row['password']) > 0:
+            valid.append(row)
+            continue
+
+        # Get the same message validate_form would have printed
+        formdata = dict(row)
+        formdata['conf_pass'] = row['password']
+        rejects.append((row, check_form_fields(formdata)))
+    return valid, rejects
+
+# Drop rows whose email was already seen earlier in the file
+def dedupe_chunk(chunk, seen):
+    unique = []
+    rejects = []
+    for row in chunk:
+        key = row['email'].lower()
+        if key in seen:
+            rejects.append((row, 'Duplicate email in import file'))
+            continue
+        seen.add(key)
+        unique.append(row)
+    return unique, rejects
+
+# COPY the chunk's emails into the staging table and return the ones that are not in LibraryUsers
+def new_emails(cursor, chunk):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in chunk:
+        writer.writerow([row['email']])
+    buffer.seek(0)
+
+    cursor.execute("TRUNCATE import_emails")
+    cursor.copy_expert("COPY import_emails(email) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    # One anti-join against LibraryUsers for the whole chunk
+    cursor.execute("""SELECT i.email FROM import_emails i
+                      WHERE NOT EXISTS (SELECT 1 FROM LibraryUsers u WHERE lower(u.email) = lower(i.email))""")
+    return set(item[0] for item in cursor.fetchall())
+
+# COPY the new patrons (with hashed passwords) into LibraryUsers and log one change per patron
+def copy_patrons(cursor, chunk, hashes):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    changes = []
+    for row, password in zip(chunk, hashes):
+        dob = datetime.datetime.strptime(row['dob'], FORMAT).date()
+        writer.writerow([row['email'], password, row['firstname'], row['lastname'], dob.isoformat(), 'N'])
+        patron = {
+            'email'     : row['email'],
+            'firstname' : row['firstname'],
+            'lastname'  : row['lastname'],
+            'dob'       : dob,
+            'isadmin'   : 'N',
+            'password'  : password,
+        }
+        changes.append(('LibraryUsers', 'I', changelog.row_key(row['email']), patron))
+    buffer.seek(0)
+    cursor.copy_expert(
+        "COPY LibraryUsers(email,password,firstname,lastname,dob,isadmin) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
+    changelog.record(cursor, changes)
+
+# Run the whole import
+# Returns (number imported, number rejected)
+def import_patrons(infile, rejects_file, chunk_size=CHUNK_SIZE):
+    # Get DB connection class
+    db = DataBase()
+
+    # Get the DB cursor
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+
+    # Staging table for the anti-join (lives as long as the pooled session)
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_emails(email VARCHAR(100))")
+
+    rejects_writer = csv.writer(rejects_file)
+    rejects_writer.writerow(['line'] + COLUMNS[:-1] + ['reason'])
+
+    imported = 0
+    rejected = 0
+    seen = set()
+    try:
+        for chunk in read_chunks(infile, chunk_size):
+            valid, invalid = validate_chunk(chunk)
+            unique, duplicates = dedupe_chunk(valid, seen)
+
+            rows = []
+            existing = []
+            if len(unique) > 0:
+                emails = new_emails(cursor, unique)
+                for row in unique:
+                    if row['email'] in emails:
+                        rows.append(row)
+                    else:
+                        existing.append((row, 'Sorry, that email has already been used'))
+
+            # Hash the passwords in parallel and COPY the chunk in
+            if len(rows) > 0:
+                hashes = credentials.hash_passwords([row['password'] for row in rows])
+                copy_patrons(cursor, rows, hashes)
+                imported = imported + len(rows)
+
+            # Write the rejects (never the password)
+            for row, reason in invalid + duplicates + existing:
+                rejects_writer.writerow([row['line']] + [row[col] for col in COLUMNS[:-1]] + [reason])
+                rejected = rejected + 1
+
+        # Nothing is visible until the whole file has gone in
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        db.release(connection)
+
+    return imported, rejected
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import patrons from a CSV file')
+    parser.add_argument('csvfile', help='CSV with columns ' + ','.join(COLUMNS))
+    parser.add_argument('--rejects', default='rejects.csv', help='file to write rejected rows to')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    with open(args.csvfile, newline='') as infile, open(args.rejects, 'w', newline='') as rejects_file:
+        imported, rejected = import_patrons(infile, rejects_file, args.chunk_size)
+    print('Imported {} patrons. {} rows rejected (see {}).'.format(imported, rejected, args.rejects))
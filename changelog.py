@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import datetime
+
+# Change log
+# Every change the library operations make to Borrow, Inventory and LibraryUsers is also written to
+# ChangeLog, in the same transaction, with a sequence number. sync.py ships the entries after the
+# last one a peer acknowledged.
+#
+# On Postgres the numbers come from the changelog_seq sequence, which takes no lock, so desks and
+# branches never wait on each other for one. A transaction can then commit seq N+1 before seq N;
+# read() only returns entries up to a number whose writers have all finished (see settled_seq).
+# record() has to come after one of the transaction's own writes (best as the last statement).
+# SQLite has one writer at a time and keeps counting in the ChangeSeq row.
+#
+# Entries (TableName, Op, RowKey, Data):
+#     Borrow        I  email|isbn|branch  {"isbn", "email", "branch", "borrowdate", "duedate"}
+#     Borrow        D  email|isbn|branch  {"isbn", "email", "branch"}
+#     Inventory     U  branch|isbn   {"isbn", "branch", "delta", "copies"[, "set_copies"]}
+#                                    (quantity and copies changes, not the new values; "copies" may be missing for 0;
+#                                    reconcile repairs also carry the new copies count as "set_copies")
+#     LibraryUsers  I  email         the whole row (password hash included, so branches can log people in)
+#     LibraryUsers  U  email         {"email", "password"}
+#
+# Entries written before branches existed have no "branch" (and Borrow keys are email|isbn); they
+# are for 'central'.
+
+# Name of this database in the sync network ('central' or the branch name)
+ORIGIN = os.environ.get('LIBRARY_BRANCH', 'central')
+
+# How long read() waits for the writers of already numbered entries to finish (seconds)
+SETTLE_TIMEOUT = 5.0
+
+def to_json(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+def encode(data):
+    return json.dumps(data, default=to_json, separators=(',', ':'))
+
+def row_key(*parts):
+    return '|'.join(str(part).strip() for part in parts)
+
+# Append changes [(table, op, key, data)] in one statement (two on SQLite)
+# The caller commits; origin is given when applying changes that came from another database
+def record(cursor, changes, origin=None):
+    origin = origin or ORIGIN
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(changes))
+    params = []
+    for number, (table, op, key, data) in enumerate(changes, 1):
+        params += [number, origin, table, op, key, encode(data)]
+
+    if cursor.connection.backend == 'sqlite':
+        # SQLite has one writer at a time, so the numbers are in commit order already
+        cursor.execute("UPDATE ChangeSeq SET seq = seq + %s WHERE id = 1", (len(changes),))
+        cursor.execute("""INSERT INTO ChangeLog(seq,origin,tablename,op,rowkey,data)
+                          SELECT c.seq - {} + v.column1, v.column2, v.column3, v.column4, v.column5, v.column6
+                          FROM (SELECT seq FROM ChangeSeq WHERE id = 1) AS c, (VALUES {}) AS v""".format(len(changes), values), params)
+    else:
+        # OFFSET 0 keeps the ordered subquery from being flattened, so the numbers follow the changes
+        cursor.execute("""INSERT INTO ChangeLog(seq,origin,tablename,op,rowkey,data)
+                          SELECT nextval('changelog_seq'), v.column2, v.column3, v.column4, v.column5, v.column6
+                          FROM (SELECT * FROM (VALUES {}) AS v ORDER BY v.column1 OFFSET 0) AS v""".format(values), params)
+
+# The highest seq that read() may return: every entry numbered up to it is committed or rolled back,
+# so no entry below it can show up later. None if some writer did not finish within `timeout`.
+def settled_seq(cursor, timeout=SETTLE_TIMEOUT):
+    if cursor.connection.backend == 'sqlite':
+        cursor.execute("SELECT seq FROM ChangeSeq WHERE id = 1")
+        return cursor.fetchone()[0]
+
+    cursor.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM changelog_seq")
+    drawn = cursor.fetchone()[0]
+    # Writers draw their numbers after they have a transaction id, so the ones still holding numbers
+    # up to `drawn` are all in this snapshot's running list
+    cursor.execute("SELECT txid_current_snapshot()::text")
+    snapshot = cursor.fetchone()[0]
+    deadline = time.monotonic() + timeout
+    while True:
+        cursor.execute("""SELECT COUNT(*) FROM txid_snapshot_xip(%s::txid_snapshot) AS x
+                          WHERE txid_status(x) = 'in progress'""", (snapshot,))
+        if cursor.fetchone()[0] == 0:
+            return drawn
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(0.005)
+
+# Entries after seq `after`, oldest first: [(seq, origin, table, op, key, data)]
+# Entries still being written are left for the next call
+def read(cursor, after, limit):
+    upto = settled_seq(cursor)
+    if upto == None:
+        return []
+    cursor.execute("""SELECT seq,origin,tablename,op,rowkey,data FROM ChangeLog
+                      WHERE seq > %s AND seq <= %s ORDER BY seq LIMIT %s""", (after, upto, limit))
+    return [(seq, origin.strip(), table.strip(), op.strip(), key, json.loads(data))
+            for seq, origin, table, op, key, data in cursor.fetchall()]
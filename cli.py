@@ -0,0 +1,147 @@
+import sys
+import argparse
+
+# Command line
+# The desk operations without the menus, for cron jobs and batch pipelines:
+#
+#     python cli.py checkout patron@example.com 9780679745259 --branch north
+#     python cli.py return patron@example.com 9780679745259
+#     python cli.py search --author Bloom --format csv
+#     python cli.py export overdue overdue.csv.gz
+#     python cli.py load patrons.csv --rejects rejects.csv
+#     python cli.py menu --profile profiles/              (the interactive menus, as python main.py)
+#
+# Only argparse is imported up front. Each command imports what it needs when it runs (psycopg2
+# comes in with main) and opens a connection only if it uses the database, so --help and usage
+# errors return at interpreter speed; python -m benchmarks.startup checks that stays so.
+# A refused operation prints its message to stderr and exits with status 1.
+
+# Exit status for an operation the library refused (argparse uses 2 for usage errors)
+REFUSED = 1
+
+# Run operation(db, cursor) on a pooled connection of a role and give the connection back
+def with_connection(role, operation, read_only=False):
+    from main import DataBase
+
+    db = DataBase()
+    connection = db.get_read_connection(role) if read_only else db.checkout_connection(role)
+    try:
+        cursor = connection.cursor()
+        result = operation(db, cursor)
+        cursor.close()
+        return result
+    finally:
+        db.release_all()
+
+def checkout_command(args):
+    import services
+
+    loan = with_connection('librarian', lambda db, cursor: services.checkout(db, cursor, args.email, args.isbn, branch=args.branch))
+    print('Checked out {} ({}) to {} at {}, due {}'.format(
+        loan['title'], loan['isbn'], loan['email'], loan['branch'], loan['duedate'].strftime(services.FORMAT)))
+
+def return_command(args):
+    import services
+
+    result = with_connection('librarian', lambda db, cursor: services.process_return(db, cursor, args.email, args.isbn, branch=args.branch))
+    charge = ', {} days overdue, charge ${:.2f}'.format(result['days_overdue'], result['charge']) if result['charge'] > 0 else ''
+    print('Returned {} ({}) from {} at {}{}'.format(result['title'], result['isbn'], result['email'], result['branch'], charge))
+
+def search_command(args):
+    import services
+    from render import Renderer, Column
+
+    def search(db, cursor):
+        if args.subject != None:
+            books = services.search_by_subject(db, cursor, args.subject)
+            columns = [Column('Title: ', 'title'), Column('Author(s): ', 'authors'), Column('ISBN: ', 'isbn')]
+        else:
+            books = services.search_by_author(db, cursor, args.author)
+            columns = [Column('Title: ',          'title'),
+                       Column('Subject: ',        'subject'),
+                       Column('Date Published: ', 'datepublished', 'date'),
+                       Column('Author: ',         lambda book: book['firstname'] + ' ' + book['lastname']),
+                       Column('ISBN: ',           'isbn')]
+        Renderer(args.format).render('Search Results: ', books, columns)
+
+    with_connection('patron', search, read_only=True)
+
+def export_command(args):
+    import export
+
+    if args.report not in export.REPORTS:
+        raise SystemExit('Unknown report {} (choose from {})'.format(args.report, ', '.join(sorted(export.REPORTS))))
+    rows, size = export.export(args.report, args.output, args.format, args.gzip)
+    sys.stderr.write('Exported {} rows ({:.1f} MB)\n'.format(rows, size / 1e6))
+
+def load_command(args):
+    import bulk_import
+
+    with open(args.csvfile, newline='') as infile, open(args.rejects, 'w', newline='') as rejects_file:
+        imported, rejected = bulk_import.import_patrons(infile, rejects_file, args.chunk_size or bulk_import.CHUNK_SIZE)
+    print('Imported {} patrons. {} rows rejected (see {}).'.format(imported, rejected, args.rejects))
+
+def menu_command(args):
+    import main
+    import metrics
+
+    metrics.serve_from_environment()
+    main.MainLoop(args.profile)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Library desk operations from the command line')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+    checkout = commands.add_parser('checkout', help='check a book out to a patron')
+    checkout.add_argument('email')
+    checkout.add_argument('isbn')
+    checkout.add_argument('--branch', help='branch the copy leaves from (default LIBRARY_BRANCH)')
+    checkout.set_defaults(run=checkout_command)
+
+    checkin = commands.add_parser('return', help='take a book back')
+    checkin.add_argument('email')
+    checkin.add_argument('isbn')
+    checkin.add_argument('--branch', help='branch the copy is returned to (default LIBRARY_BRANCH)')
+    checkin.set_defaults(run=return_command)
+
+    search = commands.add_parser('search', help='search the catalog by subject or by author')
+    terms = search.add_mutually_exclusive_group(required=True)
+    terms.add_argument('--subject')
+    terms.add_argument('--author', help="author's last name")
+    search.add_argument('--format', choices=['text', 'csv', 'json'], help='default: LIBRARY_OUTPUT_FORMAT, else text')
+    search.set_defaults(run=search_command)
+
+    report = commands.add_parser('export', help='write a librarian report to a file (see export.py)')
+    report.add_argument('report', help='overdue, borrowed or catalog')
+    report.add_argument('output', help='file to write ("-" for stdout); a .gz name is gzipped')
+    report.add_argument('--format', choices=['csv', 'jsonl'], help='default: from the file name, else csv')
+    report.add_argument('--gzip', action='store_true', default=None, help='gzip the output whatever its name')
+    report.set_defaults(run=export_command)
+
+    load = commands.add_parser('load', help='bulk import patrons from a CSV file (see bulk_import.py)')
+    load.add_argument('csvfile')
+    load.add_argument('--rejects', default='rejects.csv', help='file to write rejected rows to')
+    load.add_argument('--chunk-size', type=int, help='rows per COPY (default bulk_import.CHUNK_SIZE)')
+    load.set_defaults(run=load_command)
+
+    menu = commands.add_parser('menu', help='the interactive menus')
+    menu.add_argument('--profile', metavar='DIR', help='profile each menu action into DIR')
+    menu.set_defaults(run=menu_command)
+    return parser
+
+def run(argv=None):
+    args = build_parser().parse_args(argv)
+    import services
+    try:
+        args.run(args)
+    except services.LibraryError as error:
+        sys.stderr.write(error.message + '\n')
+        return REFUSED
+    except Exception as error:
+        # Database errors too (a loan the patron already has, a lost connection)
+        sys.stderr.write('Sorry, something went wrong: {}\n'.format(error))
+        return REFUSED
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,106 @@
+import os
+import hmac
+import base64
+import hashlib
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Password hashing
+# New passwords are stored as salted scrypt hashes in the LibraryUsers password column:
+#     $scrypt$<log2 N>$<r>$<p>$<salt>$<hash>
+# Old accounts still hold the unsalted sha3_512 hex digest (128 characters). Those still verify,
+# and needs_rehash() tells the login view to store a scrypt hash the next time the user logs in.
+# The hashing itself runs in a process pool so it uses every core and never holds up other sessions.
+
+# Cost parameter: N = 2 ** KDF_COST (each +1 doubles the time and memory of one hash)
+KDF_COST    = int(os.environ.get('LIBRARY_KDF_COST', 14))
+KDF_BLOCK   = 8     # scrypt r
+KDF_PARALLEL = 1    # scrypt p
+SALT_BYTES  = 16
+HASH_BYTES  = 32
+
+# Number of hashing processes (default: one per core)
+KDF_WORKERS = int(os.environ.get('LIBRARY_KDF_WORKERS', 0)) or None
+
+PREFIX = '$scrypt$'
+
+# Base64 without padding so the stored value stays short (fits CHAR(128))
+def b64encode(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+def b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+# Run scrypt with the given parameters (runs in the worker processes)
+def scrypt(password, salt, cost, block, parallel):
+    n = 2 ** cost
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=block, p=parallel,
+        maxmem=2 * 128 * block * n + 1024 * 1024, dklen=HASH_BYTES
+    )
+
+# Hash a password into the stored format (runs in the worker processes)
+def kdf_hash(password, cost=KDF_COST):
+    salt = os.urandom(SALT_BYTES)
+    digest = scrypt(password, salt, cost, KDF_BLOCK, KDF_PARALLEL)
+    return '{}{}${}${}${}${}'.format(PREFIX, cost, KDF_BLOCK, KDF_PARALLEL, b64encode(salt), b64encode(digest))
+
+# Check a password against a stored value of either format (runs in the worker processes)
+def kdf_verify(password, stored):
+    stored = stored.strip() # CHAR(128) comes back padded with spaces
+    if stored.startswith(PREFIX):
+        try:
+            cost, block, parallel, salt, digest = stored[len(PREFIX):].split('$')
+            expected = b64decode(digest)
+            actual = scrypt(password, b64decode(salt), int(cost), int(block), int(parallel))
+        except ValueError:
+            return False
+        return hmac.compare_digest(actual, expected)
+
+    # Legacy unsalted sha3_512 hex digest
+    legacy = hashlib.sha3_512(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy, stored)
+
+# True if the stored value is not a scrypt hash at the configured cost
+def needs_rehash(stored):
+    stored = stored.strip()
+    if not stored.startswith(PREFIX):
+        return True
+    fields = stored[len(PREFIX):].split('$')
+    return fields[:3] != [str(KDF_COST), str(KDF_BLOCK), str(KDF_PARALLEL)]
+
+# The process pool is created on first use and shared by everything in this process
+# (the lock keeps threads logging in at the same moment from each starting one)
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    global pool
+    if pool == None:
+        with pool_lock:
+            if pool == None:
+                executor = ProcessPoolExecutor(max_workers=KDF_WORKERS)
+                atexit.register(executor.shutdown)
+                pool = executor
+    return pool
+
+# Hash one password (blocks only the caller)
+def hash_password(password):
+    return get_pool().submit(kdf_hash, password, KDF_COST).result()
+
+# Hash many passwords across every core (used by the bulk import)
+def hash_passwords(passwords):
+    return list(get_pool().map(kdf_hash, passwords, [KDF_COST] * len(passwords), chunksize=64))
+
+# Verify one password (blocks only the caller)
+def verify_password(password, stored):
+    return get_pool().submit(kdf_verify, password, stored).result()
+
+# Non-blocking versions for callers that serve many sessions at once
+# (they return a concurrent.futures.Future)
+def submit_hash(password):
+    return get_pool().submit(kdf_hash, password, KDF_COST)
+
+def submit_verify(password, stored):
+    return get_pool().submit(kdf_verify, password, stored)
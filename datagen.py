@@ -0,0 +1,295 @@
+import os
+import io
+import csv
+import math
+import array
+import random
+import argparse
+import datetime
+
+import credentials
+
+# Synthetic dataset generator
+# Streams Books, Authors, WrittenBy, LibraryUsers, Borrow and Inventory rows that fit the
+# schema in LibraryCreateQueries.txt, either straight into the database with COPY or into CSV files.
+#   - ISBNs are valid ISBN-13s (CHAR(13)) with a 979 prefix so they never clash with Tables/Books.csv
+#   - AuthorIDs are CHAR(9) starting at 100000000 so they never clash with Tables/Authors.csv
+#   - book popularity is Zipf-like (a few titles get most of the loans), and so is author output
+#   - 30% of books have 2 or 3 authors
+#   - OVERDUE of the loans are past their due date
+#   - every Borrow row points at an existing book and patron, no patron borrows the same book twice,
+#     and Inventory.quantity = Inventory.copies - open loans (never below 0)
+#   - every title keeps a copy on the shelf, except the few bestsellers at MAX_COPIES
+# Rows are generated one at a time from a seeded random generator; the only thing kept in memory is
+# a loan counter per book (2 bytes each, 20MB for 10M books).
+#
+#     python datagen.py --books 1000000 --loans 5000000 --copy
+#     python datagen.py --books 10000 --loans 50000 --csv /tmp/library
+
+SUBJECTS = ['Fantasy', 'Literature', 'Programming', 'Sports', 'History', 'Science', 'Mystery',
+            'Biography', 'Poetry', 'Travel', 'Cooking', 'Art', 'Philosophy', 'Mathematics']
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas',
+               'Sarah', 'Carlos', 'Karen', 'Wei', 'Aisha', 'Mohammed', 'Priya', 'Hiroshi', 'Olga']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor',
+              'Moore', 'Jackson', 'Martin', 'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez',
+              'Clark', 'Ramirez', 'Lewis', 'Robinson', 'Walker', 'Young', 'Allen', 'King', 'Wright',
+              'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores', 'Green', 'Adams', 'Nelson', 'Baker', 'Hall',
+              'Rivera', 'Campbell', 'Mitchell', 'Carter', 'Roberts', 'Shah', 'Kim', 'Patel', 'Chen']
+TITLE_WORDS = ['Shadow', 'River', 'Silent', 'Garden', 'Empire', 'Code', 'Winter', 'Night', 'Stone',
+               'Journey', 'Secret', 'Fire', 'Ocean', 'Last', 'First', 'Golden', 'Broken', 'City',
+               'Algorithms', 'Season', 'Kingdom', 'Memory', 'Light', 'Storm', 'Game', 'Star', 'Field']
+DOMAINS = ['example.com', 'example.org', 'school.edu', 'mail.com']
+
+AUTHOR_ID_START = 100000000
+
+# Fraction of loans past their due date
+OVERDUE = 0.2
+
+# Loan length (same as assign_book_view)
+LOAN_DAYS = 14
+
+# Most copies any one title has
+MAX_COPIES = 200
+
+# ISBN-13 for the n-th generated book (979 prefix + 9 digit number + check digit)
+def make_isbn(n):
+    body = '979' + str(n).zfill(9)
+    total = sum(int(digit) * (1 if i % 2 == 0 else 3) for i, digit in enumerate(body))
+    return body + str((10 - total % 10) % 10)
+
+def make_author_id(n):
+    return str(AUTHOR_ID_START + n).zfill(9)
+
+def make_email(n):
+    return 'patron{}@{}'.format(n, DOMAINS[n % len(DOMAINS)])
+
+# Zipf-like rank in [0, n): P(rank = r) is roughly proportional to 1 / (r + 1)
+def skewed_rank(rng, n):
+    return min(int(n ** rng.random()) - 1, n - 1)
+
+# Spread the popular ranks over the whole key range (multiplication by a number coprime with n)
+def spread(rank, n, step):
+    return (rank * step) % n
+
+def coprime_step(n):
+    step = int(n * 0.6180339887) | 1
+    while math.gcd(step, n) != 1:
+        step = step + 2
+    return step
+
+def random_date(rng, start_year, end_year):
+    start = datetime.date(start_year, 1, 1).toordinal()
+    end = datetime.date(end_year, 12, 31).toordinal()
+    return datetime.date.fromordinal(rng.randint(start, end))
+
+class Generator():
+    def __init__(self, books, authors, users, loans, seed=0, overdue=OVERDUE):
+        self.books = books
+        self.authors = authors
+        self.users = users
+        self.loans = loans
+        self.seed = seed
+        self.overdue = overdue
+        self.book_step = coprime_step(books)
+        self.author_step = coprime_step(authors)
+        self.book_unstep = pow(self.book_step, -1, books)
+        self.today = datetime.date.today()
+
+        # Open loans per book, filled in while Borrow is generated and used for Inventory
+        self.loan_counts = array.array('H', bytes(2 * books))
+
+    # Each table gets its own random stream so they can be generated in any order
+    def rng(self, table):
+        return random.Random('{}:{}'.format(self.seed, table))
+
+    # Copies of a book, from how popular it is (rank 0 is the most borrowed), with a spare on
+    # top of its expected loans
+    def copies(self, n):
+        rank = (n * self.book_unstep) % self.books
+        expected = self.loans / (math.log(max(self.books, 2)) * (rank + 1))
+        return min(MAX_COPIES, 1 + math.ceil(expected * 2))
+
+    # Copies that may be out at once: all but one, so a copy stays on the shelf, except for the
+    # bestsellers held to MAX_COPIES, which can all be out
+    def lendable(self, n):
+        copies = self.copies(n)
+        return copies if copies == MAX_COPIES else copies - 1
+
+    def book_rows(self):
+        rng = self.rng('books')
+        for n in range(self.books):
+            title = ' '.join(rng.choice(TITLE_WORDS) for i in range(rng.randint(1, 4)))
+            yield (make_isbn(n), 'The ' + title, rng.choice(SUBJECTS), random_date(rng, 1900, self.today.year - 1))
+
+    def author_rows(self):
+        rng = self.rng('authors')
+        for n in range(self.authors):
+            yield (make_author_id(n), rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), random_date(rng, 1900, 1995))
+
+    # 70% of books have one author, 20% two and 10% three; prolific authors write more books
+    def written_by_rows(self):
+        rng = self.rng('writtenby')
+        for n in range(self.books):
+            count = 1
+            draw = rng.random()
+            if draw > 0.9:
+                count = 3
+            elif draw > 0.7:
+                count = 2
+            chosen = set()
+            while len(chosen) < min(count, self.authors):
+                chosen.add(spread(skewed_rank(rng, self.authors), self.authors, self.author_step))
+            for author in sorted(chosen):
+                yield (make_author_id(author), make_isbn(n))
+
+    def user_rows(self):
+        rng = self.rng('users')
+        # Everyone gets the password "password" (hashed once, synthetic data only)
+        password = credentials.kdf_hash('password')
+        for n in range(self.users):
+            yield (make_email(n), password, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+                   random_date(rng, 1940, self.today.year - 6), 'N')
+
+    # Loans are handed out patron by patron; books are picked by popularity,
+    # skipping ones the patron already has or that have no copies left to lend
+    def borrow_rows(self):
+        rng = self.rng('borrow')
+        remaining = self.loans
+        for user in range(self.users):
+            if remaining <= 0:
+                break
+            # Spread what is left evenly over the remaining patrons, with some variation
+            share = remaining / (self.users - user)
+            count = min(remaining, int(rng.expovariate(1 / share)) if share > 0 else 0, self.books)
+            email = make_email(user)
+            taken = set()
+            for k in range(count):
+                book = None
+                for attempt in range(20):
+                    candidate = spread(skewed_rank(rng, self.books), self.books, self.book_step)
+                    if attempt >= 10:
+                        # The popular titles are all out, take any book
+                        candidate = rng.randrange(self.books)
+                    if candidate not in taken and self.loan_counts[candidate] < self.lendable(candidate):
+                        book = candidate
+                        break
+                if book == None:
+                    continue
+                taken.add(book)
+                self.loan_counts[book] += 1
+                remaining = remaining - 1
+
+                if rng.random() < self.overdue:
+                    borrowdate = self.today - datetime.timedelta(days=rng.randint(LOAN_DAYS + 1, LOAN_DAYS + 120))
+                else:
+                    borrowdate = self.today - datetime.timedelta(days=rng.randint(0, LOAN_DAYS))
+                yield (make_isbn(book), email, borrowdate, borrowdate + datetime.timedelta(days=LOAN_DAYS))
+
+    # Must run after borrow_rows
+    def inventory_rows(self):
+        for n in range(self.books):
+            yield (make_isbn(n), self.copies(n) - self.loan_counts[n], self.copies(n))
+
+    # (table, columns, rows) in foreign key order
+    def tables(self):
+        return [
+            ('Books',        ['ISBN', 'Title', 'Subject', 'DatePublished'],                    self.book_rows),
+            ('Authors',      ['AuthorID', 'FirstName', 'LastName', 'DOB'],                     self.author_rows),
+            ('WrittenBy',    ['AuthorID', 'ISBN'],                                             self.written_by_rows),
+            ('LibraryUsers', ['Email', 'Password', 'FirstName', 'LastName', 'DOB', 'IsAdmin'], self.user_rows),
+            ('Borrow',       ['ISBN', 'Email', 'BorrowDate', 'DueDate'],                       self.borrow_rows),
+            ('Inventory',    ['ISBN', 'Quantity', 'Copies'],                                   self.inventory_rows),
+        ]
+
+# File-like object that renders rows as CSV on demand, so COPY can stream from a generator
+class RowStream(io.RawIOBase):
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b''
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+
+    def readable(self):
+        return True
+
+    # Render rows in batches of about 1000
+    def fill(self):
+        for i in range(1000):
+            row = next(self.rows, None)
+            if row == None:
+                break
+            self.writer.writerow(row)
+        data = self.text.getvalue().encode()
+        self.text.seek(0)
+        self.text.truncate()
+        return data
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.fill()
+            if len(data) == 0:
+                break
+            self.buffer = self.buffer + data
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+# Write every table to DIR/<Table>.csv (with a header like the files in Tables/)
+def write_csv(generator, directory):
+    os.makedirs(directory, exist_ok=True)
+    for table, columns, rows in generator.tables():
+        path = os.path.join(directory, table + '.csv')
+        with open(path, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(columns)
+            count = 0
+            for row in rows():
+                writer.writerow(row)
+                count = count + 1
+        print('{}: {} rows -> {}'.format(table, count, path))
+
+# COPY every table straight into the database (one transaction)
+def copy_to_database(generator):
+    from main import DataBase
+
+    db = DataBase()
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+    try:
+        for table, columns, rows in generator.tables():
+            cursor.copy_expert(
+                'COPY {}({}) FROM STDIN WITH (FORMAT csv)'.format(table, ','.join(columns)),
+                RowStream(rows()), size=1 << 16
+            )
+            print('{}: {} rows'.format(table, cursor.rowcount))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        db.release(connection)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic library dataset')
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--authors', type=int, default=None, help='default: books / 2')
+    parser.add_argument('--users', type=int, default=None, help='default: loans / 5')
+    parser.add_argument('--loans', type=int, default=500000)
+    parser.add_argument('--overdue', type=float, default=OVERDUE, help='fraction of loans that are overdue')
+    parser.add_argument('--seed', type=int, default=0)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--csv', metavar='DIR', help='write CSV files to DIR')
+    output.add_argument('--copy', action='store_true', help='COPY straight into the database')
+    args = parser.parse_args()
+
+    authors = args.authors or max(1, args.books // 2)
+    users = args.users or max(1, args.loans // 5)
+    generator = Generator(args.books, authors, users, args.loans, args.seed, args.overdue)
+    if args.copy:
+        copy_to_database(generator)
+    else:
+        write_csv(generator, args.csv)
@@ -0,0 +1,126 @@
+import sys
+import gzip
+import json
+import time
+import argparse
+import datetime
+
+from main import DataBase
+
+# Report export
+# Streams the librarian reports straight from the database into a file, for auditors.
+# CSV is produced by the server with COPY (query) TO STDOUT and written as it arrives.
+# JSONL reads the rows through a server-side cursor, ITERSIZE at a time.
+# Either way memory stays flat however many rows there are.
+#
+#     python export.py overdue overdue.csv
+#     python export.py catalog catalog.jsonl.gz          (format and gzip taken from the name)
+#     python export.py borrowed - --format jsonl         (to stdout)
+#
+# Dates are written as YYYY-MM-DD.
+
+# report -> query
+REPORTS = {
+    'overdue'  : """SELECT isbn,email,branch,borrowdate,duedate FROM Borrow
+                    WHERE duedate < CURRENT_DATE ORDER BY duedate,isbn""",
+    'borrowed' : """SELECT email,title,branch,borrowdate,duedate,isbn FROM Borrow NATURAL JOIN Books
+                    ORDER BY email,isbn""",
+    'catalog'  : """SELECT isbn,title,subject,
+                        STRING_AGG(firstname || ' ' || lastname, ', ') AS authors,
+                        datepublished,quantity
+                    FROM Books NATURAL JOIN WrittenBy NATURAL JOIN Authors
+                    NATURAL JOIN (SELECT isbn,SUM(quantity) AS quantity FROM Inventory GROUP BY isbn) AS Stock
+                    GROUP BY isbn,title,subject,datepublished,quantity ORDER BY title,isbn""",
+}
+
+FORMATS = ['csv', 'jsonl']
+
+# Rows per round trip for the server-side cursor
+ITERSIZE = 10000
+
+# Bytes per COPY read
+COPY_BUFFER = 1 << 16
+
+def to_json(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)   # Decimal and anything else
+
+# Counts what goes through so the summary can report it
+class CountingWriter():
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.outfile.write(data)
+
+def export_csv(cursor, query, outfile):
+    cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(query), outfile, COPY_BUFFER)
+    return cursor.rowcount
+
+def export_jsonl(connection, query, outfile):
+    cursor = connection.cursor(name='export')
+    cursor.execute(query)
+    rows = 0
+    keys = None
+    while True:
+        batch = cursor.fetchmany(ITERSIZE)
+        if len(batch) == 0:
+            break
+        if keys == None:
+            keys = [col[0] for col in cursor.description]
+        lines = [json.dumps(dict(zip(keys, row)), default=to_json) for row in batch]
+        outfile.write(('\n'.join(lines) + '\n').encode())
+        rows = rows + len(batch)
+    cursor.close()
+    return rows
+
+def open_output(path, compress):
+    if path == '-':
+        return sys.stdout.buffer, False
+    if compress:
+        return gzip.open(path, 'wb', compresslevel=6), True
+    return open(path, 'wb'), True
+
+# Export one report; returns (rows, bytes written before compression)
+def export(report, path, format=None, compress=None):
+    name = path[:-3] if path.endswith('.gz') else path
+    format = format or ('jsonl' if name.endswith('.jsonl') or name.endswith('.json') else 'csv')
+    compress = path.endswith('.gz') if compress == None else compress
+
+    db = DataBase()
+    connection = db.get_read_connection('librarian')
+    outfile, close = open_output(path, compress)
+    writer = CountingWriter(outfile)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL DateStyle = 'ISO, MDY'")
+        if format == 'csv':
+            rows = export_csv(cursor, REPORTS[report], writer)
+        else:
+            rows = export_jsonl(connection, REPORTS[report], writer)
+        cursor.close()
+        connection.rollback()
+    finally:
+        if close:
+            outfile.close()
+        else:
+            outfile.flush()
+        db.release(connection)
+    return rows, writer.bytes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a librarian report to CSV or JSONL')
+    parser.add_argument('report', choices=sorted(REPORTS))
+    parser.add_argument('output', help='file to write ("-" for stdout); a .gz name is gzipped')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the file name, else csv')
+    parser.add_argument('--gzip', action='store_true', default=None, help='gzip the output whatever its name')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows, size = export(args.report, args.output, args.format, args.gzip)
+    seconds = time.perf_counter() - start
+    sys.stderr.write('Exported {} rows ({:.1f} MB) in {:.1f}s ({:.1f} MB/s)\n'.format(
+        rows, size / 1e6, seconds, size / 1e6 / max(seconds, 1e-9)))
@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import threading
+import traceback
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import metrics
+import services
+from main import DataBase
+from sessions import SessionStore
+
+# JSON HTTP API
+# The same operations as the terminal menus (services.py) for the web catalogue and the mobile app.
+# Each request runs on its own thread with a connection from the shared per-role pools in DataBase
+# (--workers of them at a time).
+#
+#     python http_api.py --port 8080
+#
+#     POST /signup          {"firstname", "lastname", "dob", "email", "password", "conf_pass"}
+#     POST /login           {"email", "password"}             -> {"token", "email", "isadmin"}
+#     POST /logout
+#     GET  /books                                              catalog (cached, ETag)
+#     GET  /subjects                                           (cached, ETag)
+#     GET  /search?subject=...                                 (cached, ETag)
+#     GET  /search?author=...                                  (not cached here, see uncached)
+#     GET  /recommendation?subject=...
+#     GET  /availability?isbn=...,...                          branches with copies on the shelf
+#     GET  /me/books                                           patron
+#     POST /checkout        {"email", "isbn", "branch"}        librarian (branch defaults to LIBRARY_BRANCH)
+#     POST /return          {"email", "isbn", "branch"}        librarian
+#     GET  /reports/overdue | /reports/borrowed | /reports/patrons | /reports/dashboard    librarian
+#
+# Logged in requests send "Authorization: Bearer <token>" with the token from /login.
+# Errors come back as {"error": message} with the status from the LibraryError.
+
+# How long clients and this process may reuse a catalog read (seconds)
+CATALOG_MAX_AGE = int(os.environ.get('LIBRARY_HTTP_MAX_AGE', 60))
+
+# Catalog responses kept in memory at most
+CATALOG_CACHE_SIZE = int(os.environ.get('LIBRARY_HTTP_CACHE_SIZE', 256))
+
+# Largest request body accepted
+MAX_BODY = 64 * 1024
+
+sessions = SessionStore()
+
+# Rendered catalog responses, least recently used dropped first, expired ones dropped as found
+class CatalogCache():
+    def __init__(self, capacity=CATALOG_CACHE_SIZE):
+        self.capacity = capacity
+        self.cache = OrderedDict() # key -> (expires, body, etag)
+        self.lock = threading.Lock()
+
+    # (body, etag) for a key that has not expired, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry == None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, body, etag):
+        now = time.monotonic()
+        with self.lock:
+            for old in [old for old, entry in self.cache.items() if entry[0] <= now]:
+                del self.cache[old]
+            self.cache[key] = (now + CATALOG_MAX_AGE, body, etag)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+catalog_cache = CatalogCache()
+
+def clear_catalog_cache():
+    catalog_cache.clear()
+
+# The query parameters each cacheable route reads; the cache key is the route and their values
+# (anything else in the query string is ignored, so it can't add entries)
+CACHE_PARAMS = {
+    '/books'    : [],
+    '/subjects' : [],
+    '/search'   : ['subject'],
+}
+
+def cache_key(path, query):
+    return (path,) + tuple(query.get(name) for name in CACHE_PARAMS[path])
+
+# Catalog reads kept out of catalog_cache: author searches go through services.author_cache, which
+# checks CatalogVersion on every call, so a catalog change made anywhere shows up at once
+def uncached(path, query):
+    return path == '/search' and 'author' in query
+
+# Dates go out as MM/DD/YYYY like everywhere else
+def to_json(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return datetime.datetime.strftime(value, services.FORMAT)
+    raise TypeError('Cannot encode ' + type(value).__name__)
+
+def encode(payload):
+    return json.dumps(payload, default=to_json).encode()
+
+def required(values, *names):
+    missing = [name for name in names if not isinstance(values.get(name), str) or len(values[name]) == 0]
+    if len(missing) > 0:
+        raise services.InvalidRequest('Missing ' + ', '.join(missing))
+    return [values[name] for name in names]
+
+# ---------------- Handlers ----------------
+# Each takes (db, cursor, request) and returns the JSON payload
+
+def signup_route(db, cursor, request):
+    fields = ['firstname', 'lastname', 'dob', 'email', 'password', 'conf_pass']
+    formdata = {name: str(request.body.get(name, '')) for name in fields}
+    return services.sign_up(db, cursor, formdata)
+
+def login_route(db, cursor, request):
+    email, password = required(request.body, 'email', 'password')
+    user = services.authenticate(db, cursor, email, password)
+    user['token'] = sessions.create(user['email'], user['isadmin'])
+    return user
+
+def logout_route(db, cursor, request):
+    sessions.revoke(request.token)
+    return {'logged_out': True}
+
+def books_route(db, cursor, request):
+    return list(services.book_catalog(db, cursor))
+
+def subjects_route(db, cursor, request):
+    return services.list_subjects(db, cursor)
+
+def search_route(db, cursor, request):
+    if 'subject' in request.query:
+        return list(services.search_by_subject(db, cursor, request.query['subject']))
+    if 'author' in request.query:
+        return list(services.search_by_author(db, cursor, request.query['author']))
+    raise services.InvalidRequest('Search needs ?subject= or ?author=')
+
+def recommendation_route(db, cursor, request):
+    subject, = required(request.query, 'subject')
+    book = services.recommend(db, cursor, subject)
+    if book == None:
+        raise services.NotFound('Sorry, we do not have books in that subject.')
+    return book
+
+def availability_route(db, cursor, request):
+    isbns, = required(request.query, 'isbn')
+    return services.available_copies(db, cursor, isbns.split(','))
+
+def my_books_route(db, cursor, request):
+    return list(services.borrowed_books(db, cursor, request.user['email']))
+
+def checkout_route(db, cursor, request):
+    email, isbn = required(request.body, 'email', 'isbn')
+    loan = services.checkout(db, cursor, email, isbn, branch=request.body.get('branch'))
+    clear_catalog_cache()   # quantities changed
+    return loan
+
+def return_route(db, cursor, request):
+    email, isbn = required(request.body, 'email', 'isbn')
+    result = services.process_return(db, cursor, email, isbn, branch=request.body.get('branch'))
+    clear_catalog_cache()
+    return result
+
+def overdue_route(db, cursor, request):
+    return list(services.overdue_books(db, cursor))
+
+def borrowed_route(db, cursor, request):
+    return list(services.all_borrowed_books(db, cursor))
+
+def patrons_route(db, cursor, request):
+    return list(services.registered_patrons(db, cursor))
+
+def dashboard_route(db, cursor, request):
+    return services.dashboard(db)
+
+# (method, path) -> (handler, who may call it, connection role, cacheable catalog read)
+ROUTES = {
+    ('POST', '/signup')           : (signup_route,         None,        'patron',    False),
+    ('POST', '/login')            : (login_route,          None,        'patron',    False),
+    ('POST', '/logout')           : (logout_route,         'patron',    'patron',    False),
+    ('GET',  '/books')            : (books_route,          None,        'librarian', True),
+    ('GET',  '/subjects')         : (subjects_route,       None,        'patron',    True),
+    ('GET',  '/search')           : (search_route,         None,        'patron',    True),
+    ('GET',  '/recommendation')   : (recommendation_route, None,        'patron',    False),
+    ('GET',  '/availability')     : (availability_route,   None,        'patron',    False),
+    ('GET',  '/me/books')         : (my_books_route,       'patron',    'patron',    False),
+    ('POST', '/checkout')         : (checkout_route,       'librarian', 'librarian', False),
+    ('POST', '/return')           : (return_route,         'librarian', 'librarian', False),
+    ('GET',  '/reports/overdue')  : (overdue_route,        'librarian', 'librarian', False),
+    ('GET',  '/reports/borrowed') : (borrowed_route,       'librarian', 'librarian', False),
+    ('GET',  '/reports/patrons')  : (patrons_route,        'librarian', 'librarian', False),
+    ('GET',  '/reports/dashboard'): (dashboard_route,      'librarian', 'librarian', False),
+}
+
+# Routes that only read, served from a replica when DataBase.REPLICAS are configured.
+# /me/books stays on the primary: a patron looks there right after a checkout at the desk.
+READ_ONLY = {'/books', '/subjects', '/search', '/recommendation', '/availability',
+             '/reports/overdue', '/reports/borrowed', '/reports/patrons', '/reports/dashboard'}
+
+# What a handler sees of the request
+class Request():
+    def __init__(self, query, body, token, user):
+        self.query = query
+        self.body = body
+        self.token = token
+        self.user = user
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+    server_version = 'LibraryAPI/1.0'
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write('%s - %s\n' % (self.address_string(), format % args))
+
+    def send_json(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, encode({'error': message}), {'Cache-Control': 'no-store'})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            raise services.InvalidRequest('Request body too large')
+        if length == 0:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise services.InvalidRequest('Request body is not valid JSON')
+        if not isinstance(body, dict):
+            raise services.InvalidRequest('Request body must be a JSON object')
+        return body
+
+    # The session for the bearer token, checked against who may call the route
+    def authorize(self, allowed):
+        header = self.headers.get('Authorization') or ''
+        token = header[len('Bearer '):].strip() if header.startswith('Bearer ') else None
+        if allowed == None:
+            return token, None
+        user = sessions.resume(token) if token else None
+        if user == None:
+            raise services.NotAuthenticated('Please log in.')
+        if allowed == 'librarian' and user['isadmin'] != 'Y':
+            raise services.Forbidden('Only librarians can do that.')
+        return token, user
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        route = ROUTES.get((method, url.path))
+        if route == None:
+            self.send_error_json(404, 'No such endpoint')
+            return
+        handler, allowed, role, cacheable = route
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        cacheable = cacheable and not uncached(url.path, query)
+
+        # Catalog reads: answer from the cache (or with 304) without a connection
+        if cacheable:
+            key = cache_key(url.path, query)
+            cached = catalog_cache.get(key)
+            if cached != None:
+                metrics.inc('library_cache_requests_total', cache='http_catalog', result='hit')
+                self.send_cached(cached[0], cached[1])
+                return
+            metrics.inc('library_cache_requests_total', cache='http_catalog', result='miss')
+
+        db = DataBase()
+        try:
+            body = self.read_body() if method == 'POST' else {}
+            token, user = self.authorize(allowed)
+            # Read your writes follows the login (or the client), not this handler thread
+            db.set_owner(('api', token or self.client_address[0]))
+
+            # At most --workers requests hold connections at once; the rest wait here
+            metrics.inc('library_pool_waiting', role='http_api', target='worker_slot')
+            with self.server.slots:
+                metrics.inc('library_pool_waiting', -1, role='http_api', target='worker_slot')
+                if url.path in READ_ONLY:
+                    connection = db.get_read_connection(role)
+                else:
+                    connection = db.checkout_connection(role)
+                cursor = connection.cursor()
+                payload = handler(db, cursor, Request(query, body, token, user))
+                cursor.close()
+                db.release(connection)
+        except services.LibraryError as error:
+            self.send_error_json(error.status, error.message)
+            return
+        except Exception:
+            # The details stay in the server log; database errors can show table and column names
+            sys.stderr.write('{} {} failed\n{}'.format(method, url.path, traceback.format_exc()))
+            self.send_error_json(500, 'Sorry, something went wrong.')
+            return
+        finally:
+            # Anything a failed request still holds (release rolls back)
+            db.release_all()
+            db.set_owner(None)
+
+        body = encode(payload)
+        if cacheable:
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            catalog_cache.put(key, body, etag)
+            self.send_cached(body, etag)
+        else:
+            self.send_json(200, body, {'Cache-Control': 'no-store'})
+
+    def send_cached(self, body, etag):
+        headers = {'ETag': etag, 'Cache-Control': 'public, max-age={}'.format(CATALOG_MAX_AGE)}
+        if etag in [tag.strip() for tag in (self.headers.get('If-None-Match') or '').split(',')]:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(200, body, headers)
+
+class APIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, workers, verbose=False):
+        super().__init__(address, Handler)
+        self.verbose = verbose
+        self.slots = threading.BoundedSemaphore(workers)
+        # A login holds a second patron connection while it creates the session
+        DataBase.POOL_MAX = max(DataBase.POOL_MAX, 2 * workers)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the library operations as a JSON HTTP API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=32, help='requests using the database at once')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = APIServer((args.host, args.port), args.workers, args.verbose)
+    # Logged in users whose sessions this process holds
+    metrics.register_gauge('library_sessions_active', lambda: {(('server', 'http_api'),): len(sessions.cache)})
+    metrics.serve_from_environment()
+    sys.stderr.write('Library API listening on http://{}:{}\n'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
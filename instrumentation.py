@@ -0,0 +1,298 @@
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import datetime
+import threading
+import functools
+from collections import Counter
+
+import psycopg2.extensions
+
+import metrics
+
+# Query instrumentation
+# Every cursor handed out by DataBase is an InstrumentedCursor, so each execute/COPY
+# (and each commit/rollback on the connection) is timed and counted here:
+#   - per statement: latency histogram, calls and rows
+#   - per view: database time histogram, calls, round trips and rows per call
+# Statements slower than SLOW_MS are appended to the slow query log, optionally with
+# their EXPLAIN (ANALYZE, BUFFERS) plan.
+#
+# Librarians can print the stats from their menu. Set LIBRARY_STATS_FILE to also save them
+# when the process exits, then print a saved file with:
+#     python instrumentation.py stats.json
+
+# Statements slower than this (milliseconds) go to the slow query log
+SLOW_MS = float(os.environ.get('LIBRARY_SLOW_MS', 100))
+SLOW_LOG = os.environ.get('LIBRARY_SLOW_LOG', 'slow_queries.log')
+
+# Capture EXPLAIN (ANALYZE, BUFFERS) for slow statements (runs the statement again, SELECTs only)
+SLOW_EXPLAIN = os.environ.get('LIBRARY_SLOW_EXPLAIN', '0') == '1'
+
+# Save the stats here when the process exits
+STATS_FILE = os.environ.get('LIBRARY_STATS_FILE')
+
+# Histogram bucket upper bounds in milliseconds (the last bucket is everything above)
+BUCKETS = [0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+# Latency histogram with call/row totals
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.round_trips = 0
+
+    def add(self, ms, rows=0, round_trips=1):
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i = i + 1
+        self.counts[i] += 1
+        self.calls += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += max(rows, 0)
+        self.round_trips += round_trips
+
+    # Approximate percentile (upper bound of the bucket it falls in)
+    def percentile(self, p):
+        if self.calls == 0:
+            return 0.0
+        target = self.calls * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else round(self.max_ms, 3)
+        return round(self.max_ms, 3)
+
+    def to_dict(self):
+        return {
+            'calls'       : self.calls,
+            'round_trips' : self.round_trips,
+            'rows'        : self.rows,
+            'total_ms'    : round(self.total_ms, 3),
+            'mean_ms'     : round(self.total_ms / self.calls, 3) if self.calls else 0.0,
+            'p50_ms'      : self.percentile(50),
+            'p95_ms'      : self.percentile(95),
+            'p99_ms'      : self.percentile(99),
+            'max_ms'      : round(self.max_ms, 3),
+            'buckets'     : self.counts,
+        }
+
+# Registry shared by every thread in the process
+lock = threading.Lock()
+statements = {}  # statement text -> Histogram
+views = {}       # view name -> Histogram (one entry per view call)
+
+# The view running on this thread and what it has done so far
+current = threading.local()
+
+# Collapse whitespace and drop literal values so the same statement is always one key
+def statement_key(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors='replace')
+    sql = re.sub(r'\s+', ' ', str(sql)).strip()
+    sql = re.sub(r"'[^']*'", '?', sql)
+    return sql[:200]
+
+# Metrics label for a statement: the prepared statement's name, else the SQL verb
+def statement_kind(key):
+    words = key.split(' ', 2)
+    if words[0].upper() in ['EXECUTE', 'PREPARE'] and len(words) > 1:
+        return words[1]
+    return words[0].upper()
+
+# Record one round trip
+def record(sql, ms, rows):
+    key = statement_key(sql)
+    with lock:
+        if key not in statements:
+            statements[key] = Histogram()
+        statements[key].add(ms, rows)
+    metrics.observe('library_db_seconds', ms / 1000, statement=statement_kind(key))
+
+    # Add it to the view running on this thread
+    if getattr(current, 'view', None) != None:
+        current.db_ms += ms
+        current.round_trips += 1
+        current.rows += max(rows, 0)
+        current.statements[key] += 1
+
+# Append a slow statement (and maybe its plan) to the slow query log
+def log_slow(connection, sql, args, ms):
+    plan = None
+    status = connection.info.transaction_status
+    if SLOW_EXPLAIN and status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        plan = 'EXPLAIN skipped: the transaction had already failed'
+    elif SLOW_EXPLAIN and re.match(r'\s*(SELECT|EXECUTE)\b', str(sql), re.IGNORECASE):
+        # Inside the view's transaction the EXPLAIN runs under a savepoint, so if it fails the
+        # view's transaction carries on as if it never ran
+        savepoint = status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        cursor = connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT slow_explain")
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, args)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_explain")
+        except psycopg2.Error as error:
+            plan = 'EXPLAIN failed: {}'.format(error)
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_explain")
+        finally:
+            cursor.close()
+
+    with lock:
+        with open(SLOW_LOG, 'a') as logfile:
+            logfile.write('{} {:.1f} ms view={} {}\n'.format(
+                datetime.datetime.now().isoformat(timespec='seconds'), ms,
+                getattr(current, 'view', None), statement_key(sql)
+            ))
+            if plan != None:
+                logfile.write(plan + '\n')
+
+# Cursor that times every statement it sends
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, sql, args=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, args)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            record(sql, ms, self.rowcount)
+            if ms >= SLOW_MS:
+                log_slow(self.connection, sql, args, ms)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            record(sql, ms, self.rowcount)
+
+# Decorator for the Views methods: attributes the statements the view runs to it
+def track_view(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # A view called from another view counts towards the outer one
+        if getattr(current, 'view', None) != None:
+            return func(*args, **kwargs)
+
+        current.view = func.__name__
+        current.db_ms = 0.0
+        current.round_trips = 0
+        current.rows = 0
+        current.statements = Counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with lock:
+                if current.view not in views:
+                    views[current.view] = Histogram()
+                views[current.view].add(current.db_ms, current.rows, current.round_trips)
+
+            # What this call sent, for the query budget checks
+            current.last_call = {
+                'view'        : current.view,
+                'round_trips' : current.round_trips,
+                'statements'  : current.statements,
+            }
+            current.view = None
+    return wrapper
+
+# Name of the view running on this thread (None outside a view)
+def current_view():
+    return getattr(current, 'view', None)
+
+# Run func on a worker thread for `view` (current_view() of the thread that handed it over), so
+# its statements are counted like the view's own. Returns (result, work); the view's thread adds
+# the work to its call with add_work.
+def run_for_view(view, func, *args):
+    if view == None:
+        return func(*args), None
+    current.view = view
+    current.db_ms = 0.0
+    current.round_trips = 0
+    current.rows = 0
+    current.statements = Counter()
+    try:
+        result = func(*args)
+        work = {
+            'db_ms'       : current.db_ms,
+            'round_trips' : current.round_trips,
+            'rows'        : current.rows,
+            'statements'  : current.statements,
+        }
+    finally:
+        current.view = None
+    return result, work
+
+# Count work done by a worker thread (from run_for_view) towards the view running here
+def add_work(work):
+    if work == None or getattr(current, 'view', None) == None:
+        return
+    current.db_ms += work['db_ms']
+    current.round_trips += work['round_trips']
+    current.rows += work['rows']
+    current.statements.update(work['statements'])
+
+# Round trips and statement counts of the last view call on this thread
+def get_last_call():
+    return getattr(current, 'last_call', None)
+
+# Snapshot of everything recorded so far
+def get_stats():
+    with lock:
+        return {
+            'views'      : {name: hist.to_dict() for name, hist in views.items()},
+            'statements' : {sql: hist.to_dict() for sql, hist in statements.items()},
+        }
+
+def reset_stats():
+    with lock:
+        views.clear()
+        statements.clear()
+
+# Print a stats snapshot as two tables
+def print_stats(stats=None):
+    if stats == None:
+        stats = get_stats()
+
+    print('\n------------------------------------------------')
+    print('Query Statistics (per view call, database time only):')
+    print('------------------------------------------------')
+    print('{:<28} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'view', 'calls', 'trips/call', 'rows', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, view in sorted(stats['views'].items(), key=lambda item: -item[1]['total_ms']):
+        print('{:<28} {:>7} {:>10.1f} {:>9} {:>9} {:>9} {:>9}'.format(
+            name, view['calls'], view['round_trips'] / max(view['calls'], 1),
+            view['rows'], view['p50_ms'], view['p95_ms'], view['p99_ms']))
+
+    print('\n{:<7} {:>10} {:>9} {:>9} {:>9}  statement'.format('calls', 'total ms', 'p50 ms', 'p99 ms', 'rows'))
+    for sql, statement in sorted(stats['statements'].items(), key=lambda item: -item[1]['total_ms'])[:25]:
+        print('{:<7} {:>10.1f} {:>9} {:>9} {:>9}  {}'.format(
+            statement['calls'], statement['total_ms'], statement['p50_ms'],
+            statement['p99_ms'], statement['rows'], sql[:80]))
+    print('\n')
+
+def save_stats(path):
+    with open(path, 'w') as statsfile:
+        json.dump(get_stats(), statsfile, indent=2)
+
+if STATS_FILE != None:
+    atexit.register(save_stats, STATS_FILE)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: python instrumentation.py STATS_FILE')
+        sys.exit(1)
+    with open(sys.argv[1]) as statsfile:
+        print_stats(json.load(statsfile))
@@ -1,11 +1,46 @@
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 from enum import Enum
+from collections import Counter
 import datetime
+import itertools
+import os
+import threading
+import time
 from getpass import getpass
-import hashlib
-
-# Format for DATE
-FORMAT = "%m/%d/%Y" 
+import instrumentation
+import metrics
+import profiling
+import services
+from render import Renderer, Column
+from services import FORMAT
+
+# Connection that remembers which role's pool (and which replica, None for the primary) it came from
+# and which STATEMENTS have been PREPAREd on it
+# (its cursors and commits are timed by instrumentation)
+class PooledConnection(psycopg2.extensions.connection):
+    backend = 'postgres'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.role = None
+        self.replica = None
+        self.prepared = set()
+        self.cursor_factory = instrumentation.InstrumentedCursor
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        instrumentation.record('COMMIT', (time.perf_counter() - start) * 1000, 0)
+        # Whoever this was for reads from the primary for a while, so they see what they just wrote
+        if self.replica == None:
+            DataBase().note_write()
+
+    def rollback(self):
+        start = time.perf_counter()
+        super().rollback()
+        instrumentation.record('ROLLBACK', (time.perf_counter() - start) * 1000, 0)
 
 # UserType enumeration
 class UserType(Enum):
@@ -15,36 +50,240 @@ class UserType(Enum):
 
 # Database class
 class DataBase():
+    # Connection settings for each database role
+    SETTINGS = {
+        'librarian' : {'host': 'localhost', 'port': 5432, 'database': 'bookstore', 'user': 'librarian', 'password': 'password'},
+        'patron'    : {'host': 'localhost', 'port': 5432, 'database': 'bookstore', 'user': 'patron',    'password': 'password'},
+    }
+
+    # 'postgres' (the SETTINGS above) or 'sqlite' (one local file, see sqlite_backend.py)
+    BACKEND = os.environ.get('LIBRARY_BACKEND', 'postgres')
+    SQLITE_PATH = os.environ.get('LIBRARY_SQLITE_PATH', 'library.db')
+
+    # Read replicas ("host:port,host:port", same database and users as SETTINGS).
+    # Read-only views take turns on the replicas that are at most MAX_LAG seconds behind;
+    # lag is measured at most every LAG_CHECK_INTERVAL seconds per replica.
+    REPLICAS = [replica.strip() for replica in os.environ.get('LIBRARY_REPLICAS', '').split(',') if replica.strip()]
+    MAX_LAG = float(os.environ.get('LIBRARY_REPLICA_MAX_LAG', 5))
+    LAG_CHECK_INTERVAL = float(os.environ.get('LIBRARY_LAG_CHECK_INTERVAL', 1))
+
+    # Seconds a replica is behind (0 when it has replayed everything it received)
+    LAG_QUERY = """SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                               WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                               ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                          END"""
+
+    # Pool size per role
+    POOL_MIN = int(os.environ.get('LIBRARY_POOL_MIN', 1))
+    POOL_MAX = int(os.environ.get('LIBRARY_POOL_MAX', 20))
+
+    # Hot statements, PREPAREd once per pooled connection and run with EXECUTE
+    STATEMENTS = {
+        'book_by_isbn'        : "SELECT * FROM Books WHERE isbn = $1",
+        'user_by_email'       : "SELECT * FROM LibraryUsers WHERE email = $1",
+        # Emails are matched without case at sign up, login and import (an exact match first, for
+        # old databases holding the same address in two cases)
+        'email_in_use'        : "SELECT 1 FROM LibraryUsers WHERE lower(email) = lower($1) LIMIT 1",
+        'login_by_email'      : "SELECT email,isadmin,password FROM LoginView WHERE lower(email) = lower($1) ORDER BY email <> $1 LIMIT 1",
+        'inventory_by_branch_isbn': "SELECT * FROM Inventory WHERE branch = $1 AND isbn = $2",
+        'user_for_checkout'   : "SELECT * FROM LibraryUsers WHERE email = $1 FOR NO KEY UPDATE",
+        'borrow_by_email_isbn': "SELECT * FROM Borrow WHERE email = $1 AND isbn = $2 ORDER BY branch <> $3, duedate LIMIT 1",
+        'next_due_by_branch_isbn': "SELECT duedate FROM Borrow WHERE branch = $1 AND isbn = $2 ORDER BY duedate LIMIT 1",
+        'subjects'            : "SELECT DISTINCT subject FROM Books",
+        'catalog_version'     : "SELECT version FROM CatalogVersion WHERE id = 1",
+        'search_by_subject'   : """SELECT title,isbn,
+                                    STRING_AGG(
+                                        firstname || ' ' || lastname, ', '
+                                    ) AS Authors
+                                FROM Books NATURAL JOIN WrittenBy NATURAL JOIN Authors 
+                                WHERE subject = $1 GROUP BY ISBN""",
+        'search_by_author'    : """SELECT Title, FirstName, LastName, subject, datepublished, ISBN FROM Books 
+                                NATURAL JOIN WrittenBy NATURAL JOIN Authors 
+                                WHERE lastname = $1 ORDER BY firstname,lastname""",
+        'recommend_by_subject': """SELECT Title, FirstName, LastName, ISBN FROM Books 
+                                NATURAL JOIN WrittenBy NATURAL JOIN Authors 
+                                WHERE subject = $1 ORDER BY RANDOM() LIMIT 1""",
+    }
+
+    # Shared by every DataBase() in the process
+    pools = {}                  # role (primary) or (role, replica) -> ThreadedConnectionPool
+    lock = threading.Lock()
+    statement_calls = Counter() # statement name -> number of EXECUTEs
+    held = threading.local()    # connections each thread has checked out
+    owner = threading.local()   # who each thread is working for (see get_owner)
+    written = {}                # owner -> when it last committed on the primary
+    replica_lag = {}            # replica -> (checked at, seconds behind or None if unreachable)
+    replica_turn = itertools.count()
+
+    # Connection settings for a role on the primary or on a replica
+    def get_settings(self, role, replica=None):
+        settings = dict(DataBase.SETTINGS[role])
+        if replica != None:
+            host, port = replica.rsplit(':', 1) if ':' in replica else (replica, settings['port'])
+            settings.update(host=host, port=int(port), connect_timeout=2)
+        return settings
+
+    # Get (or create) the connection pool for a role (on the primary, or on a replica)
+    def get_pool(self, role, replica=None):
+        key = role if replica == None else (role, replica)
+        pool = DataBase.pools.get(key)
+        if pool == None:
+            with DataBase.lock:
+                pool = DataBase.pools.get(key)
+                if pool == None and DataBase.BACKEND == 'sqlite':
+                    import sqlite_backend
+                    pool = sqlite_backend.SQLitePool(DataBase.POOL_MIN, DataBase.POOL_MAX, DataBase.SQLITE_PATH)
+                    DataBase.pools[key] = pool
+                elif pool == None:
+                    pool = psycopg2.pool.ThreadedConnectionPool(
+                        DataBase.POOL_MIN, DataBase.POOL_MAX,
+                        connection_factory=PooledConnection,
+                        **self.get_settings(role, replica)
+                    )
+                    DataBase.pools[key] = pool
+        return pool
+
+    # Take a connection from a role's pool
+    # (the pool never waits for one: with all POOL_MAX connections out, getconn raises PoolError)
+    def checkout_connection(self, role, replica=None):
+        target = replica or 'primary'
+        try:
+            connection = self.get_pool(role, replica).getconn()
+        except psycopg2.pool.PoolError:
+            metrics.inc('library_pool_exhausted_total', role=role, target=target)
+            raise
+        except Exception:
+            metrics.inc('library_pool_errors_total', role=role, target=target)
+            raise
+        metrics.inc('library_pool_in_use', role=role, target=target)
+        connection.role = role
+        connection.replica = replica
+        if not hasattr(DataBase.held, 'connections'):
+            DataBase.held.connections = []
+        DataBase.held.connections.append(connection)
+        return connection
+
     # Get the librarian connection
     def get_librarian_connection(self):
-        # If librarian, then connect like this
-        connection = psycopg2.connect(
-            host="localhost",
-            port = 5432, 
-            database="bookstore", 
-            user="librarian", 
-            password="password"
-        )
-        return connection
+        return self.checkout_connection('librarian')
 
     # Get the Patron (Default) connection
     def get_patron_connection(self):
-        # Connect Patron (default)
-        connection = psycopg2.connect(
-            host="localhost", 
-            port = 5432, 
-            database="bookstore", 
-            user="patron", 
-            password="password"
-        )
-        return connection
+        return self.checkout_connection('patron')
+
+    # Who the current thread's reads and writes are for: the terminal session or API client a
+    # server thread is serving (set_owner), else the thread itself. Read your writes is per owner,
+    # so it follows a session from one worker thread to the next.
+    def get_owner(self):
+        return getattr(DataBase.owner, 'key', None) or ('thread', threading.get_ident())
+
+    # None goes back to the thread itself
+    def set_owner(self, key):
+        DataBase.owner.key = key
+
+    # The current owner committed on the primary
+    def note_write(self):
+        now = time.monotonic()
+        with DataBase.lock:
+            DataBase.written[self.get_owner()] = now
+            # Owners whose last write is older than MAX_LAG read from replicas again; forget them
+            if len(DataBase.written) > 1000:
+                for owner, at in list(DataBase.written.items()):
+                    if now - at >= DataBase.MAX_LAG:
+                        del DataBase.written[owner]
+
+    # Connection for a read-only view: a replica that is close enough behind (taking turns),
+    # else the primary. An owner that committed on the primary in the last MAX_LAG seconds
+    # reads from the primary, so it sees its own writes.
+    def get_read_connection(self, role):
+        if DataBase.BACKEND != 'postgres' or len(DataBase.REPLICAS) == 0:
+            return self.checkout_connection(role)
+        if time.monotonic() - DataBase.written.get(self.get_owner(), float('-inf')) < DataBase.MAX_LAG:
+            return self.checkout_connection(role)
+
+        first = next(DataBase.replica_turn)
+        for i in range(len(DataBase.REPLICAS)):
+            replica = DataBase.REPLICAS[(first + i) % len(DataBase.REPLICAS)]
+            if self.replica_usable(role, replica):
+                try:
+                    return self.checkout_connection(role, replica)
+                except psycopg2.Error:
+                    DataBase.replica_lag[replica] = (time.monotonic(), None)
+        return self.checkout_connection(role)
+
+    # Whether a replica is reachable and within MAX_LAG (measured at most every LAG_CHECK_INTERVAL)
+    def replica_usable(self, role, replica):
+        checked = DataBase.replica_lag.get(replica)
+        if checked == None or time.monotonic() - checked[0] >= DataBase.LAG_CHECK_INTERVAL:
+            checked = (time.monotonic(), self.measure_lag(role, replica))
+            DataBase.replica_lag[replica] = checked
+        return checked[1] != None and checked[1] <= DataBase.MAX_LAG
+
+    def measure_lag(self, role, replica):
+        try:
+            connection = self.checkout_connection(role, replica)
+        except psycopg2.Error:
+            return None
+        try:
+            cursor = connection.cursor()
+            cursor.execute(DataBase.LAG_QUERY)
+            lag = float(cursor.fetchone()[0])
+            cursor.close()
+            return lag
+        except psycopg2.Error:
+            return None
+        finally:
+            self.release(connection)
+
+    # Give a connection back to its pool (rolls back anything left uncommitted)
+    # close=True closes it instead of keeping it, for a connection that failed (the server went away)
+    def release(self, connection, close=False):
+        held = getattr(DataBase.held, 'connections', [])
+        if connection in held:
+            held.remove(connection)
+        self.get_pool(connection.role, connection.replica).putconn(connection, close=close)
+        metrics.inc('library_pool_in_use', -1, role=connection.role, target=connection.replica or 'primary')
+
+    # Give back every connection this thread still holds
+    # (after a view raised part way through, so its connection is never leaked)
+    def release_all(self):
+        held = getattr(DataBase.held, 'connections', [])
+        while len(held) > 0:
+            self.release(held[-1])
+
+    # Run one of the STATEMENTS, preparing it first if this connection hasn't seen it yet
+    def execute_prepared(self, cursor, name, params=()):
+        connection = cursor.connection
+        # SQLite caches its compiled statements itself, so it runs the text as is
+        if connection.backend == 'sqlite':
+            cursor.execute(DataBase.STATEMENTS[name], params)
+        else:
+            if name not in connection.prepared:
+                cursor.execute("PREPARE " + name + " AS " + DataBase.STATEMENTS[name])
+                connection.prepared.add(name)
+
+            if len(params) == 0:
+                cursor.execute("EXECUTE " + name)
+            else:
+                cursor.execute("EXECUTE " + name + " (" + ", ".join(["%s"] * len(params)) + ")", params)
+
+        with DataBase.lock:
+            DataBase.statement_calls[name] += 1
+
+    # Per-statement EXECUTE counts since the process started
+    def get_statement_calls(self):
+        with DataBase.lock:
+            return dict(DataBase.statement_calls)
     
     # Clean input function (remove ' from input ) for SQL injection defense
+    # (the time spent typing is kept out of the menu action's profile)
     def get_clean_input(self, message):
-        return input(message).replace('\'', '')
+        with profiling.waiting():
+            return input(message).replace('\'', '')
 
     def get_clean_password(self, message):
-        return getpass(prompt=message, stream=None).replace('\'', '')
+        with profiling.waiting():
+            return getpass(prompt=message, stream=None).replace('\'', '')
 
     # Description: can return a query result (one query as a dictionary)
     # This is useful for returning the user information 
@@ -60,55 +299,24 @@ class DataBase():
 
 # Form validation 
 def validate_form(formdata, cursor):
-    firstname = formdata['firstname']
-    lastname  = formdata['lastname']
-    email     = formdata['email']
-    dob       = formdata['dob']
-    password  = formdata['password']
-    conf_pass = formdata['conf_pass']
-    # If anything is empty
-    if len(firstname) == 0 or len(lastname) == 0 or len(dob) == 0 or len(password) == 0:
-        print('Sorry, all fields are required')
-        return False
-    
-    # If the email already exists
-    cursor.execute("SELECT * FROM LibraryUsers WHERE email = %s", [email])
-    if cursor.fetchone() != None:
-        print('Sorry, that email has already been used')
-        return False
-
-    # If email does not have @ or ends in com,org,edu
-    if not email.endswith('com') and not email.endswith('org') and not email.endswith('edu'):
-        print("Invalid email entered")
-        return False
-    if not '@' in email:
-        print("Invalid email entered")
-        return False
-
-    # DOB format should be "MM/DD/YYYY"
     try:
-        datetime.datetime.strptime(dob, FORMAT)
-    except ValueError:
-        print("This is the incorrect date format. It should be DD/MM/YYYY")
-        return False
-
-    # If the passwords don't match
-    if password != conf_pass:
-        print("Sorry, the passwords do not match. Please try again.")
+        services.validate_signup(DataBase(), cursor, formdata)
+    except services.LibraryError as error:
+        print(error.message)
         return False
-    
     return True
 
+def format_date(value):
+    return datetime.datetime.strftime(value, FORMAT)
+
 class Views():
+    @instrumentation.track_view
     def sign_up_view(self):
         # Get DB connection class
         db = DataBase()
 
-        # Get the DB cursor
-        connection = db.get_patron_connection()
-        cursor = connection.cursor()
-
         # Replace ' to prevent SQL injection
+        # (asked before taking a connection, so none sits idle while the user types)
         firstname = db.get_clean_input('Enter first name: ')
         lastname  = db.get_clean_input('Enter last name: ')
         dob       = db.get_clean_input('Enter date of birth: ')
@@ -116,367 +324,245 @@ class Views():
         password  = db.get_clean_password('Enter password: ')
         conf_pass = db.get_clean_password('Confirm password: ')
 
-        # Check if the form is valid
-        valid = validate_form(
-            {
+        # Get the DB cursor
+        connection = db.get_patron_connection()
+        cursor = connection.cursor()
+
+        # Check the form and create the patron
+        try:
+            services.sign_up(db, cursor, {
                 'firstname' : firstname,
                 'lastname'  : lastname,
                 'dob'       : dob,
                 'email'     : email,
                 'password'  : password,
                 'conf_pass' : conf_pass
-            },
-            cursor
-        )
-
-        if valid:
-            # Take the password and hash to get a hashed password (store safely in db)
-            pass_hashed    = hashlib.sha3_512(password.encode())
-            password       = pass_hashed.hexdigest()
-            cursor.execute(
-                """INSERT INTO LibraryUsers(email,firstname,lastname,dob,isadmin,password) 
-                VALUES (%s, %s, %s, %s, %s, %s)""", 
-                (email,firstname,lastname,dob,'N',password)
-            )
-            connection.commit()
+            })
             print('Patron signup successful\n')
+        except services.LibraryError as error:
+            print(error.message)
 
         cursor.close()
-        connection.close()
+        db.release(connection)
 
+    @instrumentation.track_view
     def login_view(self):
         # Get DB connection class
         db = DataBase()
 
-        # Get the DB cursor
-        connection = db.get_patron_connection()
-        cursor = connection.cursor()
-
         # Ask user for email and password
         email    = db.get_clean_input('Email: ')
         password = db.get_clean_password('Password: ')
 
-        # Get user with that email
-        cursor.execute("""SELECT email FROM LibraryUsers WHERE email = %s""",(email,))
-        result = cursor.fetchone() # [email,isadmin]
+        # Get the DB cursor
+        connection = db.get_patron_connection()
+        cursor = connection.cursor()
 
-        if result == None:
-            print('Sorry, we could not authenticate your credentials.')
+        # Return either:
+        #   None                       (unsuccessful login)
+        #   dict with email, isadmin   (if successful login)
+        try:
+            result = services.authenticate(db, cursor, email, password)
+            print('Login successful.\n')
+        except services.LibraryError as error:
+            print(error.message)
             print('Returning to the main menu.\n')
-            return None
-        result = db.result_to_dict(cursor,result) 
-
-        # Take the password and hash to get the hashed password (stored in db)
-        pass_hashed    = hashlib.sha3_512(password.encode())
-        password       = pass_hashed.hexdigest()
-
-        # Get user with that email and password
-        cursor.execute("""SELECT email,isadmin FROM LoginView WHERE email = %s AND password = %s""",(email,password))
-        result = cursor.fetchone() # [email,isadmin]
+            result = None
 
-        # Return the result of the query which is either:
-        #   None         (unsuccessful login)
-        #   query result (if successful login)
-        if result == None:
-            print('Sorry, we could not authenticate your credentials.')
-            print('Returning to the main menu.\n')
-            return None
-        print('Login successful.\n')
-        return db.result_to_dict(cursor,result)
+        cursor.close()
+        db.release(connection)
+        return result
 
+    @instrumentation.track_view
     def assign_book_view(self):
         # Get DB connection class
         db = DataBase()
 
-        # Get the DB cursor
-        connection = db.get_librarian_connection()
-        cursor = connection.cursor()
-
         # Ask user for email and isbn
         print('Assign book: [patron email][book isbn]')
         email    = db.get_clean_input('Patron email: ')
         isbn     = db.get_clean_input('ISBN: ')
 
-        # Get book with that isbn
-        #cursor.execute("""SELECT email,isadmin FROM LibraryUsers WHERE email = %s AND password = %s""",(email,password))
-        cursor.execute("""SELECT * FROM Books WHERE isbn = %s""", (isbn,))
-        book = cursor.fetchone() # result of query
-
-        if book == None:
-            print('Could not find the book.')
-            return None
-        book = db.result_to_dict(cursor,book)       # get attribute -> value
-
-        # Make sure quantity > 0
-        cursor.execute("SELECT * FROM Inventory WHERE isbn = %s", (book['isbn'],))
-        inventory = cursor.fetchone()
-        inventory = db.result_to_dict(cursor,inventory)
-        
-        # get the quantity and make sure the book is available
-        quantity = int(inventory['quantity'])
-        if quantity < 1:
-            # Get the most recent due date for that book
-            cursor.execute("SELECT duedate FROM Borrow WHERE isbn = %s ORDER BY duedate LIMIT 1", (book['isbn'],))
-            query = cursor.fetchone() # not actually duedate it is array[duedate]
-            next_available_date = datetime.datetime.strftime(query[0], FORMAT)
-            print('Sorry, that book is out of stock. It will be available on ' + next_available_date)
-            return None
-
-        # Get user with that email
-        cursor.execute("""SELECT * FROM LibraryUsers WHERE email = %s""", (email,))
-        patron = cursor.fetchone() # result of query
+        # Get the DB cursor
+        connection = db.get_librarian_connection()
+        cursor = connection.cursor()
 
-        # Check if the patron was found
-        if patron == None:
-            print('Could not find the patron.')
-            return None
-        patron = db.result_to_dict(cursor,patron)   # get attribute -> value
-
-        # Format for our dates
-        today = datetime.datetime.today()                       # get today as datetime obj
-        strToday = datetime.datetime.strftime(today, FORMAT)
-        duedate = today + datetime.timedelta(days=14)
-        strDuedate = datetime.datetime.strftime(duedate, FORMAT)
-
-        cursor.execute(
-                """INSERT INTO Borrow(isbn,email,borrowdate,duedate) 
-                VALUES (%s, %s, %s, %s)""", 
-                (book['isbn'],patron['email'],strToday,strDuedate)
-        )
-
-        print('Successfully checked book out to {}. \'{}\' is due on {}.'.format(
-                patron['firstname'] + ' ' + patron['lastname'],book['title'], strDuedate
+        try:
+            loan = services.checkout(db, cursor, email, isbn)
+            print('Successfully checked book out to {}. \'{}\' is due on {}.'.format(
+                    loan['name'], loan['title'], format_date(loan['duedate'])
+                )
             )
-        )
-
-        # Update inventory, setting that book's quantity - 1
-        cursor.execute("UPDATE Inventory SET quantity = quantity - 1 WHERE isbn = %s", (book['isbn'],))
+        except services.LibraryError as error:
+            print(error.message)
 
-        connection.commit()
         cursor.close()
-        connection.close()
+        db.release(connection)
     
+    @instrumentation.track_view
     def process_return_view(self):
         # Get DB connection class
         db = DataBase()
 
-        # Get the DB cursor
-        connection = db.get_librarian_connection()
-        cursor = connection.cursor()
-
         # Ask user for email and isbn
         print('Assign book: [patron email][book isbn]')
         email    = db.get_clean_input('Patron email: ')
         isbn     = db.get_clean_input('ISBN: ')
 
-        # Get book with that isbn
-        cursor.execute("""SELECT * FROM Books WHERE isbn = %s""", (isbn,))
-        book = cursor.fetchone() # result of query
-
-        if book == None:
-            print('Could not find the book.')
-            return None
-        book = db.result_to_dict(cursor,book)       # get attribute -> value
-
-        # Get user with that email
-        cursor.execute("""SELECT * FROM LibraryUsers WHERE email = %s""", (email,))
-        patron = cursor.fetchone() # result of query
-
-        # Check if the patron was found
-        if patron == None:
-            print('Could not find the patron.')
-            return None
-        patron = db.result_to_dict(cursor,patron)   # get attribute -> value
-        
-        # Get the borrowdate and duedate from the borrow record
-        cursor.execute("SELECT * FROM Borrow WHERE email = %s AND isbn = %s", (email,isbn))
-        query = cursor.fetchone()
-
-        # If query is None, then we couldn't find that patron with that book (email,isbn)
-        if query == None:
-            print('Not showing that you have borrowed this book.')
-            print("Please check the email and ISBN again.")
-            return None
-
-        borrow_record = db.result_to_dict(cursor,query)
-
-        today = datetime.date.today()      # date object
-        duedate = borrow_record['duedate'] # date object
-        days_overdue_obj = today - duedate
-        days_overdue = days_overdue_obj.days
-        # Charge them if the book is overdue
-        if(days_overdue > 0):
-            charge = days_overdue * 0.25
-            print('Your book is overdue by {} many days. Charge incurred: ${}'.format(str(days_overdue),str(charge)))
-        else:
-            print('Thank you for returning your book on time. We appreciate it.')
-        
-        # Delete the borrow entry
-        cursor.execute("DELETE FROM Borrow WHERE email = %s AND isbn = %s", (email,isbn))
+        # Get the DB cursor
+        connection = db.get_librarian_connection()
+        cursor = connection.cursor()
 
-        # Update the inventory
-        cursor.execute("UPDATE Inventory SET quantity = quantity + 1 WHERE isbn = %s", (isbn,))
+        try:
+            result = services.process_return(db, cursor, email, isbn)
+            # Charge them if the book is overdue
+            if result['days_overdue'] > 0:
+                print('Your book is overdue by {} many days. Charge incurred: ${}'.format(
+                    str(result['days_overdue']), str(result['charge'])))
+            else:
+                print('Thank you for returning your book on time. We appreciate it.')
+        except services.LibraryError as error:
+            print(error.message)
 
-        connection.commit()
         cursor.close()
-        connection.close()
+        db.release(connection)
     
+    @instrumentation.track_view
     def overdue_books_view(self):
         # Get DB connection class
         db = DataBase()
 
         # Get the DB cursor
-        connection = db.get_librarian_connection()
+        connection = db.get_read_connection('librarian')
         cursor = connection.cursor()
 
         # Get all the books from Borrow that are overdue
-        cursor.execute("SELECT * FROM Borrow WHERE duedate < CURRENT_DATE")
-        query = cursor.fetchall()
-        overduebooks = [db.result_to_dict(cursor,item) for item in query]
-        current_date = datetime.datetime.strftime(datetime.date.today(), FORMAT)
-        print('\n------------------------------------------------')
-        print('Overdue Books (Current Date: {}):'.format(current_date))
-        print('------------------------------------------------')
-        i = 0
-        for book in overduebooks:
-            print('ISBN: '          + book['isbn'])
-            print('Patron Email: '  + book['email'])
-            print('Borrow Date: '   + datetime.datetime.strftime(book['borrowdate'], FORMAT))
-            print('Due Date: '      + datetime.datetime.strftime(book['duedate'], FORMAT))
-            i = i + 1
-            if i != len(query):
-                print('------------------------------------------------')
-        print('\n')
+        overduebooks = services.overdue_books(db, cursor)
+        current_date = format_date(datetime.date.today())
+        Renderer().render('Overdue Books (Current Date: {}):'.format(current_date), overduebooks, [
+            Column('ISBN: ',          'isbn'),
+            Column('Patron Email: ',  'email'),
+            Column('Borrow Date: ',   'borrowdate', 'date'),
+            Column('Due Date: ',      'duedate', 'date'),
+        ])
 
         cursor.close()
-        connection.close()
+        db.release(connection)
 
+    @instrumentation.track_view
     def book_catalog_view(self):
         # Get DB connection class
         db = DataBase()
 
         # Get the DB cursor
-        connection = db.get_librarian_connection()
+        connection = db.get_read_connection('librarian')
         cursor = connection.cursor()
 
         # Get all books
-        cursor.execute("""SELECT title,subject,
-	                            STRING_AGG(
-		                            firstname || ' ' || lastname, ', '
-	                            ) AS Authors,
-                                datepublished,isbn,quantity
-                            FROM Books NATURAL JOIN WrittenBy NATURAL JOIN Authors 
-                            NATURAL JOIN Inventory
-                            GROUP BY ISBN,Title,datepublished,quantity ORDER BY Title""")
-        query = cursor.fetchall()
-        books = [db.result_to_dict(cursor,item) for item in query]
+        books = services.book_catalog(db, cursor)
 
         # Print results
-        print('\n------------------------------------------------')
-        print('Book Catalog: ')
-        print('------------------------------------------------')
-        i = 0
-        for book in books:
-            print('Title: '          + book['title'])
-            print('Subject: '        + book['subject'])
-            print('Author(s): '      + book['authors'])
-            print('Date Published: ' + datetime.datetime.strftime(book['datepublished'], FORMAT))
-            print('ISBN: '           + book['isbn'])
-            print('Quantity: '      + str(book['quantity']) )
-            i = i + 1
-            if i != len(query):
-                print('')
-        print('\n')
+        Renderer().render('Book Catalog: ', books, [
+            Column('Title: ',          'title'),
+            Column('Subject: ',        'subject'),
+            Column('Author(s): ',      'authors'),
+            Column('Date Published: ', 'datepublished', 'date'),
+            Column('ISBN: ',           'isbn'),
+            Column('Quantity: ',       'quantity', 'number'),
+        ], separator='')
 
         cursor.close()
-        connection.close()
+        db.release(connection)
 
+    @instrumentation.track_view
     def registered_patrons_view(self):
         # Get DB connection class
         db = DataBase()
 
         # Get the DB cursor
-        connection = db.get_librarian_connection()
+        connection = db.get_read_connection('librarian')
         cursor = connection.cursor()
 
         # Get all patrons
-        cursor.execute("SELECT * FROM LibraryUsers")
-        query = cursor.fetchall()
-        patrons = [db.result_to_dict(cursor,item) for item in query]
+        patrons = services.registered_patrons(db, cursor)
 
         # Print results
-        print('\n------------------------------------------------')
-        print('Registered Patrons: ')
-        print('------------------------------------------------')
-        i = 0
-        for patron in patrons:
-            print('First Name: ' + patron['firstname'])
-            print('Last Name: '  + patron['lastname'])
-            print('Email: '      + patron['email'])
-            i = i + 1
-            if i != len(query):
-                print('------------------------------------------------')
-        print('\n')
+        Renderer().render('Registered Patrons: ', patrons, [
+            Column('First Name: ', 'firstname'),
+            Column('Last Name: ',  'lastname'),
+            Column('Email: ',      'email'),
+        ])
 
         cursor.close()
-        connection.close()
+        db.release(connection)
     
+    @instrumentation.track_view
     def all_borrowed_books_view(self):
         # Get DB connection class
         db = DataBase()
 
         # Get the DB cursor
-        connection = db.get_librarian_connection()
+        connection = db.get_read_connection('librarian')
         cursor = connection.cursor()
 
-        # Get all the books the user is borrowing
-        cursor.execute("SELECT email,title,borrowdate,duedate,isbn FROM Borrow NATURAL JOIN Books")
-        query = cursor.fetchall()
+        # Get all the books being borrowed
+        books = services.all_borrowed_books(db, cursor)
 
-        # Convert list of tuples, to list of dictionaries
-        books = [db.result_to_dict(cursor,item) for item in query]
+        # Print out the results
+        Renderer().render('All Borrowed Books: ', books, [
+            Column('Patron Email: ', 'email'),
+            Column('Book Title: ',   'title'),
+            Column('Borrow Date: ',  'borrowdate', 'date'),
+            Column('Due Date: ',     'duedate', 'date'),
+            Column('ISBN: ',         'isbn'),
+        ])
+
+        # Close the db connection
+        cursor.close()
+        db.release(connection)
+
+
+    @instrumentation.track_view
+    def dashboard_view(self):
+        # The sections run on their own pooled connections at once
+        sections = services.dashboard(DataBase())
+        counts = sections['counts']
 
-        # Print out the results (print how many days till due, or if overdue)
         print('\n------------------------------------------------')
-        print('All Borrowed Books: ')
+        print('Dashboard (Current Date: {}):'.format(format_date(datetime.date.today())))
         print('------------------------------------------------')
-        i = 0
-        for book in books:
-            print('Patron Email: '    + book['email'])
-            print('Book Title: '      + book['title'])
-            print('Borrow Date: '     + datetime.datetime.strftime(book['borrowdate'], FORMAT))
-            print('Due Date: '        + datetime.datetime.strftime(book['duedate'], FORMAT))
-            print('ISBN: '            + book['isbn'])
-            i = i + 1
-            if i != len(books):
-                print('------------------------------------------------')
-        print('\n')
+        print('Titles: {}    Copies on shelf: {}    Patrons: {}'.format(counts['titles'], counts['on_shelf'], counts['patrons']))
+        print('Books on loan: {}    Overdue: {}'.format(counts['on_loan'], counts['overdue']))
 
-        # Close the db connection
-        cursor.close()
-        connection.close()
+        renderer = Renderer()
+        renderer.render('Most Overdue: ', sections['top_overdue'], [
+            Column('',  lambda book: '{} days  {}  {}  ({})'.format(book['days_overdue'], book['isbn'], book['title'], book['email']), name='overdue'),
+        ], separator=None)
+        renderer.render('Low Stock: ', sections['low_stock'], [
+            Column('',  lambda book: '{} left  {}  {}  {}'.format(book['quantity'], book['branch'], book['isbn'], book['title']), name='stock'),
+        ], separator=None)
+        renderer.render('Recent Checkouts: ', sections['recent_checkouts'], [
+            Column('',  lambda book: '{}  {}  {}  ({})'.format(renderer.format_date(book['borrowdate']), book['isbn'], book['title'], book['email']), name='checkout'),
+        ], separator=None)
 
 
     """  Patron Views  """
-    
-    def search_by_subject_view(self):
-        # Get DB connection class
-        db = DataBase()
 
-        # Get the DB cursor
-        connection = db.get_patron_connection()
+    # Show the subjects and return the one the user picks (None if the selection is invalid)
+    # The connection for the list goes back to the pool before the user is asked
+    def select_subject(self, db, title):
+        connection = db.get_read_connection('patron')
         cursor = connection.cursor()
+        subjects = services.list_subjects(db, cursor)
+        cursor.close()
+        db.release(connection)
 
-        # Get the list of available subjects
-        cursor.execute("SELECT DISTINCT subject FROM Books")
-        query = cursor.fetchall()
-        subjects = [item[0] for item in query]
-
-        print('---------------- Search Menu ----------------')
+        print('---------------- {} ----------------'.format(title))
         print('Select subject: ')
         for i in range(1,len(subjects)+1):
             print(str(i) + ': ' + subjects[i-1])
-        cmd = input('Selection: ')
+        with profiling.waiting():
+            cmd = input('Selection: ')
 
         try:
             cmd = int(cmd)
@@ -485,179 +571,197 @@ class Views():
             return None
 
         # Check that they did not select invalid integer
-        if cmd > len(subjects):
+        if cmd < 1 or cmd > len(subjects):
             print('Sorry, that was not a valid selection.')
             return None
+        return subjects[cmd-1]
+    
+    @instrumentation.track_view
+    def search_by_subject_view(self):
+        # Get DB connection class
+        db = DataBase()
 
         # Get the subject
-        subject = subjects[cmd-1]
-        cursor.execute(  """SELECT title,isbn,
-	                            STRING_AGG(
-		                            firstname || ' ' || lastname, ', '
-	                            ) AS Authors
-                            FROM Books NATURAL JOIN WrittenBy NATURAL JOIN Authors 
-                            WHERE subject = %s GROUP BY ISBN;""", (subject,))
-        query = cursor.fetchall()
-        query = [db.result_to_dict(cursor,item) for item in query]
+        subject = self.select_subject(db, 'Search Menu')
+        if subject == None:
+            return
 
-        print('\n------------------------------------------------')
-        print('Search Results: ')
-        print('------------------------------------------------')
-        i = 0
-        for book in query:
-            print('Title: '  + book['title'])
-            print('Author(s): ' + book['authors'])
-            print('ISBN: '   + book['isbn'])
-            i = i + 1
-            if i != len(query):
-                print('------------------------------------------------')
-        print('\n')
+        # Get the DB cursor
+        connection = db.get_read_connection('patron')
+        cursor = connection.cursor()
+
+        books = services.search_by_subject(db, cursor, subject)
+        Renderer().render('Search Results: ', books, [
+            Column('Title: ',     'title'),
+            Column('Author(s): ', 'authors'),
+            Column('ISBN: ',      'isbn'),
+        ])
 
         cursor.close()
-        connection.close()
+        db.release(connection)
 
+    @instrumentation.track_view
     def search_by_author_view(self):
         # Get DB connection class
         db = DataBase()
 
-        # Get the DB cursor
-        connection = db.get_patron_connection()
-        cursor = connection.cursor()
-
         # Get author last name from user
         author_last_name = db.get_clean_input('Please enter the author\'s last name: ')
 
+        # Get the DB cursor
+        connection = db.get_read_connection('patron')
+        cursor = connection.cursor()
+
         # Get the books written by that author
-        cursor.execute("""SELECT Title, FirstName, LastName, subject, datepublished, ISBN FROM Books 
-                        NATURAL JOIN WrittenBy NATURAL JOIN Authors 
-                        WHERE lastname = %s ORDER BY firstname,lastname""", (author_last_name,))
-        
-        query = cursor.fetchall()
-        if len(query) == 0:
+        books = services.search_by_author(db, cursor, author_last_name)
+        first = next(books, None)
+        if first == None:
             print('Sorry, we do not carry books by that author.\n')
-            return None
+        else:
+            Renderer().render('Search Results: ', itertools.chain([first], books), [
+                Column('Title: ',          'title'),
+                Column('Subject: ',        'subject'),
+                Column('Date Published: ', 'datepublished', 'date'),
+                Column('Author: ',         lambda book: book['firstname'] + ' ' + book['lastname']),
+                Column('ISBN: ',           'isbn'),
+            ])
 
-        query = [db.result_to_dict(cursor,item) for item in query]
+        cursor.close()
+        db.release(connection)
 
-        print('\n------------------------------------------------')
-        print('Search Results: ')
-        print('------------------------------------------------')
-        i = 0
-        for book in query:
-            print('Title: '          + book['title'])
-            print('Subject: '        + book['subject'])
-            print('Date Published: ' + datetime.datetime.strftime(book['datepublished'], FORMAT))
-            print('Author: '         + book['firstname'] + ' ' + book['lastname'])
-            print('ISBN: '           + book['isbn'])
-            i = i + 1
-            if i != len(query):
-                print('------------------------------------------------')
-        print('\n')
+    @instrumentation.track_view
+    def availability_view(self):
+        # Get DB connection class
+        db = DataBase()
+
+        # One or more ISBNs, separated by commas or spaces
+        isbns = db.get_clean_input('ISBN(s): ').replace(',', ' ').split()
+
+        # Get the DB cursor
+        connection = db.get_read_connection('patron')
+        cursor = connection.cursor()
+
+        # Which branches have a copy on the shelf
+        copies = services.available_copies(db, cursor, isbns)
+        Renderer().render('Available Copies: ', [{'isbn': isbn, 'copies': copies.get(isbn, [])} for isbn in isbns], [
+            Column('ISBN: ',      'isbn'),
+            Column('Available: ', lambda book: ', '.join('{} ({})'.format(copy['branch'], copy['quantity']) for copy in book['copies'])
+                                               or 'No copies on the shelf'),
+        ])
 
         cursor.close()
-        connection.close()
+        db.release(connection)
 
+    @instrumentation.track_view
     def borrowed_books_view(self, email):
         # Get DB connection class
         db = DataBase()
 
         # Get the DB cursor
-        connection = db.get_patron_connection()
+        connection = db.get_read_connection('patron')
         cursor = connection.cursor()
 
         # Get all the books the user is borrowing
-        cursor.execute("SELECT title,duedate FROM Borrow NATURAL JOIN Books WHERE email = %s", (email,))
-        query = cursor.fetchall()
-
-        # Convert list of tuples, to list of dictionaries
-        query = [db.result_to_dict(cursor,item) for item in query]
+        books = services.borrowed_books(db, cursor, email)
 
         # Print out the results (print how many days till due, or if overdue)
-        print('\n------------------------------------------------')
-        print('My Borrowed Books: ')
-        print('------------------------------------------------')
-        i = 0
-        for book in query:
-            today = datetime.date.today()               # date object
-            days_overdue_obj = today - book['duedate']  # date - date
-            days_overdue = days_overdue_obj.days
-
-            print('Title: '     + book['title'])
+        def status(book):
+            days_overdue = book['days_overdue']
             # If the book is overdue
             if days_overdue > 0:
-                charge = days_overdue * 0.25
-                print('Your book is overdue. Please return as soon as possible.')
-                print('Current overdue charge: {}'.format(charge))
+                return ('Your book is overdue. Please return as soon as possible.\n'
+                        'Current overdue charge: {}'.format(book['charge']))
             elif days_overdue == 0:
-                print('Your book is due today. Please return')
-                print('by 11:59 PM to avoid incurring an overdue charge.')
-            else:
-                print('This book is due in {} days.'.format( str(days_overdue*-1) ))
-            i = i + 1
-            if i != len(query):
-                print('------------------------------------------------')
-        print('\n')
+                return ('Your book is due today. Please return\n'
+                        'by 11:59 PM to avoid incurring an overdue charge.')
+            return 'This book is due in {} days.'.format(str(days_overdue*-1))
+
+        Renderer().render('My Borrowed Books: ', books, [
+            Column('Title: ', 'title'),
+            Column('',        status, name='status'),
+        ])
 
         # Close the db connection
         cursor.close()
-        connection.close()
+        db.release(connection)
 
+    @instrumentation.track_view
     def book_recommendation_view(self):
         # Get DB connection class
         db = DataBase()
 
+        # Get the subject and a random book in it
+        subject = self.select_subject(db, 'Book Recommendation')
+        if subject == None:
+            return
+
         # Get the DB cursor
-        connection = db.get_patron_connection()
+        connection = db.get_read_connection('patron')
         cursor = connection.cursor()
 
-        # Get the list of available subjects
-        cursor.execute("SELECT DISTINCT subject FROM Books")
-        query = cursor.fetchall()
-        subjects = [item[0] for item in query]
-
-        print('---------------- Book Recommendation ----------------')
-        print('Select subject: ')
-        for i in range(1,len(subjects)+1):
-            print(str(i) + ': ' + subjects[i-1])
-        cmd = input('Selection: ')
-
-        try:
-            cmd = int(cmd)
-        except ValueError:
-            print('Sorry, that was not a valid selection.')
-            return None
-
-        # Check that they did not select invalid integer
-        if cmd > len(subjects):
-            print('Sorry, that was not a valid selection.')
-            return None
-        
-        # Get the subject
-        subject = subjects[cmd-1]
-        cursor.execute("""SELECT Title, FirstName, LastName, ISBN FROM Books 
-                          NATURAL JOIN WrittenBy NATURAL JOIN Authors 
-                          WHERE subject = %s ORDER BY RANDOM() LIMIT 1""", (subject,))
-
-        query = cursor.fetchone()
-        book = db.result_to_dict(cursor,query)
+        book = services.recommend(db, cursor, subject)
 
         # Print out the recommended book
-        print('\n------------------------------------------------')
-        print('Here is your recommendation: ')
-        print('------------------------------------------------')
-        print('Title: '  + book['title'])
-        print('Author: ' + book['firstname'] + ' ' + book['lastname'])
-        print('ISBN: '   + book['isbn'])
-        print('\n')
+        if book == None:
+            print('Sorry, we do not have a recommendation in that subject.\n')
+        else:
+            print('\n------------------------------------------------')
+            print('Here is your recommendation: ')
+            print('------------------------------------------------')
+            print('Title: '  + book['title'])
+            print('Author: ' + book['firstname'] + ' ' + book['lastname'])
+            print('ISBN: '   + book['isbn'])
+            print('\n')
+
         # Close the db connection
         cursor.close()
-        connection.close()        
+        db.release(connection)
+
+# Set the session data for a logged in user (result has 'email' and 'isadmin')
+def start_session(session_data, result):
+    # Save the appropriate user type in session_data
+    if result['isadmin'] == 'Y':
+        # Set the user type to librarian
+        session_data['user']  = UserType.LIBRARIAN
+    elif result['isadmin'] == 'N':
+        # Set the user type to patron
+        session_data['user'] = UserType.PATRON
+
+    # Save the user email in session_data (email is pk in LibraryUsers table)
+    session_data['email'] = result['email']
+
+# End the session and go back to the anonymous menu
+def logout(store, session_data):
+    import sessions
+
+    store.revoke(session_data['token'])
+    sessions.clear_token()
+    session_data.clear()
+    session_data['user'] = UserType.ANONYMOUS
+    print('Logged out.\n')
+
+def MainLoop(profile_dir=None):
+    import sessions
+
+    # Profile each menu action when asked to (--profile or LIBRARY_PROFILE_DIR)
+    profiler = profiling.Profiler(profile_dir or profiling.PROFILE_DIR)
 
-def MainLoop():
     # Session to hold any session data for keeping track of system state
     session_data = {}
     session_data['user'] = UserType.ANONYMOUS
 
+    # Resume this terminal's session if it has a live token
+    store = sessions.SessionStore()
+    token = sessions.load_token()
+    if token != None:
+        result = store.resume(token)
+        if result == None:
+            sessions.clear_token()
+        else:
+            start_session(session_data, result)
+            session_data['token'] = token
+            print('Welcome back, {}.\n'.format(result['email']))
+
     # While user has not quit, run the main loop
     run_loop = True
 
@@ -670,35 +774,31 @@ def MainLoop():
             print('2: Login')
             print('q: quit')
             cmd = input('Selection: ')
-            
-            if cmd == '1':
-                print('Send to sign up view')
-                view = Views()
-                view.sign_up_view()
-            if cmd == '2':
-                print('Send to login view')
-                view = Views()
-
-                # Get result of logging in as a dictionary with email and isadmin
-                result = view.login_view() # keys are 'email' and 'isadmin'
-                if result == None:
-                    # This means the user was not logged in successfully
-                    continue
-
-                # Set the session data for the logged in user
-                # Save the appropriate user type in session_data
-                if result['isadmin'] == 'Y':
-                    # Set the user type to librarian
-                    session_data['user']  = UserType.LIBRARIAN
-                elif result['isadmin'] == 'N':
-                    # Set the user type to patron
-                    session_data['user'] = UserType.PATRON
-
-                # Save the user email in session_data (email is pk in LibraryUsers table)
-                session_data['email'] = result['email']
-            elif cmd == 'q':
-                run_loop = False
-                print('Goodbye.')
+
+            with profiler.action('anonymous', cmd):
+                if cmd == '1':
+                    print('Send to sign up view')
+                    view = Views()
+                    view.sign_up_view()
+                if cmd == '2':
+                    print('Send to login view')
+                    view = Views()
+
+                    # Get result of logging in as a dictionary with email and isadmin
+                    result = view.login_view() # keys are 'email' and 'isadmin'
+                    if result == None:
+                        # This means the user was not logged in successfully
+                        continue
+
+                    # Set the session data for the logged in user
+                    start_session(session_data, result)
+
+                    # Keep a token so the next run of this terminal can resume
+                    session_data['token'] = store.create(result['email'], result['isadmin'])
+                    sessions.save_token(session_data['token'])
+                elif cmd == 'q':
+                    run_loop = False
+                    print('Goodbye.')
 
         # Librarian User menu
         if session_data['user']== UserType.LIBRARIAN:
@@ -710,31 +810,42 @@ def MainLoop():
             print('4: View registered patrons') # Extra feature -DONE
             print('5: View borrowed books')     # Last Feature  -
             print('6: View overdue books')      # Extra feature -DONE
+            print('7: View query statistics')
+            print('8: View dashboard')
+            print('l: logout')
             print('q: quit')
             cmd = input('Selection: ')
 
-            if cmd   == '1':
-                view = Views()
-                view.assign_book_view()
-            elif cmd == '2':
-                view = Views()
-                view.process_return_view()
-            elif cmd == '3':
-                view = Views()
-                view.book_catalog_view()
-            elif cmd == '4':
-                print('View registered patrons')
-                view = Views()
-                view.registered_patrons_view()
-            elif cmd == '5':
-                view = Views()
-                view.all_borrowed_books_view()
-            elif cmd == '6':
-                view = Views()
-                view.overdue_books_view()
-            elif cmd == 'q':
-                run_loop = False
-                print('Goodbye.')
+            with profiler.action('librarian', cmd):
+                if cmd   == '1':
+                    view = Views()
+                    view.assign_book_view()
+                elif cmd == '2':
+                    view = Views()
+                    view.process_return_view()
+                elif cmd == '3':
+                    view = Views()
+                    view.book_catalog_view()
+                elif cmd == '4':
+                    print('View registered patrons')
+                    view = Views()
+                    view.registered_patrons_view()
+                elif cmd == '5':
+                    view = Views()
+                    view.all_borrowed_books_view()
+                elif cmd == '6':
+                    view = Views()
+                    view.overdue_books_view()
+                elif cmd == '7':
+                    instrumentation.print_stats()
+                elif cmd == '8':
+                    view = Views()
+                    view.dashboard_view()
+                elif cmd == 'l':
+                    logout(store, session_data)
+                elif cmd == 'q':
+                    run_loop = False
+                    print('Goodbye.')
         
         # Patron User Menu
         if session_data['user'] == UserType.PATRON:
@@ -744,28 +855,44 @@ def MainLoop():
             print('2: Search by author')            # Main feature  -DONE
             print('3: View my borrowed books')      # Extra feature -DONE
             print('4: Get a book recommendation')   # Extra feature -DONE
+            print('5: Find an available copy')
+            print('l: logout')
             print('q: quit')
             cmd = input('Selection: ')
 
-            if cmd   == '1':
-                view = Views()
-                view.search_by_subject_view()
-            elif cmd == '2':
-                view = Views()
-                view.search_by_author_view()
-            elif cmd == '3':
-                view = Views()
-                view.borrowed_books_view(email=session_data['email'])
-            elif cmd == '4':
-                view = Views()
-                view.book_recommendation_view()
-            elif cmd == 'q':
-                run_loop = False
-                print('Goodbye.')
+            with profiler.action('patron', cmd):
+                if cmd   == '1':
+                    view = Views()
+                    view.search_by_subject_view()
+                elif cmd == '2':
+                    view = Views()
+                    view.search_by_author_view()
+                elif cmd == '3':
+                    view = Views()
+                    view.borrowed_books_view(email=session_data['email'])
+                elif cmd == '4':
+                    view = Views()
+                    view.book_recommendation_view()
+                elif cmd == '5':
+                    view = Views()
+                    view.availability_view()
+                elif cmd == 'l':
+                    logout(store, session_data)
+                elif cmd == 'q':
+                    run_loop = False
+                    print('Goodbye.')
 
             
 # Run the Main event loop
-MainLoop()
+# (only when run as a script, so the other tools can import from main)
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Library terminal')
+    parser.add_argument('--profile', metavar='DIR', help='profile each menu action into DIR (also LIBRARY_PROFILE_DIR)')
+    args = parser.parse_args()
+    metrics.serve_from_environment()
+    MainLoop(args.profile)
 
 # Project Overview
 
@@ -794,4 +921,4 @@ MainLoop()
         # Delete the borrow entry (INSERT)
     # View all emails
     # View all books
-    # View overdue books and who has them
\ No newline at end of file
+    # View overdue books and who has them
@@ -0,0 +1,197 @@
+import os
+import sys
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Metrics
+# Counters, gauges and latency histograms from the circulation and search paths, served in the
+# Prometheus text format on localhost:
+#
+#     LIBRARY_METRICS_PORT=9108 python terminal_server.py      (or main.py, http_api.py, scanner.py)
+#     curl http://127.0.0.1:9108/metrics
+#
+# Rates come from Prometheus, e.g. rate(library_checkouts_total[1m]) for checkouts per second.
+#
+# Updates are cheap enough for the hot path: every thread adds into its own dicts, which only that
+# thread writes, so inc() and observe() take no lock. A scrape adds the threads' dicts up (and
+# folds in the counts of threads that have finished). Values that are easier to read than to
+# track, like the size of a cache, are gauges read by a function at scrape time.
+
+METRICS_PORT = os.environ.get('LIBRARY_METRICS_PORT')
+METRICS_HOST = '127.0.0.1'
+
+# Histogram bucket upper bounds (seconds)
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+# name -> (type, help); every metric sent is listed here
+DESCRIPTIONS = {
+    'library_checkouts_total'         : ('counter',   'Books checked out'),
+    'library_returns_total'           : ('counter',   'Books returned'),
+    'library_checkout_failures_total' : ('counter',   'Checkouts refused or failed, by reason'),
+    'library_searches_total'          : ('counter',   'Catalog searches, by kind'),
+    'library_sessions_started_total'  : ('counter',   'Logins that started a session'),
+    'library_sessions_active'         : ('gauge',     'Sessions open now, by server'),
+    'library_pool_in_use'             : ('gauge',     'Connections checked out of a pool'),
+    'library_pool_waiting'            : ('gauge',     'Requests waiting for an HTTP API worker slot'),
+    'library_pool_exhausted_total'    : ('counter',   'Connection checkouts refused because every pool connection was out'),
+    'library_pool_errors_total'       : ('counter',   'Failed connection checkouts for other reasons (database unreachable...)'),
+    'library_cache_requests_total'    : ('counter',   'Cache lookups, by cache and result (hit or miss)'),
+    'library_db_seconds'              : ('histogram', 'Database round trip latency, by statement'),
+}
+
+# One thread's counts
+class Shard():
+    def __init__(self, thread):
+        self.thread = thread
+        self.values = {}        # (name, labels) -> number
+        self.histograms = {}    # (name, labels) -> [count per bucket..., count above the last, sum]
+
+    def merge(self, other):
+        for key, value in list(other.values.items()):
+            self.values[key] = self.values.get(key, 0) + value
+        for key, counts in list(other.histograms.items()):
+            mine = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, count in enumerate(list(counts)):
+                mine[i] += count
+
+shards = []                 # the live threads' shards
+retired = Shard(None)       # counts of threads that have finished
+registry_lock = threading.Lock()
+local = threading.local()
+gauges = {}                 # name -> function returning a number or {labels: number}
+
+# Finished threads' shards are folded into `retired` at each scrape, and also when this many
+# have been registered (servers that start a thread per request may never be scraped)
+RETIRE_AT = 256
+retire_at = RETIRE_AT
+
+# Fold the shards of finished threads into `retired` (with registry_lock held)
+def retire_finished():
+    live = []
+    for current in shards:
+        if current.thread.is_alive():
+            live.append(current)
+        else:
+            retired.merge(current)
+    shards[:] = live
+
+def shard():
+    global retire_at
+    current = getattr(local, 'shard', None)
+    if current == None:
+        current = Shard(threading.current_thread())
+        with registry_lock:
+            shards.append(current)
+            if len(shards) >= retire_at:
+                retire_finished()
+                retire_at = max(RETIRE_AT, 2 * len(shards))
+        local.shard = current
+    return current
+
+# Add to a counter (or, with a negative amount, a gauge kept by +1/-1)
+def inc(name, amount=1, **labels):
+    values = shard().values
+    key = (name, tuple(sorted(labels.items())))
+    values[key] = values.get(key, 0) + amount
+
+# Record one latency (seconds) in a histogram
+def observe(name, seconds, **labels):
+    histograms = shard().histograms
+    key = (name, tuple(sorted(labels.items())))
+    counts = histograms.get(key)
+    if counts == None:
+        counts = histograms[key] = [0] * (len(BUCKETS) + 2)
+    counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+    counts[-1] += seconds
+
+# A gauge read at scrape time; function returns a number or {labels tuple: number}
+def register_gauge(name, function):
+    gauges[name] = function
+
+# Everything so far as one Shard
+def collect():
+    total = Shard(None)
+    with registry_lock:
+        retire_finished()
+        total.merge(retired)
+        for current in shards:
+            total.merge(current)
+    return total
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+def format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+# The Prometheus text exposition of every metric
+def render():
+    total = collect()
+    series = {}     # name -> [(labels, value)]
+    for (name, labels), value in total.values.items():
+        series.setdefault(name, []).append((labels, value))
+    for name, function in list(gauges.items()):
+        try:
+            value = function()
+        except Exception:
+            continue
+        if not isinstance(value, dict):
+            value = {(): value}
+        series.setdefault(name, []).extend(value.items())
+
+    lines = []
+    for name in sorted(set(series) | set(key[0] for key in total.histograms)):
+        kind, text = DESCRIPTIONS.get(name, ('untyped', name))
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in sorted(series.get(name, [])):
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_number(value)))
+        for (histogram, labels), counts in sorted(total.histograms.items()):
+            if histogram != name:
+                continue
+            seen = 0
+            for bound, count in zip(BUCKETS + ['+Inf'], counts[:-1]):
+                seen += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', str(bound)),)), seen))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_number(round(counts[-1], 6))))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), seen))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/metrics', '/']:
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics from a daemon thread; returns the server
+def serve(port, host=METRICS_HOST):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+# Start the endpoint if LIBRARY_METRICS_PORT is set (called by each program's entry point)
+def serve_from_environment():
+    if METRICS_PORT:
+        server = serve(int(METRICS_PORT))
+        sys.stderr.write('Metrics on http://{}:{}/metrics\n'.format(*server.server_address[:2]))
+        return server
+    return None
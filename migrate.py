@@ -0,0 +1,85 @@
+import os
+import glob
+import argparse
+
+import branches
+import sqlite_backend
+from temp_postgres import schema_statements, ROOT
+
+# Schema migrations
+# Brings an existing database up to the current LibraryCreateQueries.txt: first Inventory and
+# Borrow are made branch-aware (branches.migrate, a no-op once done), then SQL Queries/Migrations
+# holds numbered .sql files for everything else (a new database created from that file has them
+# already; they are written with IF [NOT] EXISTS, so applying them there changes nothing). Each
+# file is applied once, in name order, in its own transaction, and recorded in SchemaMigrations.
+#
+#     python migrate.py --db "dbname=bookstore user=postgres"
+#     python migrate.py --db sqlite:library.db
+#     python migrate.py --list
+#
+# On Postgres --db must connect as the tables' owner. The SQL is translated for SQLite the same
+# way the schema file is, leaving out grants and plpgsql triggers (SQLite's own triggers come
+# from sqlite_backend.TRIGGERS when the file is next opened).
+
+MIGRATIONS_DIR = os.path.join(ROOT, 'SQL Queries', 'Migrations')
+
+# name -> path of every migration file, in the order they are applied
+def migration_files():
+    paths = sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql')))
+    return [(os.path.basename(path), path) for path in paths]
+
+def applied_migrations(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS SchemaMigrations(
+                          Name VARCHAR(100) PRIMARY KEY,
+                          AppliedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)""")
+    cursor.execute("SELECT name FROM SchemaMigrations")
+    return set(row[0] for row in cursor.fetchall())
+
+# Apply the migrations not applied yet; returns their names
+def migrate(connection):
+    done = []
+    # The .sql files index Borrow by branch
+    if branches.migrate(connection):
+        done.append('branches (Inventory and Borrow by branch)')
+    for name, path in migration_files():
+        cursor = connection.cursor()
+        try:
+            if connection.backend == 'sqlite':
+                cursor.execute("BEGIN IMMEDIATE")
+            if name in applied_migrations(cursor):
+                connection.rollback()
+                continue
+            for statement in schema_statements(path):
+                if connection.backend == 'sqlite' and sqlite_backend.postgres_only(statement):
+                    continue
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO SchemaMigrations(name) VALUES (%s)", (name,))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        done.append(name)
+    return done
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply the schema migrations in SQL Queries/Migrations')
+    parser.add_argument('--db', help='sqlite:PATH or a Postgres DSN (default: the librarian connection)')
+    parser.add_argument('--list', action='store_true', help='show which migrations are applied and stop')
+    args = parser.parse_args()
+
+    connection = branches.connect(args.db)
+    if args.list:
+        cursor = connection.cursor()
+        applied = applied_migrations(cursor)
+        cursor.close()
+        connection.commit()
+        for name, path in migration_files():
+            print('{:<10} {}'.format('applied' if name in applied else 'pending', name))
+    else:
+        done = migrate(connection)
+        for name in done:
+            print('Applied ' + name)
+        if len(done) == 0:
+            print('Nothing to apply')
@@ -0,0 +1,150 @@
+import sys
+import json
+import argparse
+
+import psycopg2
+
+import datagen
+from main import DataBase
+from temp_postgres import TempPostgres
+from benchmarks.views import SCALES
+
+# Query plan checks
+# Loads a synthetic dataset (datagen) into a throwaway Postgres, runs EXPLAIN on each hot query
+# the views and the HTTP API send and fails if the planner doesn't use the index the query was
+# given in LibraryCreateQueries.txt. Plans depend on table sizes (on the sample data every table
+# fits in a page and a sequential scan wins), so the check loads a benchmark scale first.
+#
+#     python plan_check.py                       (the "medium" scale: 100k books, 500k loans)
+#     python plan_check.py --scale large
+#
+# Only the table a query starts from is checked; joining the rest with a hash join is the
+# planner's call. When a query or its index changes, update its entry here in the same change.
+
+# (name, prepared statement or SQL, parameters, indexes it may start from)
+# Prepared statements are EXPLAINed as EXECUTEd by DataBase.execute_prepared; the SQL ones are
+# the queries in services.py.
+CHECKS = [
+    ('book_by_isbn',             'book_by_isbn',            ['isbn'],            ['books_pkey']),
+    ('user_by_email',            'user_by_email',           ['email'],           ['libraryusers_pkey']),
+    ('email_in_use',             'email_in_use',            ['email'],           ['libraryusers_email_lower_index']),
+    ('login_by_email',           'login_by_email',          ['email'],           ['libraryusers_email_lower_index']),
+    ('user_for_checkout',        'user_for_checkout',       ['email'],           ['libraryusers_pkey']),
+    ('inventory_by_branch_isbn', 'inventory_by_branch_isbn', ['branch', 'isbn'], ['inventory_pk']),
+    ('borrow_by_email_isbn',     'borrow_by_email_isbn',    ['email', 'isbn', 'branch'], ['bw_pk']),
+    ('next_due_by_branch_isbn',  'next_due_by_branch_isbn', ['branch', 'isbn'],  ['borrow_isbn_index']),
+    ('search_by_subject',        'search_by_subject',       ['subject'],         ['books_subject_index']),
+    ('search_by_author',         'search_by_author',        ['lastname'],        ['authors_lastname_index']),
+    ('recommend_by_subject',     'recommend_by_subject',    ['subject'],         ['books_subject_index']),
+    ('borrowed_books',
+     "SELECT title,duedate FROM Borrow NATURAL JOIN Books WHERE email = %s",
+     ['email'], ['bw_pk']),
+    ('available_copies',
+     """SELECT isbn,branch,quantity FROM Inventory
+        WHERE isbn IN (%s, %s) AND quantity > 0 ORDER BY isbn,branch""",
+     ['isbn', 'other_isbn'], ['inventory_available_index', 'inventory_pk']),
+    ('top_overdue',
+     """SELECT isbn,title,email,duedate,CURRENT_DATE - duedate AS days_overdue
+        FROM Borrow NATURAL JOIN Books WHERE duedate < CURRENT_DATE
+        ORDER BY duedate LIMIT 10""",
+     [], ['borrow_duedate_index']),
+    ('recent_checkouts',
+     """SELECT isbn,title,email,borrowdate,duedate FROM Borrow NATURAL JOIN Books
+        ORDER BY borrowdate DESC LIMIT 10""",
+     [], ['borrow_borrowdate_index']),
+]
+
+# Plan nodes that read a table
+SCAN_NODES = ['Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Index Scan']
+
+def load(server, books, loans):
+    datagen.copy_to_database(datagen.Generator(books, max(1, books // 2), max(1, loans // 5), loans))
+    connection = psycopg2.connect(server.dsn())
+    connection.autocommit = True
+    # VACUUM sets the visibility map, so index-only scans are costed as they would be in production
+    connection.cursor().execute("VACUUM ANALYZE")
+    connection.close()
+
+# Values for the parameters, taken from the loaded data
+def parameters(cursor):
+    cursor.execute("SELECT branch, isbn, email FROM Borrow ORDER BY duedate LIMIT 1")
+    branch, isbn, email = cursor.fetchone()
+    # Another book on the shelf somewhere, or any other book if every copy is out
+    cursor.execute("SELECT isbn FROM Inventory WHERE quantity > 0 AND isbn <> %s LIMIT 1", (isbn,))
+    row = cursor.fetchone()
+    if row == None:
+        cursor.execute("SELECT isbn FROM Books WHERE isbn <> %s LIMIT 1", (isbn,))
+        row = cursor.fetchone()
+    other_isbn = row[0]
+    cursor.execute("SELECT subject FROM Books LIMIT 1")
+    subject = cursor.fetchone()[0]
+    cursor.execute("SELECT lastname FROM Authors LIMIT 1")
+    lastname = cursor.fetchone()[0]
+    return {'branch': branch, 'isbn': isbn, 'other_isbn': other_isbn, 'email': email,
+            'subject': subject, 'lastname': lastname}
+
+def explain(cursor, name, query, values):
+    if query in DataBase.STATEMENTS:
+        cursor.execute("PREPARE check_{} AS {}".format(name, DataBase.STATEMENTS[query]))
+        execute = "EXECUTE check_{}".format(name)
+        if len(values) > 0:
+            execute += '(' + ', '.join(['%s'] * len(values)) + ')'
+        cursor.execute("EXPLAIN (FORMAT JSON) " + execute, values)
+    else:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + query, values)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+# (node type, table, index) of every scan in a plan, in plan order
+def scans(node):
+    found = []
+    if node['Node Type'] in SCAN_NODES:
+        found.append((node['Node Type'], node.get('Relation Name'), node.get('Index Name')))
+    for child in node.get('Plans', []):
+        found += scans(child)
+    return found
+
+# A partition's index is named after the partition; report the partitioned index it belongs to
+def parent_index(cursor, index):
+    cursor.execute("""SELECT parent.relname FROM pg_inherits i
+                      JOIN pg_class child ON child.oid = i.inhrelid
+                      JOIN pg_class parent ON parent.oid = i.inhparent
+                      WHERE child.relname = %s AND child.relkind = 'i'""", (index,))
+    row = cursor.fetchone()
+    return row[0] if row != None else index
+
+def run(books, loans):
+    failures = 0
+    with TempPostgres(load_sample=False) as server:
+        load(server, books, loans)
+        connection = psycopg2.connect(server.dsn())
+        cursor = connection.cursor()
+        values = parameters(cursor)
+        for name, query, names, expected in CHECKS:
+            plan = explain(cursor, name, query, [values[key] for key in names])
+            used = [(node, table, parent_index(cursor, index) if index != None else None)
+                    for node, table, index in scans(plan)]
+            indexes = [index for node, table, index in used if index != None]
+            ok = any(index in expected for index in indexes)
+            print('{:<4} {:<26} {}'.format('ok' if ok else 'FAIL', name,
+                  ', '.join('{} {}'.format(node, index or table) for node, table, index in used)))
+            if not ok:
+                print('       expected a scan of ' + ' or '.join(expected))
+                failures = failures + 1
+        cursor.close()
+        connection.close()
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the hot queries use their indexes at scale')
+    parser.add_argument('--scale', default='medium', choices=sorted(SCALES))
+    args = parser.parse_args()
+
+    books, loans = SCALES[args.scale]
+    failures = run(books, loans)
+    if failures > 0:
+        print('\n{} query plan problem(s)'.format(failures))
+        sys.exit(1)
+    print('\nAll hot queries use their indexes')
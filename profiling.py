@@ -0,0 +1,192 @@
+import os
+import re
+import glob
+import json
+import time
+import pstats
+import cProfile
+import argparse
+import datetime
+import threading
+import contextlib
+import tracemalloc
+from collections import defaultdict
+
+import instrumentation
+
+# Profiling per menu action
+# With LIBRARY_PROFILE_DIR set (or python main.py --profile DIR) every menu action MainLoop
+# dispatches runs under cProfile and tracemalloc, and leaves two files in the directory, named
+# <session>-<number>-<view>:
+#     .prof   the cProfile stats (python -m pstats FILE, or any pstats viewer)
+#     .json   wall and CPU time, peak traced memory and the top allocation sites still held
+#             when the action finished
+# Time spent waiting for the user at a prompt (see waiting) is left out of the wall time and the
+# cProfile stats and reported on its own as input_ms.
+# The summary adds them up per view across a session (or every session in the directory):
+#
+#     python profiling.py summary profiles/
+#     python profiling.py summary profiles/ --session 20261019-101500-4242 --view book_catalog_view
+#
+# Only the thread running the menu is profiled (the dashboard's query threads are not), and
+# tracemalloc makes allocation-heavy code several times slower, so compare profiles with each
+# other rather than with timings taken without it.
+
+PROFILE_DIR = os.environ.get('LIBRARY_PROFILE_DIR')
+
+# Allocation sites kept per action, and rows the summary prints
+TOP_SITES = 25
+TOP_ROWS = 20
+
+# Frames kept per allocation (1: just the line that allocated)
+TRACE_FRAMES = 1
+
+# tracemalloc's own allocations and imports aren't the action's
+IGNORED = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+]
+
+# The action being profiled on this thread: (cProfile.Profile, [seconds waited for input])
+current = threading.local()
+
+# Wrap a prompt: while the user types, the action's profile is paused and the time is counted as input
+@contextlib.contextmanager
+def waiting():
+    action = getattr(current, 'action', None)
+    if action == None:
+        yield
+        return
+    profile, waited = action
+    profile.disable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        waited[0] += time.perf_counter() - start
+        profile.enable()
+
+# A view name or menu option made safe to use in a file name ('x/y' -> 'x_y')
+def file_name(name):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', name)[:60]
+
+class Profiler():
+    # directory None: actions run as they are, nothing is recorded
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.session = '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid())
+        self.actions = 0
+        if directory != None:
+            os.makedirs(directory, exist_ok=True)
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+
+    # Profile one menu dispatch; the files are named after the view it ran (or menu-option)
+    @contextlib.contextmanager
+    def action(self, menu, option):
+        if self.directory == None or option == 'q':
+            yield
+            return
+
+        before = instrumentation.get_last_call()
+        tracemalloc.clear_traces()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        waited = [0.0]
+        started = datetime.datetime.now()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        current.action = (profile, waited)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            current.action = None
+            wall = time.perf_counter() - wall - waited[0]
+            cpu = time.process_time() - cpu
+            retained, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED)
+
+            last = instrumentation.get_last_call()
+            if last != None and last is not before:
+                name = last['view']
+            else:
+                name = '{}-{}'.format(menu, option)
+            self.actions += 1
+            path = os.path.join(self.directory, '{}-{:03d}-{}'.format(self.session, self.actions, file_name(name)))
+            profile.dump_stats(path + '.prof')
+            with open(path + '.json', 'w') as jsonfile:
+                json.dump({
+                    'session'     : self.session,
+                    'number'      : self.actions,
+                    'view'        : name,
+                    'menu'        : menu,
+                    'option'      : option,
+                    'started'     : started.isoformat(timespec='seconds'),
+                    'wall_ms'     : round(wall * 1000, 3),
+                    'input_ms'    : round(waited[0] * 1000, 3),
+                    'cpu_ms'      : round(cpu * 1000, 3),
+                    'peak_kb'     : round(peak / 1024, 1),
+                    'retained_kb' : round(retained / 1024, 1),
+                    'sites'       : [{'site': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                                      'kb': round(stat.size / 1024, 1), 'count': stat.count}
+                                     for stat in snapshot.statistics('lineno')[:TOP_SITES]],
+                }, jsonfile, indent=1)
+
+# The .json records in a directory (one session's, or all), oldest first
+def load_actions(directory, session=None, view=None):
+    actions = []
+    for path in sorted(glob.glob(os.path.join(directory, (session or '') + '*.json'))):
+        with open(path) as jsonfile:
+            action = json.load(jsonfile)
+        if view == None or action['view'] == view:
+            action['profile'] = path[:-len('.json')] + '.prof'
+            actions.append(action)
+    return actions
+
+def print_summary(actions, top=TOP_ROWS):
+    sessions = sorted(set(action['session'] for action in actions))
+    print('{} actions in {} session(s): {}'.format(len(actions), len(sessions), ', '.join(sessions)))
+
+    print('\n{:<28} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('view', 'calls', 'wall ms', 'cpu ms', 'max wall', 'peak KB', 'input ms'))
+    views = defaultdict(list)
+    for action in actions:
+        views[action['view']].append(action)
+    for name, calls in sorted(views.items(), key=lambda item: -sum(call['wall_ms'] for call in item[1])):
+        print('{:<28} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            name, len(calls), sum(call['wall_ms'] for call in calls), sum(call['cpu_ms'] for call in calls),
+            max(call['wall_ms'] for call in calls), max(call['peak_kb'] for call in calls),
+            sum(call.get('input_ms', 0) for call in calls)))
+
+    # Memory still held at the end of each action, added up per allocating line
+    sites = defaultdict(lambda: [0.0, 0])
+    for action in actions:
+        for site in action['sites']:
+            sites[site['site']][0] += site['kb']
+            sites[site['site']][1] += site['count']
+    print('\nTop allocation sites (KB held at the end of the actions, summed):')
+    for site, (kb, count) in sorted(sites.items(), key=lambda item: -item[1][0])[:top]:
+        print('{:>10.1f} KB {:>8} blocks  {}'.format(kb, count, site))
+
+    profiles = [action['profile'] for action in actions if os.path.exists(action['profile'])]
+    if len(profiles) > 0:
+        print('\nTop functions by cumulative time:')
+        pstats.Stats(*profiles).strip_dirs().sort_stats('cumulative').print_stats(top)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the per-action profiles written by main.py --profile')
+    commands = parser.add_subparsers(dest='command', required=True)
+    summary = commands.add_parser('summary', help='add up the profiles per view')
+    summary.add_argument('directory', nargs='?', default=PROFILE_DIR or '.', help='profile directory (default: LIBRARY_PROFILE_DIR)')
+    summary.add_argument('--session', help='only this session (the file name prefix)')
+    summary.add_argument('--view', help='only this view (or menu-option)')
+    summary.add_argument('--top', type=int, default=TOP_ROWS, help='allocation sites and functions to show')
+    args = parser.parse_args()
+
+    actions = load_actions(args.directory, args.session, args.view)
+    if len(actions) == 0:
+        print('No profiles in ' + args.directory)
+    else:
+        print_summary(actions, args.top)
@@ -0,0 +1,122 @@
+import sys
+
+import instrumentation
+from main import Views
+from temp_postgres import TempPostgres
+from benchmarks.scripted import ScriptedInput, scripted
+
+# Query budgets
+# Every view has a budget of statements and round trips (statements plus the commit or the
+# rollback that ends the transaction) per call. This runs each view with scripted input against a
+# throwaway Postgres and fails if a view goes over its budget, or sends the same statement more
+# than once in one call (a query inside a row loop).
+#
+#     python query_budget.py
+#
+# Each scenario runs twice and the second (warm) run is checked. PREPAREs never count against the
+# budget: they happen once per pooled connection, and a warm call can still land on a connection
+# the dashboard's parallel queries added to the pool.
+# When a view legitimately needs another query, raise its budget here in the same change.
+
+# view -> (statements, round trips)
+# (the subject views end the subject list's transaction before asking, hence a second round trip;
+# the dashboard's sections run on their own connections, each ended by a rollback)
+BUDGETS = {
+    'sign_up_view'             : (3, 4),
+    'login_view'               : (1, 2),
+    'assign_book_view'         : (6, 7),
+    'process_return_view'      : (6, 7),
+    'overdue_books_view'       : (1, 2),
+    'book_catalog_view'        : (1, 2),
+    'registered_patrons_view'  : (1, 2),
+    'all_borrowed_books_view'  : (1, 2),
+    'search_by_subject_view'   : (2, 4),
+    'search_by_author_view'    : (2, 3),
+    'borrowed_books_view'      : (1, 2),
+    'book_recommendation_view' : (2, 4),
+    'availability_view'        : (1, 2),
+    'dashboard_view'           : (4, 8),
+}
+
+# Statements that end a transaction (round trips, not statements)
+TRANSACTION_END = ['COMMIT', 'ROLLBACK']
+
+PATRON_PASSWORD = 'budget-password'
+ISBN = '9780679745259'      # in Tables/Books.csv
+LASTNAME = 'Bloom'          # in Tables/Authors.csv
+
+# (view, scripted answers, keyword arguments) for one pass; round is 0 (cold) or 1 (warm)
+def scenarios(round):
+    email = 'budget{}@example.com'.format(round)
+    return [
+        ('sign_up_view',             ['Budget', 'Patron', '01/01/2000', email, PATRON_PASSWORD, PATRON_PASSWORD], {}),
+        ('login_view',               [email, PATRON_PASSWORD], {}),
+        ('assign_book_view',         [email, ISBN], {}),
+        ('borrowed_books_view',      [], {'email': email}),
+        ('all_borrowed_books_view',  [], {}),
+        ('overdue_books_view',       [], {}),
+        ('process_return_view',      [email, ISBN], {}),
+        ('book_catalog_view',        [], {}),
+        ('registered_patrons_view',  [], {}),
+        ('search_by_subject_view',   ['1'], {}),
+        ('search_by_author_view',    [LASTNAME], {}),
+        ('book_recommendation_view', ['1'], {}),
+        ('availability_view',        [ISBN + ', 9780060540425'], {}),
+        ('dashboard_view',           [], {}),
+    ]
+
+# Check one view call against its budget; returns a list of problems
+def check_call(view, call):
+    problems = []
+    prepares = sum(count for sql, count in call['statements'].items() if sql.startswith('PREPARE '))
+    statements = sum(count for sql, count in call['statements'].items() if sql not in TRANSACTION_END) - prepares
+    round_trips = call['round_trips'] - prepares
+    max_statements, max_round_trips = BUDGETS[view]
+    if statements > max_statements:
+        problems.append('{} statements (budget {})'.format(statements, max_statements))
+    if round_trips > max_round_trips:
+        problems.append('{} round trips (budget {})'.format(round_trips, max_round_trips))
+    for sql, count in call['statements'].items():
+        if sql not in TRANSACTION_END and count > 1:
+            problems.append('sent {} times in one call (query inside a row loop?): {}'.format(count, sql[:80]))
+    return statements, round_trips, problems
+
+def run():
+    failures = 0
+    answers = ScriptedInput()
+    # The report is printed after scripted(), which sends stdout to a throwaway buffer
+    report = []
+    with TempPostgres():
+        with scripted(answers):
+            for round in range(2):
+                for view, script, kwargs in scenarios(round):
+                    answers.clear()
+                    answers.feed(*script)
+                    getattr(Views(), view)(**kwargs)
+                    if round == 0:
+                        continue
+
+                    call = instrumentation.get_last_call()
+                    statements, round_trips, problems = check_call(view, call)
+                    status = 'FAIL' if len(problems) > 0 else 'ok'
+                    report.append('{:<4} {:<26} {:>3} statements {:>3} round trips'.format(
+                        status, view, statements, round_trips))
+                    for problem in problems:
+                        report.append('       ' + problem)
+                    failures = failures + len(problems)
+    for line in report:
+        print(line)
+
+    # Every view must have been exercised
+    missing = set(BUDGETS) - set(view for view, script, kwargs in scenarios(1))
+    for view in sorted(missing):
+        print('FAIL {:<26} has a budget but no scenario'.format(view))
+        failures = failures + 1
+    return failures
+
+if __name__ == '__main__':
+    failures = run()
+    if failures > 0:
+        print('\n{} query budget problem(s)'.format(failures))
+        sys.exit(1)
+    print('\nAll views within their query budgets')
@@ -0,0 +1,237 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import changelog
+from main import DataBase
+
+# Inventory reconciliation
+# Inventory.quantity is a counter kept up by checkouts and returns; if one fails partway (or a sync
+# conflict clamps a delta) it drifts. For every (branch, isbn) this checks
+#
+#     quantity = copies - open Borrow rows from that branch
+#
+# with one set-based query per ISBN range, and repairs the rows that don't match:
+#     fewer copies than loans        copies = loans, quantity = 0                           (copies)
+#     anything else                  quantity = copies - loans                              (quantity)
+#     loans but no Inventory row     a row with copies = loans, quantity = 0               (missing)
+#
+# Rows whose copies are unknown (NULL) can't be checked: they are only reported (unknown). With
+# --baseline they get copies = quantity + loans, taking the counts as they stand, drift included
+# (baseline); count the shelf first, or run it once right after the Copies column was added.
+#
+# The ISBN keyspace is split into ranges that worker processes take in turn. Repairs are written
+# REPAIR_BATCH rows per statement, each only if the row (and its loan count) still has the values
+# that were read, so checkouts can carry on during a run; rows that changed are left for the next
+# run. Every repair is recorded in InventoryAudit under the run id and in the change log (so
+# branches get it too), in the batch's transaction. The change log entry carries the repaired
+# copies count itself, so a branch that never knew Copies (NULL) learns it.
+#
+#     python reconcile.py                       (workers: one per CPU)
+#     python reconcile.py --workers 8 --ranges 64 --dry-run
+#     python reconcile.py --baseline
+
+# Rows per repair statement (and transaction)
+REPAIR_BATCH = 1000
+
+# ISBN ranges per worker (more ranges than workers evens out uneven ranges)
+RANGES_PER_WORKER = 4
+
+# (branch, isbn, quantity, copies, loans) for the rows in [first, last] that don't add up
+DRIFT_QUERY = """SELECT COALESCE(i.branch, b.branch), COALESCE(i.isbn, b.isbn), i.quantity, i.copies, COALESCE(b.loans, 0)
+                 FROM (SELECT branch,isbn,quantity,copies FROM Inventory WHERE isbn BETWEEN %s AND %s) AS i
+                 FULL JOIN (SELECT branch,isbn,COUNT(*) AS loans FROM Borrow
+                            WHERE isbn BETWEEN %s AND %s GROUP BY branch,isbn) AS b
+                 ON b.branch = i.branch AND b.isbn = i.isbn
+                 WHERE i.isbn IS NULL OR i.copies IS NULL OR i.quantity <> i.copies - COALESCE(b.loans, 0)"""
+
+# Update rows whose quantity, copies and loan count are still what was read
+# VALUES columns: branch, isbn, old quantity, old copies, loans, new quantity, new copies
+REPAIR_UPDATE = """UPDATE Inventory AS i
+                   SET quantity = CAST(v.column6 AS INTEGER), copies = CAST(v.column7 AS INTEGER)
+                   FROM (VALUES {}) AS v
+                   WHERE i.branch = v.column1 AND i.isbn = v.column2
+                     AND i.quantity = CAST(v.column3 AS INTEGER)
+                     AND i.copies IS NOT DISTINCT FROM CAST(v.column4 AS INTEGER)
+                     AND (SELECT COUNT(*) FROM Borrow b WHERE b.branch = i.branch AND b.isbn = i.isbn) = CAST(v.column5 AS INTEGER)
+                   RETURNING branch, isbn"""
+
+REPAIR_INSERT = """INSERT INTO Inventory(branch,isbn,quantity,copies) VALUES {}
+                   ON CONFLICT (branch,isbn) DO NOTHING RETURNING branch, isbn"""
+
+AUDIT_INSERT = """INSERT INTO InventoryAudit(runid,branch,isbn,oldquantity,newquantity,oldcopies,newcopies,loans,reason)
+                  VALUES {}"""
+
+def run_id():
+    return '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S'), os.getpid())
+
+# Split [first, last] into about `count` ranges of ISBNs (inclusive bounds, as 13 digit strings)
+def split_ranges(first, last, count):
+    if not (first.isdigit() and last.isdigit() and len(first) == len(last)):
+        return [(first, last)]
+    low, high = int(first), int(last)
+    step = max((high - low + 1) // count, 1)
+    ranges = []
+    start = low
+    while start <= high:
+        end = min(start + step - 1, high)
+        if high - end < step // 2:
+            end = high      # no sliver at the end
+        ranges.append((str(start).zfill(len(first)), str(end).zfill(len(first))))
+        start = end + 1
+    return ranges
+
+def isbn_bounds(cursor):
+    bounds = []
+    for table in ['Inventory', 'Borrow']:
+        cursor.execute("SELECT MIN(isbn), MAX(isbn) FROM {}".format(table))
+        first, last = cursor.fetchone()
+        if first != None:
+            bounds.append((first.strip(), last.strip()))
+    if len(bounds) == 0:
+        return None
+    return min(first for first, last in bounds), max(last for first, last in bounds)
+
+# The repair for one drifted row: (new quantity, new copies, reason)
+# Unknown copies get no repair (None, None) unless `baseline` says to take the counts as they stand
+def repair(quantity, copies, loans, baseline=False):
+    if quantity == None:
+        return 0, loans, 'missing'
+    if copies == None and not baseline:
+        return None, None, 'unknown'
+    if copies == None:
+        return quantity, quantity + loans, 'baseline'
+    if copies < loans:
+        return 0, loans, 'copies'
+    return copies - loans, copies, 'quantity'
+
+def values_list(rows, width):
+    return ', '.join(['(' + ', '.join(['%s'] * width) + ')'] * len(rows))
+
+# Write one batch of repairs with its audit rows and change log entries; returns the rows repaired
+def write_batch(connection, run, batch):
+    cursor = connection.cursor()
+    try:
+        updates = [row for row in batch if row['quantity'] != None]
+        inserts = [row for row in batch if row['quantity'] == None]
+        done = set()
+        if len(updates) > 0:
+            params = []
+            for row in updates:
+                params += [row['branch'], row['isbn'], row['quantity'], row['copies'], row['loans'],
+                           row['new_quantity'], row['new_copies']]
+            cursor.execute(REPAIR_UPDATE.format(values_list(updates, 7)), params)
+            done.update((branch, isbn.strip()) for branch, isbn in cursor.fetchall())
+        if len(inserts) > 0:
+            params = []
+            for row in inserts:
+                params += [row['branch'], row['isbn'], row['new_quantity'], row['new_copies']]
+            cursor.execute(REPAIR_INSERT.format(values_list(inserts, 4)), params)
+            done.update((branch, isbn.strip()) for branch, isbn in cursor.fetchall())
+
+        repaired = [row for row in batch if (row['branch'], row['isbn']) in done]
+        if len(repaired) > 0:
+            params = []
+            changes = []
+            for row in repaired:
+                params += [run, row['branch'], row['isbn'], row['quantity'], row['new_quantity'],
+                           row['copies'], row['new_copies'], row['loans'], row['reason']]
+                changes.append(('Inventory', 'U', changelog.row_key(row['branch'], row['isbn']), {
+                    'isbn'       : row['isbn'],
+                    'branch'     : row['branch'],
+                    'delta'      : row['new_quantity'] - (row['quantity'] or 0),
+                    'copies'     : row['new_copies'] - (row['copies'] or 0),
+                    'set_copies' : row['new_copies'],
+                }))
+            cursor.execute(AUDIT_INSERT.format(values_list(repaired, 9)), params)
+            changelog.record(cursor, changes)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return repaired
+
+# Check and repair one ISBN range (in a worker process); returns a Counter of results
+def reconcile_range(run, first, last, dry_run=False, batch_size=REPAIR_BATCH, baseline=False):
+    db = DataBase()
+    connection = db.get_librarian_connection()
+    totals = Counter()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(DRIFT_QUERY, (first, last, first, last))
+        drifted = []
+        for branch, isbn, quantity, copies, loans in cursor.fetchall():
+            new_quantity, new_copies, reason = repair(quantity, copies, loans, baseline)
+            drifted.append({'branch': branch, 'isbn': isbn.strip(), 'quantity': quantity, 'copies': copies,
+                            'loans': loans, 'new_quantity': new_quantity, 'new_copies': new_copies, 'reason': reason})
+        cursor.close()
+        connection.rollback()
+
+        totals['drifted'] += len(drifted)
+        for row in drifted:
+            totals['drifted ' + row['reason']] += 1
+        repairable = [row for row in drifted if row['reason'] != 'unknown']
+        if not dry_run:
+            for start in range(0, len(repairable), batch_size):
+                batch = repairable[start:start + batch_size]
+                repaired = write_batch(connection, run, batch)
+                totals['repaired'] += len(repaired)
+                totals['skipped'] += len(batch) - len(repaired)
+    finally:
+        db.release(connection)
+    return totals
+
+def reconcile(workers=None, ranges=None, dry_run=False, batch_size=REPAIR_BATCH, baseline=False):
+    workers = workers or os.cpu_count() or 1
+    run = run_id()
+
+    db = DataBase()
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+    bounds = isbn_bounds(cursor)
+    cursor.close()
+    db.release(connection)
+    totals = Counter()
+    if bounds == None:
+        return run, totals
+
+    # Forked workers must not share the parent's connections
+    for pool in DataBase.pools.values():
+        pool.closeall()
+    DataBase.pools.clear()
+
+    isbn_ranges = split_ranges(bounds[0], bounds[1], ranges or workers * RANGES_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = [executor.submit(reconcile_range, run, first, last, dry_run, batch_size, baseline) for first, last in isbn_ranges]
+        for result in results:
+            totals.update(result.result())
+    totals['ranges'] = len(isbn_ranges)
+    return run, totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check Inventory against copies and open loans, and repair it')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--ranges', type=int, help='ISBN ranges (default: {} per worker)'.format(RANGES_PER_WORKER))
+    parser.add_argument('--batch', type=int, default=REPAIR_BATCH, help='repairs per statement')
+    parser.add_argument('--dry-run', action='store_true', help='report the drift without repairing it')
+    parser.add_argument('--baseline', action='store_true', help='set unknown copies to quantity + loans (the counts as they stand)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    run, totals = reconcile(args.workers, args.ranges, args.dry_run, args.batch, args.baseline)
+    seconds = time.perf_counter() - start
+    reasons = ', '.join('{} {}'.format(totals[key], key[len('drifted '):]) for key in sorted(totals) if key.startswith('drifted '))
+    sys.stderr.write('Run {}: {} ranges in {:.1f}s, {} rows drifted{}\n'.format(
+        run, totals['ranges'], seconds, totals['drifted'], ' (' + reasons + ')' if reasons else ''))
+    if not args.dry_run:
+        sys.stderr.write('{} repaired, {} changed during the run (left for the next one); see InventoryAudit\n'.format(
+            totals['repaired'], totals['skipped']))
+    if totals['drifted unknown'] > 0:
+        sys.stderr.write('{} rows with unknown copies left as they are (--baseline sets them from the current counts)\n'.format(
+            totals['drifted unknown']))
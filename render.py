@@ -0,0 +1,124 @@
+import io
+import os
+import sys
+import csv
+import json
+
+from services import FORMAT
+
+# Report rendering
+# Views hand a row iterator and a list of columns to a Renderer, which formats the rows in
+# batches and writes each batch to the output stream in one write (instead of a print() per field).
+# Dates are formatted once per distinct date.
+#
+#     LIBRARY_OUTPUT_FORMAT=csv python main.py     (text, csv or json)
+#
+# text is the layout the menus have always printed; csv and json print just the rows
+# (for piping a report into a file or another program).
+
+FORMATS = ['text', 'csv', 'json']
+
+OUTPUT_FORMAT = os.environ.get('LIBRARY_OUTPUT_FORMAT', 'text')
+
+# Rows formatted per write
+BATCH_ROWS = int(os.environ.get('LIBRARY_RENDER_BATCH', 500))
+
+RULE = '------------------------------------------------'
+
+# A report column: label in the text layout, the row key (or a function of the row)
+# and how to format it ('text', 'date' or 'number'). name is the CSV/JSON field name.
+class Column():
+    def __init__(self, label, key, kind='text', name=None):
+        self.label = label
+        self.key = key
+        self.kind = kind
+        self.name = name or (key if isinstance(key, str) else label.rstrip(': ').lower().replace(' ', '_'))
+
+class Renderer():
+    def __init__(self, format=None, stream=None, batch_rows=None):
+        self.format = format or OUTPUT_FORMAT
+        if self.format not in FORMATS:
+            raise ValueError('Unknown output format: ' + self.format)
+        self.stream = stream
+        self.batch_rows = batch_rows or BATCH_ROWS
+        self.dates = {}     # date -> formatted text
+
+    # sys.stdout is looked up on every write, so redirected output (terminal server, scripted runs) works
+    def write(self, text):
+        (self.stream or sys.stdout).write(text)
+
+    def format_date(self, value):
+        text = self.dates.get(value)
+        if text == None:
+            text = value.strftime(FORMAT)
+            self.dates[value] = text
+        return text
+
+    def value(self, row, column):
+        value = column.key(row) if callable(column.key) else row[column.key]
+        if value == None:
+            return ''
+        if column.kind == 'date':
+            return self.format_date(value)
+        if column.kind == 'number':
+            return value if self.format == 'json' else str(value)
+        return value
+
+    # Render rows (any iterable of dicts) and return how many there were
+    def render(self, title, rows, columns, separator=RULE):
+        if self.format == 'csv':
+            count = self.render_csv(rows, columns)
+        elif self.format == 'json':
+            count = self.render_json(rows, columns)
+        else:
+            count = self.render_text(title, rows, columns, separator)
+        (self.stream or sys.stdout).flush()
+        return count
+
+    # The menu layout: a title block, then 'Label: value' lines per row with a separator between rows
+    # (separator None for none at all)
+    def render_text(self, title, rows, columns, separator):
+        parts = ['\n' + RULE + '\n' + title + '\n' + RULE + '\n']
+        count = 0
+        for row in rows:
+            if count > 0 and separator != None:
+                parts.append(separator + '\n')
+            for column in columns:
+                parts.append(column.label + self.value(row, column) + '\n')
+            count = count + 1
+            if count % self.batch_rows == 0:
+                self.write(''.join(parts))
+                parts = []
+        parts.append('\n\n')
+        self.write(''.join(parts))
+        return count
+
+    def render_csv(self, rows, columns):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([column.name for column in columns])
+        count = 0
+        for row in rows:
+            writer.writerow([self.value(row, column) for column in columns])
+            count = count + 1
+            if count % self.batch_rows == 0:
+                self.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+        self.write(buffer.getvalue())
+        return count
+
+    # One JSON array, one row per line
+    def render_json(self, rows, columns):
+        parts = ['[']
+        count = 0
+        for row in rows:
+            record = {column.name: self.value(row, column) for column in columns}
+            parts.append(('\n' if count == 0 else ',\n') + json.dumps(record))
+            count = count + 1
+            if count % self.batch_rows == 0:
+                self.write(''.join(parts))
+                parts = []
+        parts.append('\n]\n')
+        self.write(''.join(parts))
+        return count
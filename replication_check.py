@@ -0,0 +1,182 @@
+import sys
+import time
+import contextlib
+import threading
+
+import psycopg2
+
+from main import DataBase, Views
+from temp_postgres import TempPostgres
+from benchmarks.scripted import ScriptedInput, NullWriter, scripted
+
+# Read routing check
+# Starts a throwaway Postgres with a streaming hot standby and checks that DataBase sends
+#     the read-only views to the replica (where a write would fail),
+#     reads right after a write to the primary (read your writes), for the same owner on any thread,
+#     reads to the primary while the replica is more than MAX_LAG behind or unreachable.
+#
+#     python replication_check.py
+#
+# Needs initdb, pg_ctl and pg_basebackup (see temp_postgres.py).
+
+ISBN = '9780679745259'      # in Tables/Books.csv
+LASTNAME = 'Bloom'          # in Tables/Authors.csv
+PASSWORD = 'replica-password'
+
+# view -> scripted answers; the views that only read
+READ_VIEWS = [
+    ('overdue_books_view',       [], {}),
+    ('book_catalog_view',        [], {}),
+    ('registered_patrons_view',  [], {}),
+    ('all_borrowed_books_view',  [], {}),
+    ('search_by_subject_view',   ['1'], {}),
+    ('search_by_author_view',    [LASTNAME], {}),
+    ('book_recommendation_view', ['1'], {}),
+]
+
+# Notes where every connection a view takes comes from (None for the primary)
+@contextlib.contextmanager
+def connections_used(used):
+    checkout = DataBase.checkout_connection
+    def recording(self, role, replica=None):
+        used.append(replica)
+        return checkout(self, role, replica)
+    DataBase.checkout_connection = recording
+    try:
+        yield used
+    finally:
+        DataBase.checkout_connection = checkout
+
+def wait_for_replay(server, timeout=30):
+    primary = psycopg2.connect(server.dsn())
+    cursor = primary.cursor()
+    cursor.execute("SELECT pg_current_wal_lsn()")
+    lsn = cursor.fetchone()[0]
+    primary.close()
+
+    replica = psycopg2.connect(server.replica_dsn())
+    replica.autocommit = True
+    cursor = replica.cursor()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        cursor.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (lsn,))
+        if cursor.fetchone()[0]:
+            replica.close()
+            return
+        time.sleep(0.1)
+    replica.close()
+    raise RuntimeError('The replica did not catch up in {}s'.format(timeout))
+
+def forget_writes():
+    DataBase.written.clear()
+
+# Run a view with its output thrown away (the check results still print)
+def run_view(view, **kwargs):
+    with contextlib.redirect_stdout(NullWriter()):
+        getattr(Views(), view)(**kwargs)
+
+# Where a read connection comes from on another thread working for owner
+def read_place(owner):
+    places = []
+    def read():
+        db = DataBase()
+        db.set_owner(owner)
+        connection = db.get_read_connection('patron')
+        places.append(connection.replica)
+        db.release(connection)
+        db.set_owner(None)
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    return places[0]
+
+def check(failures, ok, message):
+    print('{:<4} {}'.format('ok' if ok else 'FAIL', message))
+    return failures + (0 if ok else 1)
+
+def run():
+    failures = 0
+    answers = ScriptedInput()
+    with TempPostgres() as server:
+        replica = server.start_replica()
+        DataBase.LAG_CHECK_INTERVAL = 0
+        wait_for_replay(server)
+        db = DataBase()
+
+        with scripted(answers, quiet=False):
+            # Read-only views go to the replica
+            for view, script, kwargs in READ_VIEWS:
+                forget_writes()
+                answers.clear()
+                answers.feed(*script)
+                with connections_used([]) as used:
+                    run_view(view, **kwargs)
+                failures = check(failures, len(used) > 0 and all(place == replica for place in used),
+                                 '{} reads from the replica'.format(view))
+
+            # A write, then reads from the same thread: primary
+            email = 'replica@example.com'
+            answers.clear()
+            answers.feed('Replica', 'Patron', '01/01/2000', email, PASSWORD, PASSWORD)
+            run_view('sign_up_view')
+            db.set_owner(('terminal', 'desk-1'))
+            answers.feed(email, ISBN)
+            run_view('assign_book_view')
+            with connections_used([]) as used:
+                run_view('borrowed_books_view', email=email)
+            failures = check(failures, used == [None], 'borrowed_books_view right after a checkout reads from the primary')
+            db.set_owner(None)
+
+            # The same session on another worker thread still reads from the primary; others don't
+            failures = check(failures, read_place(('terminal', 'desk-1')) == None,
+                             'the writing session reads from the primary on another thread')
+            failures = check(failures, read_place(('terminal', 'desk-2')) == replica,
+                             'another session reads from the replica')
+
+        # Once the write is old and replayed, back to the replica
+        wait_for_replay(server)
+        forget_writes()
+        connection = db.get_read_connection('patron')
+        failures = check(failures, connection.replica == replica, 'reads go back to the replica after MAX_LAG')
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM Borrow WHERE email = %s", (email,))
+        failures = check(failures, cursor.fetchone()[0] == 1, 'the replica has the checkout')
+        cursor.close()
+        db.release(connection)
+
+        # Replay paused with writes waiting: the replica is behind, so the primary
+        standby = psycopg2.connect(server.replica_dsn())
+        standby.autocommit = True
+        standby.cursor().execute("SELECT pg_wal_replay_pause()")
+        primary = psycopg2.connect(server.dsn())
+        primary.cursor().execute("UPDATE Inventory SET quantity = quantity WHERE isbn = %s", (ISBN,))
+        primary.commit()
+        primary.close()
+        saved_lag = DataBase.MAX_LAG
+        DataBase.MAX_LAG = 0.5
+        time.sleep(1)
+        connection = db.get_read_connection('patron')
+        failures = check(failures, connection.replica == None, 'reads go to the primary while the replica lags')
+        db.release(connection)
+        standby.cursor().execute("SELECT pg_wal_replay_resume()")
+        standby.close()
+        DataBase.MAX_LAG = saved_lag
+
+        # An unreachable replica is skipped
+        DataBase.REPLICAS.insert(0, '{}:{}'.format(server.directory, 1))
+        DataBase.replica_lag.clear()
+        wait_for_replay(server)
+        places = []
+        for i in range(4):
+            connection = db.get_read_connection('patron')
+            places.append(connection.replica)
+            db.release(connection)
+        failures = check(failures, all(place == replica for place in places), 'an unreachable replica is skipped')
+    return failures
+
+if __name__ == '__main__':
+    failures = run()
+    if failures > 0:
+        print('\n{} read routing problem(s)'.format(failures))
+        sys.exit(1)
+    print('\nRead routing works')
@@ -0,0 +1,428 @@
+import sys
+import time
+import queue
+import argparse
+import datetime
+import threading
+import socketserver
+
+import psycopg2
+
+import changelog
+import metrics
+import services
+from main import DataBase
+from services import FORMAT, LOAN_DAYS, InvalidRequest
+
+# Desk scanner stream
+# Circulation for barcode scanners: one event per line,
+#
+#     checkout patron@example.com 9780679745259
+#     return patron@example.com 9780679745259
+#
+# read from stdin or from TCP connections, and one reply line per event, in order:
+#
+#     ok checkout patron@example.com 9780679745259 due 11/02/2026
+#     error checkout patron@example.com 9780000000000 Could not find the book.
+#
+# Instead of a lookup-and-commit cycle per event, events are committed in groups: a group closes
+# after GROUP_SIZE events or GROUP_WAIT_MS after its first event, whichever comes first. Each group
+# costs a few set-based lookups (books, patrons, stock and loans for all its events), a few batched
+# writes and one commit, while the next group's events are read in. Replies go out only after the
+# commit returns, so an acknowledged event is durable (with the default synchronous_commit).
+# Events that fail (unknown book, out of stock...) are answered with the same messages as the
+# desk views and don't affect the rest of their group. If a group's transaction fails as a whole
+# (say a desk took the last copy at the same moment) its events are replayed one at a time. If the
+# connection itself failed (the database restarted, say) it is closed and a fresh one is taken from
+# the pool first.
+#
+#     python scanner.py < scans.txt
+#     python scanner.py --port 7100 --group 200 --wait-ms 10      (nc localhost 7100)
+
+# Events per commit
+GROUP_SIZE = 100
+
+# Longest an event waits for its group to fill up (ms)
+GROUP_WAIT_MS = 20
+
+OPERATIONS = ['checkout', 'return']
+
+# One scanned event and where its reply goes
+# (error is set for a line that could not be parsed: it is answered in its turn, never committed)
+class Event():
+    def __init__(self, op, email, isbn, reply, error=None):
+        self.op = op
+        self.email = email
+        self.isbn = isbn
+        self.reply = reply
+        self.error = error
+        self.result = None
+        self.done = threading.Event()
+
+    def finish(self, result, detail):
+        self.result = result
+        self.reply('{} {} {} {} {}\n'.format(result, self.op, self.email, self.isbn, detail.replace('\n', ' ')))
+        self.done.set()
+
+    def succeed(self, detail):
+        self.finish('ok', detail)
+
+    def fail(self, message):
+        self.finish('error', message)
+
+    # Answer a line that could not be parsed
+    def reject(self):
+        self.result = 'error'
+        self.reply('error {}\n'.format(self.error))
+        self.done.set()
+
+# "checkout email isbn" -> (op, email, isbn)
+def parse(line):
+    words = line.replace('\'', '').split()
+    if len(words) != 3 or words[0].lower() not in OPERATIONS:
+        raise InvalidRequest('Expected "checkout EMAIL ISBN" or "return EMAIL ISBN"')
+    return words[0].lower(), words[1], words[2]
+
+def placeholders(count, width=1):
+    if width == 1:
+        return ', '.join(['%s'] * count)
+    return ', '.join(['(' + ', '.join(['%s'] * width) + ')'] * count)
+
+class GroupCommitter():
+    def __init__(self, branch=None, group_size=GROUP_SIZE, wait_ms=GROUP_WAIT_MS):
+        self.branch = branch or services.BRANCH
+        self.group_size = group_size
+        self.wait = wait_ms / 1000
+        self.events = queue.Queue()
+        self.db = DataBase()
+        self.connection = None
+        self.stats = {'events': 0, 'groups': 0, 'failed': 0, 'replayed': 0}
+
+    def submit(self, event):
+        self.events.put(event)
+
+    # No more events after the ones already submitted
+    def close(self):
+        self.events.put(None)
+
+    # Commit groups until close(); runs on its own thread
+    def run(self):
+        self.connection = self.db.get_librarian_connection()
+        try:
+            closed = False
+            while not closed:
+                first = self.events.get()
+                if first == None:
+                    break
+                group = [first]
+                deadline = time.monotonic() + self.wait
+                while len(group) < self.group_size:
+                    try:
+                        event = self.events.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if event == None:
+                        closed = True
+                        break
+                    group.append(event)
+                self.process(group)
+        finally:
+            if self.connection != None:
+                self.db.release(self.connection)
+
+    # A cursor on the committer's connection, taking a fresh connection if the last one was dropped
+    def cursor(self):
+        if self.connection == None:
+            self.connection = self.db.get_librarian_connection()
+        return self.connection.cursor()
+
+    # Undo a failed transaction. A connection that failed itself is closed and dropped (rolling it
+    # back would only fail again); the next cursor() takes a fresh one from the pool.
+    def recover(self, error):
+        if self.connection == None:
+            return
+        if not isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            try:
+                self.connection.rollback()
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pass
+        self.db.release(self.connection, close=True)
+        self.connection = None
+
+    def process(self, group):
+        events = [event for event in group if event.error == None]
+        outcomes = []
+        if len(events) > 0:
+            try:
+                cursor = self.cursor()
+                try:
+                    outcomes = self.commit_group(cursor, events)
+                finally:
+                    cursor.close()
+            except Exception as error:
+                self.recover(error)
+                outcomes = None
+
+        self.stats['groups'] += 1
+        self.stats['events'] += len(group)
+        if outcomes == None:
+            self.stats['replayed'] += len(events)
+            self.replay(group)
+            return
+        # Replies in the order the lines came in
+        outcomes = iter(outcomes)
+        for event in group:
+            if event.error != None:
+                self.stats['failed'] += 1
+                event.reject()
+                continue
+            ok, text, reason = next(outcomes)
+            if ok:
+                metrics.inc('library_checkouts_total' if event.op == 'checkout' else 'library_returns_total', branch=self.branch)
+                event.succeed(text)
+            else:
+                if event.op == 'checkout':
+                    metrics.inc('library_checkout_failures_total', reason=reason)
+                self.stats['failed'] += 1
+                event.fail(text)
+
+    # One event at a time through services (each commits on its own)
+    def replay(self, group):
+        for event in group:
+            if event.error != None:
+                self.stats['failed'] += 1
+                event.reject()
+                continue
+            try:
+                cursor = self.cursor()
+                try:
+                    if event.op == 'checkout':
+                        loan = services.checkout(self.db, cursor, event.email, event.isbn, branch=self.branch)
+                        event.succeed('due ' + loan['duedate'].strftime(FORMAT))
+                    else:
+                        result = services.process_return(self.db, cursor, event.email, event.isbn, branch=self.branch)
+                        event.succeed(return_detail(result['days_overdue'], result['charge']))
+                finally:
+                    cursor.close()
+            except services.LibraryError as error:
+                self.recover(error)
+                self.stats['failed'] += 1
+                event.fail(error.message)
+            except Exception as error:
+                self.recover(error)
+                self.stats['failed'] += 1
+                event.fail('Sorry, something went wrong: {}'.format(error))
+
+    # Decide and write a whole group in one transaction; returns [(ok, text, failure reason)] per event
+    def commit_group(self, cursor, group):
+        branch = self.branch
+        isbns = sorted(set(event.isbn for event in group))
+        emails = sorted(set(event.email for event in group))
+
+        cursor.execute("SELECT isbn,title FROM Books WHERE isbn IN ({})".format(placeholders(len(isbns))), isbns)
+        titles = {isbn.strip(): title for isbn, title in cursor.fetchall()}
+        # Patrons locked (in email order) like services.checkout does, so no desk at any branch can
+        # lend them one of these books between the loan lookup below and the commit
+        # (SQLite has one writer at a time and drops the FOR ... UPDATE)
+        cursor.execute("SELECT email FROM LibraryUsers WHERE email IN ({}) ORDER BY email FOR NO KEY UPDATE".format(
+            placeholders(len(emails))), emails)
+        patrons = set(email for email, in cursor.fetchall())
+
+        # Stock at this branch, locked (in ISBN order) until the commit so no other desk can take it meanwhile
+        cursor.execute("SELECT isbn,quantity FROM Inventory WHERE branch = %s AND isbn IN ({}) ORDER BY isbn FOR UPDATE".format(
+            placeholders(len(isbns))), [branch] + isbns)
+        stock = {isbn.strip(): quantity for isbn, quantity in cursor.fetchall()}
+        stocked = set((branch, isbn) for isbn in stock)
+
+        pairs = sorted(set((event.email, event.isbn) for event in group))
+        params = [value for pair in pairs for value in pair]
+        cursor.execute("SELECT email,isbn,branch,duedate FROM Borrow WHERE (email, isbn) IN (VALUES {})".format(
+            placeholders(len(pairs), 2)), params)
+        loans = {}          # (email, isbn) -> (branch, duedate), as it stands after the events so far
+        for email, isbn, loan_branch, duedate in cursor.fetchall():
+            loans.setdefault((email, isbn.strip()), (loan_branch, duedate))
+        existing = dict(loans)
+
+        today = datetime.date.today()
+        duedate = today + datetime.timedelta(days=LOAN_DAYS)
+        deltas = {}         # (branch, isbn) -> [quantity change, copies change]
+        outcomes = []
+        out_of_stock = set()
+        for event in group:
+            key = (event.email, event.isbn)
+            if event.isbn not in titles:
+                outcomes.append((False, 'Could not find the book.', 'unknown_book'))
+            elif event.email not in patrons:
+                outcomes.append((False, 'Could not find the patron.', 'unknown_patron'))
+            elif event.op == 'checkout':
+                if stock.get(event.isbn, 0) < 1:
+                    out_of_stock.add(event.isbn)
+                    outcomes.append((False, 'Sorry, that book is out of stock.', 'out_of_stock'))
+                elif key in loans:
+                    outcomes.append((False, 'That patron already has this book.', 'already_borrowed'))
+                else:
+                    stock[event.isbn] -= 1
+                    loans[key] = (branch, duedate)
+                    deltas.setdefault((branch, event.isbn), [0, 0])[0] -= 1
+                    outcomes.append((True, 'due ' + duedate.strftime(FORMAT), None))
+            else:
+                if key not in loans:
+                    outcomes.append((False, 'Not showing that you have borrowed this book. Please check the email and ISBN again.', 'not_borrowed'))
+                    continue
+                loan_branch, loan_due = loans.pop(key)
+                stock[event.isbn] = stock.get(event.isbn, 0) + 1
+                moved = 1 if loan_branch != branch else 0
+                deltas.setdefault((branch, event.isbn), [0, 0])[0] += 1
+                deltas[(branch, event.isbn)][1] += moved
+                if moved:
+                    deltas.setdefault((loan_branch, event.isbn), [0, 0])[1] -= 1
+                days_overdue, charge = services.overdue_charge(loan_due, today)
+                outcomes.append((True, return_detail(days_overdue, charge), None))
+
+        # When the out of stock books come back here
+        if len(out_of_stock) > 0:
+            cursor.execute("SELECT isbn,duedate FROM Borrow WHERE branch = %s AND isbn IN ({})".format(
+                placeholders(len(out_of_stock))), [branch] + sorted(out_of_stock))
+            next_due = {}
+            for isbn, due in cursor.fetchall():
+                next_due[isbn.strip()] = min(due, next_due.get(isbn.strip(), due))
+            for i, event in enumerate(group):
+                ok, text, reason = outcomes[i]
+                if not ok and event.isbn in next_due and text.startswith('Sorry, that book is out of stock'):
+                    outcomes[i] = (False, text + ' It will be available on ' + next_due[event.isbn].strftime(FORMAT), reason)
+
+        self.write_changes(cursor, existing, loans, deltas, stocked, today, duedate)
+        self.connection.commit()
+        return outcomes
+
+    # The group's net effect: loans that ended, loans that started, stock per (branch, isbn)
+    # (stocked: the (branch, isbn) rows that were there when the group started)
+    def write_changes(self, cursor, existing, loans, deltas, stocked, today, duedate):
+        ended = [(key, existing[key][0]) for key in existing if loans.get(key) != existing[key]]
+        started = [(key, loans[key][0]) for key in loans if existing.get(key) != loans[key]]
+        changes = []
+
+        if len(ended) > 0:
+            params = [value for (email, isbn), loan_branch in ended for value in (loan_branch, email, isbn)]
+            cursor.execute("DELETE FROM Borrow WHERE (branch, email, isbn) IN (VALUES {})".format(placeholders(len(ended), 3)), params)
+            for (email, isbn), loan_branch in ended:
+                changes.append(('Borrow', 'D', changelog.row_key(email, isbn, loan_branch), {'isbn': isbn, 'email': email, 'branch': loan_branch}))
+
+        if len(started) > 0:
+            params = [value for (email, isbn), loan_branch in started for value in (loan_branch, isbn, email, today, duedate)]
+            cursor.execute("INSERT INTO Borrow(branch,isbn,email,borrowdate,duedate) VALUES {}".format(placeholders(len(started), 5)), params)
+            for (email, isbn), loan_branch in started:
+                changes.append(('Borrow', 'I', changelog.row_key(email, isbn, loan_branch),
+                                {'isbn': isbn, 'email': email, 'branch': loan_branch, 'borrowdate': today, 'duedate': duedate}))
+
+        deltas = {key: delta for key, delta in deltas.items() if delta != [0, 0]}
+        if len(deltas) > 0:
+            keys = sorted(deltas)
+            # Returns to a branch that had no row for the book are inserted (they only ever add, so
+            # the quantity CHECK holds for the row to insert); everything else is updated in place
+            new = [key for key in keys if key[0] == self.branch and key not in stocked]
+            updates = [key for key in keys if key not in new]
+            if len(updates) > 0:
+                params = [value for key in updates for value in (key[0], key[1], deltas[key][0], deltas[key][1])]
+                cursor.execute("""UPDATE Inventory AS i
+                                  SET quantity = i.quantity + CAST(v.column3 AS INTEGER), copies = i.copies + CAST(v.column4 AS INTEGER)
+                                  FROM (VALUES {}) AS v WHERE i.branch = v.column1 AND i.isbn = v.column2""".format(
+                    placeholders(len(updates), 4)), params)
+            if len(new) > 0:
+                params = [value for key in new for value in (key[0], key[1], deltas[key][0], deltas[key][1])]
+                cursor.execute("""INSERT INTO Inventory(branch,isbn,quantity,copies) VALUES {}
+                                  ON CONFLICT (branch,isbn) DO UPDATE SET quantity = Inventory.quantity + excluded.quantity,
+                                                                          copies = Inventory.copies + excluded.copies""".format(
+                    placeholders(len(new), 4)), params)
+            for loan_branch, isbn in keys:
+                quantity, copies = deltas[(loan_branch, isbn)]
+                changes.append(('Inventory', 'U', changelog.row_key(loan_branch, isbn),
+                                {'isbn': isbn, 'branch': loan_branch, 'delta': quantity, 'copies': copies}))
+
+        if len(changes) > 0:
+            changelog.record(cursor, changes)
+
+def return_detail(days_overdue, charge):
+    if days_overdue > 0:
+        return 'overdue {} days charge ${}'.format(days_overdue, charge)
+    return 'on time'
+
+# Submit the events in a line stream, replying through reply(text); returns the last event
+def read_events(lines, committer, reply):
+    last = None
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        # A line that can't be parsed still goes through the committer, so its reply keeps its place
+        try:
+            op, email, isbn = parse(line)
+            last = Event(op, email, isbn, reply)
+        except InvalidRequest as error:
+            last = Event(None, None, None, reply, error='{} {}'.format(error.message, line.strip()))
+        committer.submit(last)
+    return last
+
+# One scanner connection: events in, replies out on the same socket
+class ScannerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lock = threading.Lock()
+        def reply(text):
+            with lock:
+                try:
+                    self.wfile.write(text.encode())
+                    self.wfile.flush()
+                except OSError:
+                    pass    # the scanner went away; its events are committed anyway
+        lines = (line.decode(errors='replace') for line in self.rfile)
+        last = read_events(lines, self.server.committer, reply)
+        # Keep the connection until its last event is answered
+        if last != None:
+            last.done.wait()
+
+class ScannerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, committer):
+        super().__init__(address, ScannerHandler)
+        self.committer = committer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Group-commit circulation for barcode scanner events')
+    parser.add_argument('--port', type=int, help='listen on localhost:PORT instead of reading stdin')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--branch', help='branch the desk is at (default LIBRARY_BRANCH)')
+    parser.add_argument('--group', type=int, default=GROUP_SIZE, help='events per commit at most')
+    parser.add_argument('--wait-ms', type=float, default=GROUP_WAIT_MS, help='longest wait for a group to fill')
+    args = parser.parse_args()
+
+    metrics.serve_from_environment()
+    committer = GroupCommitter(args.branch, args.group, args.wait_ms)
+    worker = threading.Thread(target=committer.run, name='group-commit')
+    worker.start()
+    start = time.perf_counter()
+
+    if args.port != None:
+        server = ScannerServer((args.host, args.port), committer)
+        sys.stderr.write('Listening for scanners on {}:{}\n'.format(args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    else:
+        output = threading.Lock()
+        def reply(text):
+            with output:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+        read_events(sys.stdin, committer, reply)
+
+    committer.close()
+    worker.join()
+    seconds = time.perf_counter() - start
+    stats = committer.stats
+    sys.stderr.write('{} events in {} commits ({:.1f} per commit), {} failed, {} replayed one by one, {:.0f} events/s\n'.format(
+        stats['events'], stats['groups'], stats['events'] / max(stats['groups'], 1), stats['failed'], stats['replayed'],
+        stats['events'] / max(seconds, 1e-9)))
@@ -0,0 +1,550 @@
+import os
+import sqlite3
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2.errors
+
+import credentials
+import changelog
+import metrics
+import instrumentation
+
+# Library operations without any terminal I/O
+# The Views (terminal), the terminal server and the HTTP API all call these.
+# Each one takes the DataBase and a cursor from one of its pooled connections, returns plain
+# dicts/lists, and raises LibraryError with the message the user should see when it can't go ahead.
+# The ones that write commit on the cursor's connection before returning, with their changes
+# recorded in the change log (changelog.py) in the same transaction.
+
+# Format for DATE
+FORMAT = "%m/%d/%Y"
+
+# Late fee per day overdue
+DAILY_FEE = 0.25
+
+# Loan length in days
+LOAN_DAYS = 14
+
+# Branch this desk checks books out from and takes returns at (the sync name of a branch database)
+BRANCH = changelog.ORIGIN
+
+class LibraryError(Exception):
+    status = 400    # HTTP status for the API
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+class InvalidRequest(LibraryError):
+    status = 400
+
+class NotAuthenticated(LibraryError):
+    status = 401
+
+class Forbidden(LibraryError):
+    status = 403
+
+class NotFound(LibraryError):
+    status = 404
+
+class Conflict(LibraryError):
+    status = 409
+
+# ---------------- Validation ----------------
+
+# Email must have an @ and end in com,org,edu
+def valid_email(email):
+    if not email.endswith('com') and not email.endswith('org') and not email.endswith('edu'):
+        return False
+    return '@' in email
+
+# Date must parse with FORMAT ("MM/DD/YYYY")
+def valid_date(value):
+    try:
+        datetime.datetime.strptime(value, FORMAT)
+    except ValueError:
+        return False
+    return True
+
+# Form field checks that don't need the database
+# Returns the error message for the first rule that fails, or None if the fields are valid
+# (shared by validate_signup and the bulk patron import)
+def check_form_fields(formdata):
+    firstname = formdata['firstname']
+    lastname  = formdata['lastname']
+    email     = formdata['email']
+    dob       = formdata['dob']
+    password  = formdata['password']
+    conf_pass = formdata['conf_pass']
+    # If anything is empty
+    if len(firstname) == 0 or len(lastname) == 0 or len(dob) == 0 or len(password) == 0:
+        return 'Sorry, all fields are required'
+
+    # If email does not have @ or ends in com,org,edu
+    if not valid_email(email):
+        return "Invalid email entered"
+
+    # DOB format should be "MM/DD/YYYY"
+    if not valid_date(dob):
+        return "This is the incorrect date format. It should be DD/MM/YYYY"
+
+    # If the passwords don't match
+    if password != conf_pass:
+        return "Sorry, the passwords do not match. Please try again."
+
+    return None
+
+# Sign up form validation (raises InvalidRequest/Conflict)
+def validate_signup(db, cursor, formdata):
+    # If anything is empty
+    if len(formdata['firstname']) == 0 or len(formdata['lastname']) == 0 or len(formdata['dob']) == 0 or len(formdata['password']) == 0:
+        raise InvalidRequest('Sorry, all fields are required')
+
+    # If the email already exists (in any case)
+    db.execute_prepared(cursor, 'email_in_use', (formdata['email'],))
+    if cursor.fetchone() != None:
+        raise Conflict('Sorry, that email has already been used')
+
+    # Email format, DOB format and matching passwords
+    error = check_form_fields(formdata)
+    if error != None:
+        raise InvalidRequest(error)
+
+# ---------------- Patrons ----------------
+
+# Create a patron account from the sign up form
+def sign_up(db, cursor, formdata):
+    validate_signup(db, cursor, formdata)
+
+    # Take the password and hash to get a salted hashed password (store safely in db)
+    password = credentials.hash_password(formdata['password'])
+    patron = {
+        'email'     : formdata['email'],
+        'firstname' : formdata['firstname'],
+        'lastname'  : formdata['lastname'],
+        'dob'       : datetime.datetime.strptime(formdata['dob'], FORMAT).date(),
+        'isadmin'   : 'N',
+        'password'  : password,
+    }
+    cursor.execute(
+        """INSERT INTO LibraryUsers(email,firstname,lastname,dob,isadmin,password)
+        VALUES (%s, %s, %s, %s, %s, %s)""",
+        (formdata['email'], formdata['firstname'], formdata['lastname'], formdata['dob'], 'N', password)
+    )
+    changelog.record(cursor, [('LibraryUsers', 'I', changelog.row_key(patron['email']), patron)])
+    cursor.connection.commit()
+    return {'email': formdata['email'], 'firstname': formdata['firstname'], 'lastname': formdata['lastname']}
+
+# Check an email and password; returns {'email', 'isadmin'} or raises NotAuthenticated
+def authenticate(db, cursor, email, password):
+    # Get the user and stored (salted) hash for that email in one primary key lookup
+    db.execute_prepared(cursor, 'login_by_email', (email,))
+    result = cursor.fetchone() # [email,isadmin,password]
+
+    # Check the password against the stored hash
+    if result == None or not credentials.verify_password(password, result[2]):
+        raise NotAuthenticated('Sorry, we could not authenticate your credentials.')
+    result = db.result_to_dict(cursor, result)
+
+    # Upgrade old sha3 hashes (or hashes at an old cost) now that we have the password
+    if credentials.needs_rehash(result['password']):
+        upgrade_password(db, result['email'], result['password'], credentials.hash_password(password))
+    del result['password']
+    return result
+
+# Replace the stored hash `old` (just checked against the password) with `new`
+# Patrons can't write LibraryUsers, so this takes a librarian connection; the old hash is part of the
+# WHERE, so a password changed in the meantime is left alone
+def upgrade_password(db, email, old, new):
+    connection = db.get_librarian_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute("UPDATE LibraryUsers SET password = %s WHERE email = %s AND password = %s", (new, email, old))
+        if cursor.rowcount == 1:
+            changelog.record(cursor, [('LibraryUsers', 'U', changelog.row_key(email), {'email': email, 'password': new})])
+        connection.commit()
+    finally:
+        cursor.close()
+        db.release(connection)
+
+# ---------------- Circulation ----------------
+
+# Count a refused checkout (for the metrics) and hand back the error to raise
+def checkout_failure(reason, error):
+    metrics.inc('library_checkout_failures_total', reason=reason)
+    return error
+
+# 'unique' or 'check' for a unique or check constraint failure on either backend, else None
+# (sqlite3 raises IntegrityError for all of them and only the message tells which)
+def constraint_violation(error):
+    if isinstance(error, psycopg2.errors.UniqueViolation) or 'UNIQUE constraint failed' in str(error):
+        return 'unique'
+    if isinstance(error, psycopg2.errors.CheckViolation) or 'CHECK constraint failed' in str(error):
+        return 'check'
+    return None
+
+# Check a book out to a patron from a branch's shelf
+# Returns {'name', 'email', 'title', 'isbn', 'branch', 'borrowdate', 'duedate'}
+def checkout(db, cursor, email, isbn, today=None, branch=None):
+    branch = branch or BRANCH
+
+    # Get book with that isbn
+    db.execute_prepared(cursor, 'book_by_isbn', (isbn,))
+    book = cursor.fetchone()
+    if book == None:
+        raise checkout_failure('unknown_book', NotFound('Could not find the book.'))
+    book = db.result_to_dict(cursor, book)
+
+    # Make sure quantity > 0 at this branch
+    db.execute_prepared(cursor, 'inventory_by_branch_isbn', (branch, book['isbn']))
+    inventory = cursor.fetchone()
+    if inventory == None or int(db.result_to_dict(cursor, inventory)['quantity']) < 1:
+        # Get the most recent due date for that book here, and where else it is on the shelf
+        db.execute_prepared(cursor, 'next_due_by_branch_isbn', (branch, book['isbn']))
+        query = cursor.fetchone()
+        elsewhere = available_copies(db, cursor, [book['isbn']]).get(book['isbn'], [])
+        message = 'Sorry, that book is out of stock.'
+        if query != None:
+            message = message + ' It will be available on ' + datetime.datetime.strftime(query[0], FORMAT)
+        if len(elsewhere) > 0:
+            message = message + '\nOn the shelf at: ' + ', '.join(copy['branch'] for copy in elsewhere)
+        raise checkout_failure('out_of_stock', Conflict(message))
+
+    # Get user with that email, locking the row until the commit: a patron's checkouts (at any
+    # branch) go one at a time, so the loan check below can't miss one being made meanwhile
+    db.execute_prepared(cursor, 'user_for_checkout', (email,))
+    patron = cursor.fetchone()
+    if patron == None:
+        raise checkout_failure('unknown_patron', NotFound('Could not find the patron.'))
+    patron = db.result_to_dict(cursor, patron)
+
+    # Dates for the loan
+    today = today or datetime.date.today()
+    duedate = today + datetime.timedelta(days=LOAN_DAYS)
+
+    try:
+        # One loan per patron and book across all the branches (Borrow's key includes the branch)
+        cursor.execute(
+                """INSERT INTO Borrow(branch,isbn,email,borrowdate,duedate)
+                SELECT %s, %s, %s, %s, %s
+                WHERE NOT EXISTS (SELECT 1 FROM Borrow WHERE email = %s AND isbn = %s)""",
+                (branch, book['isbn'], patron['email'], today, duedate, patron['email'], book['isbn'])
+        )
+        if cursor.rowcount == 0:
+            raise checkout_failure('already_borrowed', Conflict('That patron already has this book.'))
+
+        # Update inventory, setting that book's quantity at this branch - 1
+        # (only this branch's row is locked, so other branches' desks never wait on it)
+        cursor.execute("UPDATE Inventory SET quantity = quantity - 1 WHERE branch = %s AND isbn = %s", (branch, book['isbn']))
+        changelog.record(cursor, [
+            ('Borrow',    'I', changelog.row_key(patron['email'], book['isbn'], branch),
+             {'isbn': book['isbn'], 'email': patron['email'], 'branch': branch, 'borrowdate': today, 'duedate': duedate}),
+            ('Inventory', 'U', changelog.row_key(branch, book['isbn']), {'isbn': book['isbn'], 'branch': branch, 'delta': -1}),
+        ])
+        cursor.connection.commit()
+    except LibraryError:
+        # Don't keep the patron locked
+        cursor.connection.rollback()
+        raise
+    except (psycopg2.IntegrityError, sqlite3.IntegrityError) as error:
+        violation = constraint_violation(error)
+        if violation == None:
+            metrics.inc('library_checkout_failures_total', reason='error')
+            raise
+        cursor.connection.rollback()
+        # quantity_check: the last copy went to another desk meanwhile
+        if violation == 'check':
+            raise checkout_failure('out_of_stock', Conflict('Sorry, that book is out of stock.'))
+        raise checkout_failure('already_borrowed', Conflict('That patron already has this book.'))
+    except Exception:
+        metrics.inc('library_checkout_failures_total', reason='error')
+        raise
+    metrics.inc('library_checkouts_total', branch=branch)
+
+    return {
+        'name'       : patron['firstname'] + ' ' + patron['lastname'],
+        'email'      : patron['email'],
+        'title'      : book['title'],
+        'isbn'       : book['isbn'],
+        'branch'     : branch,
+        'borrowdate' : today,
+        'duedate'    : duedate,
+    }
+
+# Days overdue and charge for a due date (negative days = due in that many days)
+def overdue_charge(duedate, today=None):
+    today = today or datetime.date.today()
+    days_overdue = (today - duedate).days
+    charge = days_overdue * DAILY_FEE if days_overdue > 0 else 0
+    return days_overdue, charge
+
+# Take a book back from a patron at a branch (the copy joins that branch's shelf and copies,
+# whichever branch it was checked out from)
+# Returns {'email', 'isbn', 'title', 'branch', 'days_overdue', 'charge'}
+def process_return(db, cursor, email, isbn, today=None, branch=None):
+    branch = branch or BRANCH
+
+    # Get book with that isbn
+    db.execute_prepared(cursor, 'book_by_isbn', (isbn,))
+    book = cursor.fetchone()
+    if book == None:
+        raise NotFound('Could not find the book.')
+    book = db.result_to_dict(cursor, book)
+
+    # Get user with that email
+    db.execute_prepared(cursor, 'user_by_email', (email,))
+    if cursor.fetchone() == None:
+        raise NotFound('Could not find the patron.')
+
+    # Get the borrowdate and duedate from the borrow record (this branch's loan if, from before
+    # loans were one per patron and book across branches, there is more than one)
+    db.execute_prepared(cursor, 'borrow_by_email_isbn', (email, isbn, branch))
+    query = cursor.fetchone()
+
+    # If query is None, then we couldn't find that patron with that book (email,isbn)
+    if query == None:
+        raise NotFound('Not showing that you have borrowed this book.\nPlease check the email and ISBN again.')
+    borrow_record = db.result_to_dict(cursor, query)
+    days_overdue, charge = overdue_charge(borrow_record['duedate'], today)
+
+    # Delete the borrow entry (in the partition of the branch it was checked out from)
+    cursor.execute("DELETE FROM Borrow WHERE branch = %s AND email = %s AND isbn = %s",
+                   (borrow_record['branch'], email, isbn))
+
+    # A copy from another branch now belongs here
+    moved = 1 if borrow_record['branch'] != branch else 0
+    changes = [('Borrow', 'D', changelog.row_key(email, isbn, borrow_record['branch']), {'isbn': isbn, 'email': email, 'branch': borrow_record['branch']})]
+    if moved:
+        cursor.execute("UPDATE Inventory SET copies = copies - 1 WHERE branch = %s AND isbn = %s",
+                       (borrow_record['branch'], isbn))
+        changes.append(('Inventory', 'U', changelog.row_key(borrow_record['branch'], isbn),
+                        {'isbn': isbn, 'branch': borrow_record['branch'], 'delta': 0, 'copies': -1}))
+
+    # Update the inventory here (a branch that didn't stock the book has one now)
+    cursor.execute("""INSERT INTO Inventory(branch,isbn,quantity,copies) VALUES (%s, %s, 1, 1)
+                      ON CONFLICT (branch,isbn) DO UPDATE SET quantity = Inventory.quantity + 1,
+                                                              copies = Inventory.copies + %s""", (branch, isbn, moved))
+    changes.append(('Inventory', 'U', changelog.row_key(branch, isbn), {'isbn': isbn, 'branch': branch, 'delta': 1, 'copies': moved}))
+    changelog.record(cursor, changes)
+    cursor.connection.commit()
+    metrics.inc('library_returns_total', branch=branch)
+
+    return {'email': email, 'isbn': isbn, 'title': book['title'], 'branch': branch,
+            'days_overdue': days_overdue, 'charge': charge}
+
+# Where copies are on the shelf now, for a list of ISBNs, in one query
+# Returns {isbn: [{'branch', 'quantity'}, ...]} with only the ISBNs that have copies somewhere
+def available_copies(db, cursor, isbns):
+    isbns = [isbn.strip() for isbn in isbns if len(isbn.strip()) > 0]
+    if len(isbns) == 0:
+        return {}
+    cursor.execute("""SELECT isbn,branch,quantity FROM Inventory
+                      WHERE isbn IN ({}) AND quantity > 0 ORDER BY isbn,branch""".format(', '.join(['%s'] * len(isbns))),
+                   isbns)
+    copies = {}
+    for isbn, branch, quantity in cursor.fetchall():
+        copies.setdefault(isbn.strip(), []).append({'branch': branch, 'quantity': quantity})
+    return copies
+
+# ---------------- Reports ----------------
+# These return row iterators over the cursor, so read them before closing it.
+
+# Rows fetched from the driver at a time
+FETCH_ROWS = 1000
+
+# The rest of the cursor's result as dicts, fetched in batches
+def iter_dicts(cursor, size=FETCH_ROWS):
+    keys = [col[0] for col in cursor.description]
+    while True:
+        rows = cursor.fetchmany(size)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            yield dict(zip(keys, row))
+
+def fetch_dicts(db, cursor):
+    return list(iter_dicts(cursor))
+
+# All the books from Borrow that are overdue
+def overdue_books(db, cursor):
+    cursor.execute("SELECT * FROM Borrow WHERE duedate < CURRENT_DATE")
+    return iter_dicts(cursor)
+
+# Every book with its authors and quantity, by title
+def book_catalog(db, cursor):
+    cursor.execute("""SELECT title,subject,
+	                        STRING_AGG(
+		                        firstname || ' ' || lastname, ', '
+	                        ) AS Authors,
+                            datepublished,isbn,quantity
+                        FROM Books NATURAL JOIN WrittenBy NATURAL JOIN Authors
+                        NATURAL JOIN (SELECT isbn,SUM(quantity) AS quantity FROM Inventory GROUP BY isbn) AS Stock
+                        GROUP BY ISBN,Title,datepublished,quantity ORDER BY Title""")
+    return iter_dicts(cursor)
+
+def without_password(patrons):
+    # Never hand out the password hashes
+    for patron in patrons:
+        patron.pop('password', None)
+        yield patron
+
+def registered_patrons(db, cursor):
+    cursor.execute("SELECT * FROM LibraryUsers")
+    return without_password(iter_dicts(cursor))
+
+def all_borrowed_books(db, cursor):
+    cursor.execute("SELECT email,title,borrowdate,duedate,isbn FROM Borrow NATURAL JOIN Books")
+    return iter_dicts(cursor)
+
+# ---------------- Dashboard ----------------
+# Small summary queries, each meant to run on its own connection at the same time as the others
+
+# Copies on the shelf at or below this count are low stock
+LOW_STOCK = 1
+
+# How many rows the dashboard lists show
+DASHBOARD_ROWS = 10
+
+def circulation_counts(db, cursor):
+    cursor.execute("""SELECT (SELECT COUNT(*) FROM Books) AS titles,
+                             (SELECT COALESCE(SUM(quantity), 0) FROM Inventory) AS on_shelf,
+                             (SELECT COUNT(*) FROM Borrow) AS on_loan,
+                             (SELECT COUNT(*) FROM Borrow WHERE duedate < CURRENT_DATE) AS overdue,
+                             (SELECT COUNT(*) FROM LibraryUsers WHERE isadmin = 'N') AS patrons""")
+    return db.result_to_dict(cursor, cursor.fetchone())
+
+# The longest overdue loans
+def top_overdue(db, cursor, limit=DASHBOARD_ROWS):
+    cursor.execute("""SELECT isbn,title,email,duedate,CURRENT_DATE - duedate AS days_overdue
+                      FROM Borrow NATURAL JOIN Books WHERE duedate < CURRENT_DATE
+                      ORDER BY duedate LIMIT %s""", (limit,))
+    return fetch_dicts(db, cursor)
+
+def low_stock(db, cursor, threshold=LOW_STOCK, limit=DASHBOARD_ROWS):
+    cursor.execute("""SELECT branch,isbn,title,quantity FROM Inventory NATURAL JOIN Books
+                      WHERE quantity <= %s ORDER BY quantity,branch,isbn LIMIT %s""", (threshold, limit))
+    return fetch_dicts(db, cursor)
+
+def recent_checkouts(db, cursor, limit=DASHBOARD_ROWS):
+    cursor.execute("""SELECT isbn,title,email,borrowdate,duedate FROM Borrow NATURAL JOIN Books
+                      ORDER BY borrowdate DESC LIMIT %s""", (limit,))
+    return fetch_dicts(db, cursor)
+
+# section -> query
+DASHBOARD = {
+    'counts'           : circulation_counts,
+    'top_overdue'      : top_overdue,
+    'low_stock'        : low_stock,
+    'recent_checkouts' : recent_checkouts,
+}
+
+# One thread per section; threads are only started the first time the dashboard is used
+dashboard_executor = ThreadPoolExecutor(max_workers=len(DASHBOARD), thread_name_prefix='dashboard')
+
+# Run one query on its own librarian connection (on a dashboard thread, for the caller's owner)
+def run_on_connection(db, query, owner):
+    db.set_owner(owner)
+    connection = db.get_read_connection('librarian')
+    try:
+        cursor = connection.cursor()
+        result = query(db, cursor)
+        cursor.close()
+        return result
+    finally:
+        db.release(connection)
+        db.set_owner(None)
+
+# All the dashboard sections, queried at the same time
+# (takes as long as the slowest query instead of the sum)
+# The sections' statements count towards the calling view (dashboard_view's time and round trips)
+def dashboard(db):
+    owner = db.get_owner()
+    view = instrumentation.current_view()
+    futures = {name: dashboard_executor.submit(instrumentation.run_for_view, view, run_on_connection, db, query, owner)
+               for name, query in DASHBOARD.items()}
+    sections = {}
+    for name, future in futures.items():
+        sections[name], work = future.result()
+        instrumentation.add_work(work)
+    return sections
+
+# ---------------- Searches ----------------
+
+def list_subjects(db, cursor):
+    db.execute_prepared(cursor, 'subjects')
+    return [item[0] for item in cursor.fetchall()]
+
+def search_by_subject(db, cursor, subject):
+    metrics.inc('library_searches_total', kind='subject')
+    db.execute_prepared(cursor, 'search_by_subject', (subject,))
+    return iter_dicts(cursor)
+
+# Surnames whose author search results are kept (least recently used dropped first)
+AUTHOR_CACHE_SIZE = int(os.environ.get('LIBRARY_AUTHOR_CACHE_SIZE', 256))
+
+# Results of author searches, by surname, each with the CatalogVersion it was read at.
+# The triggers on Books, Authors and WrittenBy bump the version on every change, whichever
+# process or tool makes it, so an entry is only used while the database still has that
+# version; checking costs one primary key read instead of the three table join.
+class AuthorCache():
+    def __init__(self, capacity=AUTHOR_CACHE_SIZE):
+        self.capacity = capacity
+        self.cache = OrderedDict() # surname -> (version, rows)
+        self.lock = threading.Lock()
+
+    # The rows cached for a surname at this version, or None
+    def get(self, key, version):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry == None or entry[0] != version:
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, rows):
+        with self.lock:
+            self.cache[key] = (version, rows)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+author_cache = AuthorCache()
+
+def catalog_version(db, cursor):
+    db.execute_prepared(cursor, 'catalog_version')
+    return cursor.fetchone()[0]
+
+def search_by_author(db, cursor, lastname):
+    metrics.inc('library_searches_total', kind='author')
+    # ' Bloom ' is the same search as 'Bloom' (the match itself is case sensitive)
+    lastname = ' '.join(lastname.split())
+    # Read before the search, so rows are never cached under a version newer than they are
+    version = catalog_version(db, cursor)
+    rows = author_cache.get(lastname, version)
+    metrics.inc('library_cache_requests_total', cache='author_search', result='miss' if rows == None else 'hit')
+    if rows == None:
+        db.execute_prepared(cursor, 'search_by_author', (lastname,))
+        rows = fetch_dicts(db, cursor)
+        author_cache.put(lastname, version, rows)
+    return iter([dict(row) for row in rows])
+
+def with_charges(books, today):
+    for book in books:
+        book['days_overdue'], book['charge'] = overdue_charge(book['duedate'], today)
+        yield book
+
+# The books a patron is borrowing, with days overdue and the current charge
+def borrowed_books(db, cursor, email, today=None):
+    cursor.execute("SELECT title,duedate FROM Borrow NATURAL JOIN Books WHERE email = %s", (email,))
+    return with_charges(iter_dicts(cursor), today)
+
+# A random book in the subject, or None
+def recommend(db, cursor, subject):
+    db.execute_prepared(cursor, 'recommend_by_subject', (subject,))
+    book = cursor.fetchone()
+    if book == None:
+        return None
+    return db.result_to_dict(cursor, book)
@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+import metrics
+from main import DataBase
+
+# Session tokens
+# A successful login gets a random token. Only its sha256 is stored in the Sessions table
+# (with the user's email, isadmin and expiry) so a returning terminal can resume without logging in again.
+# Recently used tokens are kept in an in-memory LRU, so resuming a hot session only touches the database
+# once every SESSION_RECHECK seconds. The recheck is what notices a logout in another process or an
+# expired session: expiry is always set and compared by the database's clock (now()), never this host's.
+
+# How long a session lasts after login
+SESSION_HOURS = int(os.environ.get('LIBRARY_SESSION_HOURS', 12))
+
+# How many sessions to keep in memory
+SESSION_CACHE_SIZE = int(os.environ.get('LIBRARY_SESSION_CACHE_SIZE', 1024))
+
+# How long a session in memory is trusted before it is checked against the table again (seconds)
+SESSION_RECHECK = float(os.environ.get('LIBRARY_SESSION_RECHECK', 30))
+
+# Where the terminal keeps its token between runs
+SESSION_FILE = os.environ.get('LIBRARY_SESSION_FILE', os.path.expanduser('~/.library_session'))
+
+# Only the hash of a token is ever stored or cached
+def token_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class SessionStore():
+    def __init__(self, capacity=SESSION_CACHE_SIZE):
+        self.capacity = capacity
+        self.cache = OrderedDict() # token hash -> {'email', 'isadmin', 'checked' (time.monotonic())}
+        self.lock = threading.Lock()
+
+    # Remember a session in the LRU, dropping the least recently used one when full
+    def remember(self, key, session):
+        with self.lock:
+            self.cache[key] = session
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def forget(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    # Start a session for a logged in user and return its token
+    def create(self, email, isadmin):
+        token = secrets.token_urlsafe(32)
+        key = token_key(token)
+
+        db = DataBase()
+        connection = db.get_patron_connection()
+        cursor = connection.cursor()
+        cursor.execute(
+            "INSERT INTO Sessions(token,email,isadmin,expires) VALUES (%s, %s, %s, now() + INTERVAL '{} hours')".format(SESSION_HOURS),
+            (key, email, isadmin)
+        )
+        connection.commit()
+        cursor.close()
+        db.release(connection)
+
+        self.remember(key, {'email': email, 'isadmin': isadmin, 'checked': time.monotonic()})
+        metrics.inc('library_sessions_started_total')
+        return token
+
+    # Return {'email', 'isadmin'} for a live token, or None if it is unknown, expired or revoked
+    def resume(self, token):
+        key = token_key(token)
+        with self.lock:
+            session = self.cache.get(key)
+            if session != None and time.monotonic() - session['checked'] >= SESSION_RECHECK:
+                session = None
+            if session != None:
+                self.cache.move_to_end(key)
+        metrics.inc('library_cache_requests_total', cache='sessions', result='miss' if session == None else 'hit')
+
+        # Not in memory or due for a recheck: ask the table (one primary key lookup)
+        if session == None:
+            checked = time.monotonic()
+            db = DataBase()
+            connection = db.get_patron_connection()
+            cursor = connection.cursor()
+            cursor.execute("SELECT email,isadmin FROM Sessions WHERE token = %s AND expires > now()", (key,))
+            result = cursor.fetchone()
+            if result != None:
+                session = db.result_to_dict(cursor, result)
+                session['checked'] = checked
+            cursor.close()
+            db.release(connection)
+            if session == None:
+                self.forget(key)
+                return None
+            self.remember(key, session)
+        return {'email': session['email'], 'isadmin': session['isadmin']}
+
+    # End a session (logout)
+    def revoke(self, token):
+        key = token_key(token)
+        self.forget(key)
+
+        db = DataBase()
+        connection = db.get_patron_connection()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Sessions WHERE token = %s OR expires <= now()", (key,))
+        connection.commit()
+        cursor.close()
+        db.release(connection)
+
+# Token file for this terminal
+def load_token():
+    try:
+        with open(SESSION_FILE) as tokenfile:
+            token = tokenfile.read().strip()
+    except OSError:
+        return None
+    if len(token) == 0:
+        return None
+    return token
+
+def save_token(token):
+    # Only readable by this user
+    fd = os.open(SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as tokenfile:
+        tokenfile.write(token)
+
+def clear_token():
+    try:
+        os.remove(SESSION_FILE)
+    except OSError:
+        pass
@@ -0,0 +1,278 @@
+import re
+import os
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+import datetime
+import threading
+
+import psycopg2.pool
+
+import instrumentation
+
+# SQLite backend
+# For bookmobiles and branch kiosks with no database server: the same schema in a local SQLite
+# file (WAL mode), used in-process by every view. Selected with
+#
+#     LIBRARY_BACKEND=sqlite LIBRARY_SQLITE_PATH=/var/lib/library/library.db python main.py
+#
+# DataBase gets an SQLitePool instead of the psycopg2 pools. Its connections and cursors behave
+# like the psycopg2 ones the views use: %s and $1 parameters, lower case column names, DATE
+# columns read back as datetime.date. Postgres-only SQL (STRING_AGG, CURRENT_DATE arithmetic,
+# now()) is translated once per statement text.
+#
+#     python sqlite_backend.py library.db --sample      (create the schema and load Tables/)
+#
+# There are no database roles: librarian and patron share the file. The COPY based tools
+# (bulk_import, datagen --copy, export) need Postgres.
+
+# Waiting for another writer before giving up (ms)
+BUSY_TIMEOUT = int(os.environ.get('LIBRARY_SQLITE_BUSY_MS', 5000))
+
+# Connection settings run on every new connection
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA busy_timeout = {}'.format(BUSY_TIMEOUT),
+]
+
+MDY_LITERAL = re.compile(r"'(\d\d)/(\d\d)/(\d{4})'")
+MDY_VALUE = re.compile(r'(\d\d)/(\d\d)/(\d{4})$')
+
+# Postgres spelling -> SQLite spelling
+REWRITES = [
+    (re.compile(r'%s'),                                 '?'),
+    (re.compile(r'\$(\d+)'),                            r'?\1'),
+    (re.compile(r'\bSTRING_AGG\s*\(', re.I),            'GROUP_CONCAT('),
+    (re.compile(r'\bCURRENT_DATE\s*-\s*(\w+)', re.I),   r"CAST(julianday(date('now', 'localtime')) - julianday(\1) AS INTEGER)"),
+    (re.compile(r'\bCURRENT_DATE\b', re.I),             "date('now', 'localtime')"),
+    (re.compile(r"\bnow\(\)\s*\+\s*INTERVAL\s*'(\d+) hours?'", re.I), r"datetime('now', 'localtime', '+\1 hours')"),
+    (re.compile(r'\bnow\(\)', re.I),                    "datetime('now', 'localtime')"),
+    (re.compile(r'\bUSING\s+HASH\b', re.I),             ''),
+    (re.compile(r'\s+FOR\s+(NO\s+KEY\s+)?UPDATE\b', re.I), ''),
+    (re.compile(r'\s+INCLUDE\s*\([^)]*\)', re.I),         ''),
+    (re.compile(r'\)\s*PARTITION\s+BY\s+LIST\s*\(\s*\w+\s*\)', re.I), ')'),
+    (MDY_LITERAL,                                       r"'\3-\1-\2'"),
+]
+
+translations = {}
+translations_lock = threading.Lock()
+
+def translate(sql):
+    translated = translations.get(sql)
+    if translated == None:
+        translated = sql
+        for pattern, replacement in REWRITES:
+            translated = pattern.sub(replacement, translated)
+        with translations_lock:
+            translations[sql] = translated
+    return translated
+
+# Postgres reads 'MM/DD/YYYY' into a DATE (DateStyle MDY); store those as ISO dates here too
+def adapt_value(value):
+    if isinstance(value, str):
+        match = MDY_VALUE.match(value)
+        if match != None:
+            month, day, year = match.groups()
+            return '{}-{}-{}'.format(year, month, day)
+    return value
+
+def adapt_params(params):
+    if params == None:
+        return ()
+    return tuple(adapt_value(value) for value in params)
+
+def convert_date(value):
+    text = value.decode()
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        return text
+
+def convert_timestamp(value):
+    return datetime.datetime.fromisoformat(value.decode())
+
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DATE', convert_date)
+sqlite3.register_converter('TIMESTAMP', convert_timestamp)
+
+class SQLiteCursor():
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.raw.cursor()
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql, args=None):
+        start = time.perf_counter()
+        try:
+            self.cursor.execute(translate(sql), adapt_params(args))
+        finally:
+            self.rowcount = self.cursor.rowcount
+            instrumentation.record(sql, (time.perf_counter() - start) * 1000, self.rowcount)
+        # psycopg2 (like Postgres) gives unquoted names in lower case
+        if self.cursor.description != None:
+            self.description = [(col[0].lower(),) + tuple(col[1:]) for col in self.cursor.description]
+        else:
+            self.description = None
+
+    def executemany(self, sql, seq):
+        self.cursor.executemany(translate(sql), [adapt_params(args) for args in seq])
+        self.rowcount = self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def copy_expert(self, sql, file, size=8192):
+        raise NotImplementedError('COPY needs the Postgres backend')
+
+    def close(self):
+        self.cursor.close()
+
+# Looks like a PooledConnection to DataBase and the views
+class SQLiteConnection():
+    backend = 'sqlite'
+
+    def __init__(self, path):
+        # Deferred reads, and writers queue for the lock (busy_timeout) when their first write starts
+        self.raw = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                   isolation_level='IMMEDIATE', check_same_thread=False)
+        for pragma in PRAGMAS:
+            self.raw.execute(pragma)
+        self.role = None
+        self.prepared = set()
+        self.closed = False
+
+    def cursor(self, name=None):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        start = time.perf_counter()
+        self.raw.commit()
+        instrumentation.record('COMMIT', (time.perf_counter() - start) * 1000, 0)
+
+    def rollback(self):
+        start = time.perf_counter()
+        self.raw.rollback()
+        instrumentation.record('ROLLBACK', (time.perf_counter() - start) * 1000, 0)
+
+    def close(self):
+        self.raw.close()
+        self.closed = True
+
+# Same interface as psycopg2's ThreadedConnectionPool (each connection is used by one thread at a time)
+class SQLitePool():
+    def __init__(self, minconn, maxconn, path):
+        self.path = path
+        self.maxconn = maxconn
+        self.idle = []
+        self.used = 0
+        self.lock = threading.Lock()
+        # Every statement is IF NOT EXISTS, so this also adds tables new to an existing file
+        create_schema(path)
+        for i in range(minconn):
+            self.idle.append(SQLiteConnection(path))
+
+    def getconn(self):
+        with self.lock:
+            if len(self.idle) > 0:
+                connection = self.idle.pop()
+            elif self.used >= self.maxconn:
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+            else:
+                connection = None
+            self.used += 1
+        if connection == None:
+            connection = SQLiteConnection(self.path)
+        return connection
+
+    def putconn(self, connection, close=False):
+        if close:
+            connection.close()
+        elif connection.raw.in_transaction:
+            connection.raw.rollback()
+        with self.lock:
+            self.used -= 1
+            if not close:
+                self.idle.append(connection)
+
+    def closeall(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+# Postgres-only statements: roles, grants, partitions, sequences and the plpgsql trigger functions
+# (SQLite gets TRIGGERS instead)
+POSTGRES_ONLY = re.compile(r'^(GRANT|REVOKE|CREATE\s+USER|CREATE\s+(OR\s+REPLACE\s+)?FUNCTION|(CREATE|DROP)\s+TRIGGER'
+                           r'|CREATE\s+SEQUENCE|SELECT\s+setval)\b'
+                           r'|\bPARTITION\s+OF\b', re.I)
+
+def postgres_only(statement):
+    return POSTGRES_ONLY.search(statement) != None
+
+# Row triggers that keep CatalogVersion current, like the statement triggers on Postgres
+TRIGGERS = ["""CREATE TRIGGER IF NOT EXISTS {0}_{1}_catalog_version AFTER {1} ON {0}
+               BEGIN UPDATE CatalogVersion SET Version = Version + 1 WHERE Id = 1; END""".format(table, op)
+            for table in ['Books', 'Authors', 'WrittenBy'] for op in ['INSERT', 'UPDATE', 'DELETE']]
+
+# The CREATE (and seed INSERT) statements of LibraryCreateQueries.txt in SQLite form
+# (roles, grants and partitions dropped: Inventory and Borrow are plain tables here)
+def schema(path=None):
+    from temp_postgres import schema_statements, SCHEMA_FILE
+    statements = []
+    for statement in schema_statements(path or SCHEMA_FILE):
+        if statement.split()[0].upper() not in ['CREATE', 'INSERT'] or postgres_only(statement):
+            continue
+        statement = re.sub(r'^CREATE\s+(TABLE|VIEW|INDEX)\b', r'CREATE \1 IF NOT EXISTS', statement, flags=re.I)
+        statements.append(translate(statement))
+    return statements + TRIGGERS
+
+def create_schema(path, load_sample=False):
+    connection = SQLiteConnection(path)
+    cursor = connection.raw.cursor()
+
+    # A file from before branches (or before Inventory.Copies) is brought up to date first
+    columns = [row[1].lower() for row in cursor.execute('PRAGMA table_info(Inventory)')]
+    if len(columns) > 0 and ('branch' not in columns or 'copies' not in columns):
+        import branches
+        branches.migrate(connection)
+
+    for statement in schema():
+        cursor.execute(statement)
+
+    if load_sample:
+        from temp_postgres import schema_statements, SAMPLE_TABLES, SUPERUSER_FILE, TABLES_DIR
+        for table, columns in SAMPLE_TABLES:
+            with open(os.path.join(TABLES_DIR, table + '.csv')) as csvfile:
+                rows = csv.reader(csvfile)
+                next(rows)
+                sql = 'INSERT OR IGNORE INTO {}({}) VALUES ({})'.format(table, columns, ', '.join(['?'] * len(columns.split(','))))
+                cursor.executemany(sql, [adapt_params(row) for row in rows])
+        for statement in schema_statements(SUPERUSER_FILE):
+            cursor.execute(translate(statement.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)))
+        connection.raw.commit()
+        cursor.execute('ANALYZE')
+    connection.raw.commit()
+    connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the library schema in an SQLite file')
+    parser.add_argument('path', help='database file (created if missing)')
+    parser.add_argument('--sample', action='store_true', help='also load the sample data in Tables/ and the librarian account')
+    args = parser.parse_args()
+    create_schema(args.path, args.sample)
+    sys.stderr.write('Created {}\n'.format(args.path))
@@ -0,0 +1,198 @@
+import sys
+import json
+import zlib
+import argparse
+
+import psycopg2
+
+import changelog
+from main import PooledConnection
+
+# Branch sync
+# Reconciles a branch database (usually SQLite) with the central Postgres through their change logs.
+#
+#     push: the branch's own changes since the last one central acknowledged
+#     pull: central's changes (its own and other branches') since the last one the branch applied
+#
+# Changes travel in zlib-compressed JSON batches. Each batch is applied in one transaction with the
+# receiver's SyncState, so a batch is applied exactly once and an interrupted sync just resumes.
+# Applied changes are logged again on the receiver (keeping their origin) so they reach the other branches.
+#
+#     python sync.py north sqlite:/var/lib/library/library.db "host=central dbname=bookstore user=librarian"
+#
+# Conflicts are settled the same way on every node:
+#     Inventory deltas are added to the branch's current quantity; if that would go below 0 the
+#       quantity stops at 0 and only the part that fitted is logged onwards. A branch with no row
+#       for the book gets one. Copies changes are added the same way, except that a reconcile
+#       repair ("set_copies") sets the count outright.
+#     A Borrow insert for a (email, isbn) that is already on loan at any branch, or a LibraryUsers
+#       insert for an existing email, is skipped (the first one applied wins).
+#     Borrow deletes and password updates apply as they come (the last one applied wins); one that
+#       matches no row here changes nothing and is not logged onwards.
+
+# Changes per batch
+BATCH_SIZE = 500
+
+def connect(spec):
+    if spec.startswith('sqlite:'):
+        import sqlite_backend
+        return sqlite_backend.SQLiteConnection(spec[len('sqlite:'):])
+    return psycopg2.connect(spec, connection_factory=PooledConnection)
+
+def encode_batch(last_seq, changes):
+    return zlib.compress(json.dumps({'last_seq': last_seq, 'changes': changes}, separators=(',', ':')).encode())
+
+def decode_batch(payload):
+    batch = json.loads(zlib.decompress(payload))
+    return batch['last_seq'], batch['changes']
+
+def last_applied(cursor, peer):
+    cursor.execute("SELECT lastseq FROM SyncState WHERE peer = %s", (peer,))
+    row = cursor.fetchone()
+    return row[0] if row != None else 0
+
+# The next batch from source after `after`; wanted(origin) picks which entries to send
+# Returns (payload, number of changes) or None when there is nothing after `after`
+def next_batch(source, after, wanted, size=BATCH_SIZE):
+    cursor = source.cursor()
+    entries = changelog.read(cursor, after, size)
+    cursor.close()
+    source.rollback()
+    if len(entries) == 0:
+        return None
+    # Acknowledge everything scanned, including the entries that were not wanted
+    changes = [entry for entry in entries if wanted(entry[1])]
+    return encode_batch(entries[-1][0], changes), len(changes)
+
+# Apply one change; returns (change to log onwards or None, conflict)
+def apply_change(cursor, table, op, key, data):
+    # Entries from before branches were all central's
+    branch = data.get('branch', 'central')
+
+    if table == 'Inventory':
+        cursor.execute("SELECT quantity FROM Inventory WHERE branch = %s AND isbn = %s", (branch, data['isbn']))
+        row = cursor.fetchone()
+        current = row[0] if row != None else 0
+        quantity = max(current + data['delta'], 0)
+        copies = data.get('copies', 0)
+        set_copies = data.get('set_copies')
+        if set_copies != None:
+            cursor.execute("""INSERT INTO Inventory(branch,isbn,quantity,copies) VALUES (%s, %s, %s, %s)
+                              ON CONFLICT (branch,isbn) DO UPDATE SET quantity = excluded.quantity,
+                                                                      copies = excluded.copies""",
+                           (branch, data['isbn'], quantity, set_copies))
+        else:
+            cursor.execute("""INSERT INTO Inventory(branch,isbn,quantity,copies) VALUES (%s, %s, %s, %s)
+                              ON CONFLICT (branch,isbn) DO UPDATE SET quantity = excluded.quantity,
+                                                                      copies = Inventory.copies + %s""",
+                           (branch, data['isbn'], quantity, max(copies, 0), copies))
+        applied = quantity - current
+        change = {'isbn': data['isbn'], 'branch': branch, 'delta': applied, 'copies': copies}
+        if set_copies != None:
+            change['set_copies'] = set_copies
+        return (table, op, key, change), applied != data['delta']
+
+    if table == 'Borrow' and op == 'I':
+        cursor.execute("""INSERT INTO Borrow(branch,isbn,email,borrowdate,duedate) SELECT %s, %s, %s, %s, %s
+                          WHERE NOT EXISTS (SELECT 1 FROM Borrow WHERE email = %s AND isbn = %s)""",
+                       (branch, data['isbn'], data['email'], data['borrowdate'], data['duedate'], data['email'], data['isbn']))
+    elif table == 'Borrow' and op == 'D':
+        cursor.execute("DELETE FROM Borrow WHERE branch = %s AND email = %s AND isbn = %s", (branch, data['email'], data['isbn']))
+    elif table == 'LibraryUsers' and op == 'I':
+        cursor.execute("""INSERT INTO LibraryUsers(email,firstname,lastname,dob,isadmin,password)
+                          VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
+                       (data['email'], data['firstname'], data['lastname'], data['dob'], data['isadmin'], data['password']))
+    elif table == 'LibraryUsers' and op == 'U':
+        cursor.execute("UPDATE LibraryUsers SET password = %s WHERE email = %s", (data['password'], data['email']))
+    else:
+        raise ValueError('Unknown change: {} {}'.format(table, op))
+
+    if cursor.rowcount == 0:
+        return None, op == 'I'
+    return (table, op, key, data), False
+
+# Apply a batch from peer in one transaction; returns (applied, conflicts)
+def apply_batch(target, peer, payload):
+    last_seq, changes = decode_batch(payload)
+    cursor = target.cursor()
+    try:
+        done = last_applied(cursor, peer)
+        applied = 0
+        conflicts = 0
+        onwards = {}    # origin -> changes to log again
+        for seq, origin, table, op, key, data in changes:
+            if seq <= done:
+                continue    # a batch sent again after a lost acknowledgement
+            change, conflict = apply_change(cursor, table, op, key, data)
+            applied += 1
+            conflicts += 1 if conflict else 0
+            if change != None:
+                onwards.setdefault(origin, []).append(change)
+
+        # SyncState first: record() needs a write before it (see changelog.py), and every change in
+        # the batch may have matched nothing
+        cursor.execute("""INSERT INTO SyncState(peer,lastseq) VALUES (%s, %s)
+                          ON CONFLICT (peer) DO UPDATE SET lastseq = excluded.lastseq""", (peer, max(last_seq, done)))
+        for origin, logged in onwards.items():
+            changelog.record(cursor, logged, origin)
+        target.commit()
+    except Exception:
+        target.rollback()
+        raise
+    finally:
+        cursor.close()
+    return applied, conflicts
+
+# Ship batches from source to target until source has nothing newer
+def transfer(source, target, peer, wanted, size=BATCH_SIZE):
+    totals = {'batches': 0, 'changes': 0, 'applied': 0, 'conflicts': 0, 'bytes': 0}
+    cursor = target.cursor()
+    after = last_applied(cursor, peer)
+    cursor.close()
+    target.rollback()
+    while True:
+        batch = next_batch(source, after, wanted, size)
+        if batch == None:
+            break
+        payload, count = batch
+        applied, conflicts = apply_batch(target, peer, payload)
+        after = decode_batch(payload)[0]
+        totals['batches'] += 1
+        totals['changes'] += count
+        totals['applied'] += applied
+        totals['conflicts'] += conflicts
+        totals['bytes'] += len(payload)
+    return totals
+
+# The branch's own changes to central (central remembers them under the branch name)
+def push(branch, central, name, size=BATCH_SIZE):
+    return transfer(branch, central, name, lambda origin: origin == name, size)
+
+# Everything central has that did not come from this branch
+def pull(central, branch, name, size=BATCH_SIZE):
+    return transfer(central, branch, 'central', lambda origin: origin != name, size)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync a branch database with central through the change logs')
+    parser.add_argument('name', help='branch name (LIBRARY_BRANCH on the branch)')
+    parser.add_argument('branch', help='branch database: sqlite:PATH or a Postgres DSN')
+    parser.add_argument('central', help='central database: a Postgres DSN (or sqlite:PATH)')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='changes per batch')
+    direction = parser.add_mutually_exclusive_group()
+    direction.add_argument('--push-only', action='store_true')
+    direction.add_argument('--pull-only', action='store_true')
+    args = parser.parse_args()
+
+    branch = connect(args.branch)
+    central = connect(args.central)
+    steps = []
+    if not args.pull_only:
+        steps.append(('push', push))
+    if not args.push_only:
+        steps.append(('pull', pull))
+    for label, step in steps:
+        source, target = (branch, central) if label == 'push' else (central, branch)
+        totals = step(source, target, args.name, args.batch)
+        sys.stderr.write('{}: {changes} changes in {batches} batches ({bytes} bytes), {applied} applied, {conflicts} conflicts\n'.format(label, **totals))
+    branch.close()
+    central.close()
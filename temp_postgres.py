@@ -0,0 +1,198 @@
+import os
+import glob
+import shutil
+import socket
+import tempfile
+import subprocess
+
+import psycopg2
+
+from main import DataBase
+
+# Throwaway local Postgres
+# Runs initdb in a temp directory, starts a server on a free port (socket in the same directory),
+# creates the bookstore database with the schema, roles and grants from LibraryCreateQueries.txt,
+# loads the sample data in Tables/ and points DataBase at it. Everything is deleted on exit.
+#
+#     with TempPostgres() as server:
+#         Views().book_catalog_view()
+#
+# start_replica() adds a hot standby streaming from it (pg_basebackup) and lists it in
+# DataBase.REPLICAS, for trying out the read routing locally:
+#
+#     with TempPostgres() as server:
+#         server.start_replica()
+#
+# The Postgres binaries are found on PATH, in /usr/lib/postgresql/*/bin, or in PG_BIN.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_FILE = os.path.join(ROOT, 'SQL Queries', 'LibraryCreateQueries.txt')
+SUPERUSER_FILE = os.path.join(ROOT, 'SQL Queries', 'createsuperuser.txt')
+TABLES_DIR = os.path.join(ROOT, 'Tables')
+
+# Sample data, in foreign key order: (table, columns)
+SAMPLE_TABLES = [
+    ('Books',     'ISBN, Title, Subject, DatePublished'),
+    ('Authors',   'AuthorID, FirstName, LastName, DOB'),
+    ('WrittenBy', 'AuthorID, ISBN'),
+    ('Inventory', 'ISBN, Quantity'),
+]
+
+def find_binary(name):
+    if os.environ.get('PG_BIN'):
+        return os.path.join(os.environ['PG_BIN'], name)
+    found = shutil.which(name)
+    if found != None:
+        return found
+    candidates = sorted(glob.glob('/usr/lib/postgresql/*/bin/' + name))
+    if len(candidates) == 0:
+        raise RuntimeError('Could not find ' + name + ' (set PG_BIN to the Postgres bin directory)')
+    return candidates[-1]
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+# The runnable statements of a .txt SQL file: drops comments, \copy lines and the
+# "Queries" section (which holds Python snippets, not SQL)
+def schema_statements(path):
+    with open(path) as sqlfile:
+        text = sqlfile.read()
+    start = text.find('----------------------- Queries')
+    end = text.find('----------------------- Views')
+    if start != -1 and end != -1:
+        text = text[:start] + text[end:]
+    lines = [line for line in text.splitlines()
+             if not line.strip().startswith('--') and not line.strip().startswith('\\copy')]
+    # Split on ';' except inside $$ quoted function bodies
+    statements = ['']
+    for i, part in enumerate('\n'.join(lines).split('$$')):
+        if i % 2 == 1:
+            statements[-1] += '$$' + part + '$$'
+        else:
+            pieces = part.split(';')
+            statements[-1] += pieces[0]
+            statements += pieces[1:]
+    return [statement.strip() for statement in statements if len(statement.strip()) > 0]
+
+class TempPostgres():
+    def __init__(self, load_sample=True, settings=None):
+        self.load_sample = load_sample
+        self.settings = settings or []  # extra "name=value" server settings
+        self.directory = None
+        self.port = None
+        self.saved_settings = None
+        self.saved_replicas = None
+        self.replicas = []              # (data directory, port) of each standby
+
+    # Connection string for the superuser (for setup, EXPLAIN, TRUNCATE and so on)
+    def dsn(self, database='bookstore'):
+        return 'host={} port={} dbname={} user=postgres'.format(self.directory, self.port, database)
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='library-pg-')
+        self.port = free_port()
+        data = os.path.join(self.directory, 'data')
+        subprocess.run([find_binary('initdb'), '-D', data, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        options = '-k {} -p {} -c listen_addresses= -c fsync=off'.format(self.directory, self.port)
+        for setting in self.settings:
+            options = options + ' -c ' + setting
+        subprocess.run([find_binary('pg_ctl'), '-D', data, '-o', options, '-w', '-l',
+                        os.path.join(self.directory, 'server.log'), 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        admin = psycopg2.connect(self.dsn('postgres'))
+        admin.autocommit = True
+        admin.cursor().execute("CREATE DATABASE bookstore")
+        admin.close()
+        self.create_schema()
+
+        # Point every DataBase() at this server
+        self.saved_settings = {role: dict(settings) for role, settings in DataBase.SETTINGS.items()}
+        for settings in DataBase.SETTINGS.values():
+            settings['host'] = self.directory
+            settings['port'] = self.port
+        DataBase.pools.clear()
+        return self
+
+    # A hot standby of this server on another port; returns its "host:port" (as in DataBase.REPLICAS)
+    def start_replica(self):
+        port = free_port()
+        data = os.path.join(self.directory, 'replica{}'.format(len(self.replicas) + 1))
+        subprocess.run([find_binary('pg_basebackup'), '-h', self.directory, '-p', str(self.port), '-U', 'postgres',
+                        '-D', data, '-R', '-X', 'stream'],
+                       check=True, stdout=subprocess.DEVNULL)
+        options = '-k {} -p {} -c listen_addresses= -c fsync=off -c hot_standby=on'.format(self.directory, port)
+        subprocess.run([find_binary('pg_ctl'), '-D', data, '-o', options, '-w', '-l',
+                        data + '.log', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        self.replicas.append((data, port))
+
+        replica = '{}:{}'.format(self.directory, port)
+        if self.saved_replicas == None:
+            self.saved_replicas = list(DataBase.REPLICAS)
+        DataBase.REPLICAS.append(replica)
+        DataBase.replica_lag.clear()
+        return replica
+
+    # Connection string for the superuser on a standby
+    def replica_dsn(self, number=1, database='bookstore'):
+        return 'host={} port={} dbname={} user=postgres'.format(self.directory, self.replicas[number - 1][1], database)
+
+    def create_schema(self):
+        connection = psycopg2.connect(self.dsn())
+        cursor = connection.cursor()
+        cursor.execute("SET DateStyle = 'ISO, MDY'")
+        statements = schema_statements(SCHEMA_FILE)
+        for statement in statements:
+            cursor.execute(statement)
+
+        if self.load_sample:
+            for table, columns in SAMPLE_TABLES:
+                with open(os.path.join(TABLES_DIR, table + '.csv')) as csvfile:
+                    cursor.copy_expert('COPY {}({}) FROM STDIN WITH (FORMAT csv, HEADER)'.format(table, columns), csvfile)
+            for statement in schema_statements(SUPERUSER_FILE):
+                cursor.execute(statement)
+
+        # Grant again so the objects created after the GRANTs (views, later tables) are covered
+        for statement in statements:
+            if statement.upper().startswith('GRANT'):
+                cursor.execute(statement)
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+    def stop(self):
+        for pool in DataBase.pools.values():
+            pool.closeall()
+        DataBase.pools.clear()
+        if self.saved_settings != None:
+            for role, settings in self.saved_settings.items():
+                DataBase.SETTINGS[role].clear()
+                DataBase.SETTINGS[role].update(settings)
+        if self.saved_replicas != None:
+            DataBase.REPLICAS[:] = self.saved_replicas
+            DataBase.replica_lag.clear()
+            self.saved_replicas = None
+
+        for data, port in self.replicas:
+            subprocess.run([find_binary('pg_ctl'), '-D', data, '-m', 'immediate', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.replicas = []
+
+        if self.directory != None:
+            subprocess.run([find_binary('pg_ctl'), '-D', os.path.join(self.directory, 'data'), '-m', 'immediate', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
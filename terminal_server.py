@@ -0,0 +1,245 @@
+import sys
+import asyncio
+import argparse
+import builtins
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+import metrics
+import instrumentation
+from main import DataBase, Views, UserType, start_session
+
+# Terminal server
+# One process serves many desks and kiosks over line-oriented TCP (telnet/nc).
+# Each connection runs the same Anonymous/Librarian/Patron menus as MainLoop, but as a coroutine,
+# so a session sitting at a menu costs a few KB and no thread.
+# When a menu option is picked the existing view runs on a shared worker thread
+# (using the shared connection pools in DataBase); its input()/getpass() prompts and print()
+# output are bridged back to that session's socket. Views ask for their input before they take a
+# pooled connection, so a view waiting on its user holds a worker thread but no connection or open
+# transaction, and a prompt inside a view gives up after PROMPT_TIMEOUT rather than IDLE_TIMEOUT.
+#
+#     python terminal_server.py --port 7000 --workers 64
+#     nc localhost 7000
+#
+# Passwords are read like any other line (no echo suppression over a raw TCP line).
+
+# Menus: (key, label, view method). Mirrors MainLoop.
+LIBRARIAN_MENU = [
+    ('1', 'Assign book to patron',     'assign_book_view'),
+    ('2', 'Process book return',       'process_return_view'),
+    ('3', 'View book catalog',         'book_catalog_view'),
+    ('4', 'View registered patrons',   'registered_patrons_view'),
+    ('5', 'View borrowed books',       'all_borrowed_books_view'),
+    ('6', 'View overdue books',        'overdue_books_view'),
+    ('7', 'View query statistics',     None),
+    ('8', 'View dashboard',            'dashboard_view'),
+]
+PATRON_MENU = [
+    ('1', 'Search by subject',         'search_by_subject_view'),
+    ('2', 'Search by author',          'search_by_author_view'),
+    ('3', 'View my borrowed books',    'borrowed_books_view'),
+    ('4', 'Get a book recommendation', 'book_recommendation_view'),
+    ('5', 'Find an available copy',    'availability_view'),
+]
+
+# Close sessions that send nothing for this long (seconds)
+IDLE_TIMEOUT = 900
+
+# How long a view's prompt waits before the session is closed (the wait holds a worker thread)
+PROMPT_TIMEOUT = 120
+
+# The session bound to the current worker thread (None on other threads)
+bound = threading.local()
+
+# Connection between one TCP session and the worker thread running a view for it
+class SessionIO():
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.pending = []
+
+    # Buffer output; it is sent in one write when the view asks for input or finishes
+    def write(self, text):
+        self.pending.append(text)
+
+    def flush(self):
+        if len(self.pending) > 0:
+            data = ''.join(self.pending).replace('\n', '\r\n').encode()
+            self.pending = []
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    async def read_line(self, timeout=IDLE_TIMEOUT):
+        line = await asyncio.wait_for(self.reader.readline(), timeout)
+        if len(line) == 0:
+            raise EOFError('session closed')
+        return line.decode(errors='replace').rstrip('\r\n')
+
+    # Called from the worker thread (stands in for input/getpass)
+    def prompt(self, message):
+        self.write(message)
+        self.flush()
+        return asyncio.run_coroutine_threadsafe(self.read_line(PROMPT_TIMEOUT), self.loop).result()
+
+# sys.stdout replacement: output from a worker thread goes to its session, anything else to the real stdout
+class SessionStdout():
+    def __init__(self, real):
+        self.real = real
+
+    def write(self, text):
+        session = getattr(bound, 'session', None)
+        if session != None:
+            session.write(text)
+            return len(text)
+        return self.real.write(text)
+
+    def flush(self):
+        if getattr(bound, 'session', None) == None:
+            self.real.flush()
+
+original_input = builtins.input
+original_getpass = main.getpass
+
+def session_input(prompt=''):
+    session = getattr(bound, 'session', None)
+    if session == None:
+        return original_input(prompt)
+    return session.prompt(prompt)
+
+def session_getpass(prompt='Password: ', stream=None):
+    session = getattr(bound, 'session', None)
+    if session == None:
+        return original_getpass(prompt=prompt, stream=stream)
+    return session.prompt(prompt)
+
+# Runs on a worker thread: a view with its I/O bound to the session
+def run_bound(session, method, kwargs):
+    bound.session = session
+    # Read your writes follows the session, whichever worker runs its next view
+    DataBase().set_owner(('terminal', id(session)))
+    try:
+        return getattr(Views(), method)(**kwargs)
+    except (EOFError, asyncio.TimeoutError):
+        raise
+    except Exception as error:
+        print('Sorry, something went wrong: {}\n'.format(error))
+        return None
+    finally:
+        DataBase().release_all()
+        DataBase().set_owner(None)
+        session.flush()
+        bound.session = None
+
+class TerminalServer():
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='view')
+        self.sessions = 0
+        # Every worker may hold a connection of each role
+        DataBase.POOL_MAX = max(DataBase.POOL_MAX, workers)
+
+    async def run_view(self, session, method, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run_bound, session, method, kwargs)
+
+    # Write menu text straight from the coroutine
+    async def send(self, session, text):
+        session.writer.write(text.replace('\n', '\r\n').encode())
+        await session.writer.drain()
+
+    async def menu(self, session, title, options):
+        lines = ['---------------- {} ----------------'.format(title), 'Select Option: ']
+        lines += ['{}: {}'.format(key, label) for key, label, method in options]
+        await self.send(session, '\n'.join(lines) + '\nSelection: ')
+        return await session.read_line()
+
+    # The MainLoop state machine for one session
+    async def handle(self, reader, writer):
+        session = SessionIO(reader, writer, asyncio.get_running_loop())
+        session_data = {'user': UserType.ANONYMOUS}
+        self.sessions += 1
+        try:
+            while True:
+                if session_data['user'] == UserType.ANONYMOUS:
+                    cmd = await self.menu(session, 'Main Menu', [('1', 'Sign up', None), ('2', 'Login', None), ('q', 'quit', None)])
+                    if cmd == '1':
+                        await self.run_view(session, 'sign_up_view')
+                    elif cmd == '2':
+                        result = await self.run_view(session, 'login_view')
+                        if result != None:
+                            start_session(session_data, result)
+                    elif cmd == 'q':
+                        break
+
+                elif session_data['user'] == UserType.LIBRARIAN:
+                    options = LIBRARIAN_MENU + [('l', 'logout', None), ('q', 'quit', None)]
+                    cmd = await self.menu(session, 'Librarian Menu ({})'.format(session_data['email']), options)
+                    methods = {key: method for key, label, method in LIBRARIAN_MENU}
+                    if cmd == '7':
+                        await self.run_stats(session)
+                    elif methods.get(cmd) != None:
+                        await self.run_view(session, methods[cmd])
+                    elif cmd == 'l':
+                        session_data = {'user': UserType.ANONYMOUS}
+                        await self.send(session, 'Logged out.\n\n')
+                    elif cmd == 'q':
+                        break
+
+                elif session_data['user'] == UserType.PATRON:
+                    options = PATRON_MENU + [('l', 'logout', None), ('q', 'quit', None)]
+                    cmd = await self.menu(session, 'Patron Menu ({})'.format(session_data['email']), options)
+                    methods = {key: method for key, label, method in PATRON_MENU}
+                    if cmd == '3':
+                        await self.run_view(session, 'borrowed_books_view', email=session_data['email'])
+                    elif methods.get(cmd) != None:
+                        await self.run_view(session, methods[cmd])
+                    elif cmd == 'l':
+                        session_data = {'user': UserType.ANONYMOUS}
+                        await self.send(session, 'Logged out.\n\n')
+                    elif cmd == 'q':
+                        break
+
+            await self.send(session, 'Goodbye.\n')
+        except (EOFError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def run_stats(self, session):
+        loop = asyncio.get_running_loop()
+        def stats():
+            bound.session = session
+            try:
+                instrumentation.print_stats()
+            finally:
+                session.flush()
+                bound.session = None
+        await loop.run_in_executor(self.executor, stats)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, limit=4096)
+        sys.stderr.write('Library terminal server listening on {}:{}\n'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the library menus to many terminals over TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--workers', type=int, default=64, help='threads running views (and pooled connections per role)')
+    args = parser.parse_args()
+
+    # Route the views' prompts and output to whichever session the thread is serving
+    builtins.input = session_input
+    main.getpass = session_getpass
+    sys.stdout = SessionStdout(sys.stdout)
+
+    server = TerminalServer(args.workers)
+    metrics.register_gauge('library_sessions_active', lambda: {(('server', 'terminal'),): server.sessions})
+    metrics.serve_from_environment()
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass